@@ -12,6 +12,22 @@ from PIL import Image, ImageTk
 import io
 import base64
 
+from flash_scheduler import FlashScheduler, FlashJob, discover_devices
+from image_verify import (VerificationError, find_images, load_checksums, record_checksums,
+                          shared_cache, unreferenced, verify_images)
+import fastboot_client
+from flash_plan import PlanCache, PlanRunner
+from flash_journal import FlashJournal
+import payload_extractor
+import super_image
+import boot_image
+import magisk_patch
+import rom_archive
+import device_monitor
+import adb_client
+import blank_image_cache
+import firmware_store
+
 # Try to import pygame, but handle audio device errors gracefully
 try:
     import pygame
@@ -26,6 +42,16 @@ class MenuAction(Enum):
     RUN_EXE = 4
     NOT_WORKING = 5
     MUSIC_PLAYER = 6
+    FLASH_ALL = 7
+    EXTRACT_PAYLOAD = 8
+    PATCH_MAGISK = 9
+    EXTRACT_ROM = 10
+    FLASH_ROM = 11
+    DEVICE_INFO = 12
+    REBOOT_BOOTLOADER = 13
+    WIPE_USERDATA = 14
+    EXTRACT_SUPER = 15
+    CANCEL_FLASH = 16
 
 class MenuItem:
     def __init__(self, name, action=None, action_data=None, submenu=None, path_segment=None):
@@ -213,6 +239,16 @@ class FlashToolGUI:
         self.music_path = os.path.join(self.base_path, "Music")
         self.current_path = self.base_path
         self.menu_stack = []
+        self.scheduler = None
+        # Выставляется отменой, пришедшей во время поиска устройств
+        self.discovery_cancelled = threading.Event()
+        self.hash_cache = shared_cache(os.path.join(self.base_path, "cache", "verify_cache.json"))
+        self.plan_cache = PlanCache(os.path.join(self.base_path, "cache", "plans"))
+        self.journal_dir = os.path.join(self.base_path, "cache", "journal")
+        self.blank_cache = blank_image_cache.shared_cache(os.path.join(self.base_path, "cache", "blank"))
+        self.firmware_store = firmware_store.shared_store(os.path.join(self.base_path, "store"))
+        # Образы, о копировании которых в хранилище уже предупреждали
+        self.reported_copies = set()
         
         # Инициализация главного окна
         self.root = tk.Tk()
@@ -229,6 +265,19 @@ class FlashToolGUI:
         # Создание GUI
         self.create_gui()
         
+        # Отслеживание подключения устройств по событиям USB
+        self.device_monitor = device_monitor.DeviceMonitor()
+        self.device_monitor.subscribe(
+            lambda event: self.root.after(0, self.update_status, event.describe()))
+        try:
+            self.device_monitor.start()
+        except Exception as e:
+            print(f"Device monitor error: {e}")
+            self.device_monitor = None
+        
+        # Подготовка пустых образов userdata/metadata до первого устройства
+        threading.Thread(target=self.warm_up_blank_images, daemon=True).start()
+        
         # Инициализация музыки ПОСЛЕ создания GUI
         try:
             self.music_player = MusicPlayer(self.music_path)
@@ -541,7 +590,11 @@ class FlashToolGUI:
             MenuItem("Оригинал.bat", MenuAction.RUN_BAT, 
                      os.path.join(base_path, "Оригинал.bat")),
             MenuItem("Magisk.bat", MenuAction.RUN_BAT, 
-                     os.path.join(base_path, "Magisk.bat"))
+                     os.path.join(base_path, "Magisk.bat")),
+            MenuItem("Оригинал → все устройства", MenuAction.FLASH_ALL,
+                     FlashJob(version, "Оригинал")),
+            MenuItem("Magisk → все устройства", MenuAction.FLASH_ALL,
+                     FlashJob(version, "Magisk"))
         ])
     
     def create_hyperos2_menu(self, version):
@@ -553,7 +606,11 @@ class FlashToolGUI:
             MenuItem("Оригинал.bat", MenuAction.RUN_BAT, 
                      os.path.join(base_path, "Оригинал.bat")),
             MenuItem("Magisk.bat", MenuAction.RUN_BAT, 
-                     os.path.join(base_path, "Magisk.bat"))
+                     os.path.join(base_path, "Magisk.bat")),
+            MenuItem("Оригинал → все устройства", MenuAction.FLASH_ALL,
+                     FlashJob(version, "Оригинал")),
+            MenuItem("Magisk → все устройства", MenuAction.FLASH_ALL,
+                     FlashJob(version, "Magisk"))
         ])
     
     def setup_menu(self):
@@ -573,7 +630,8 @@ class FlashToolGUI:
                     self.create_hyperos2_menu("2.0.3.0.VMFMIXM"),
                     self.create_hyperos2_menu("2.0.103.0.VMFMIXM"),
                     self.create_hyperos2_menu("2.0.104.0.VMFMIXM")
-                ])
+                ]),
+                MenuItem("Пропатчить все версии новым Magisk", MenuAction.PATCH_MAGISK)
             ]),
             MenuItem("Загрузка прошивки на основе официальной", submenu=[
                 MenuItem("HyperOS 2.0.103.0 EEA.bat", MenuAction.RUN_BAT, 
@@ -589,7 +647,11 @@ class FlashToolGUI:
             MenuItem("Прошивка официальных прошивок для Fastboot mode", submenu=[
                 MenuItem("FastbootTool.exe", MenuAction.RUN_EXE, 
                          os.path.join("Прошивка официальных прошивок для Fastboot mode", 
-                                      "FastbootTool.exe"))
+                                      "FastbootTool.exe")),
+                MenuItem("Распаковать fastboot-прошивку (.tgz/.zip)", MenuAction.EXTRACT_ROM),
+                MenuItem("Прошить из архива без распаковки", MenuAction.FLASH_ROM),
+                MenuItem("Извлечь образы из OTA (payload.bin)", MenuAction.EXTRACT_PAYLOAD),
+                MenuItem("Распаковать super.img", MenuAction.EXTRACT_SUPER)
             ]),
             MenuItem("Разблокировка загрузчика", submenu=[
                 MenuItem("miflash_unlock.exe", MenuAction.RUN_EXE, 
@@ -599,6 +661,13 @@ class FlashToolGUI:
                 MenuItem("driver_install_64.exe", MenuAction.RUN_EXE, 
                          os.path.join("Разблокировка загрузчика", "driver_install_64.exe"))
             ]),
+            MenuItem("Подключённые устройства", MenuAction.DEVICE_INFO),
+            MenuItem("Перевести все устройства в fastboot (adb)", MenuAction.REBOOT_BOOTLOADER),
+            MenuItem("Отменить прошивку всех устройств", MenuAction.CANCEL_FLASH),
+            MenuItem("Очистка userdata", submenu=[
+                MenuItem("Форматировать userdata (f2fs)", MenuAction.WIPE_USERDATA, False),
+                MenuItem("Форматировать userdata (f2fs, casefold)", MenuAction.WIPE_USERDATA, True)
+            ]),
             MenuItem("О программе", MenuAction.SHOW_LINK, 
                      "ProshivkaTool v1.3t для Xiaomi 13T\n\n"
                      "Инструмент для прошивки устройств Xiaomi\n"
@@ -645,9 +714,39 @@ class FlashToolGUI:
             elif item.action == MenuAction.RUN_EXE:
                 self.run_exe_file(item.action_data)
             
+            elif item.action == MenuAction.FLASH_ALL:
+                self.flash_all_devices(item.action_data)
+            
+            elif item.action == MenuAction.CANCEL_FLASH:
+                self.cancel_flash()
+            
+            elif item.action == MenuAction.EXTRACT_PAYLOAD:
+                self.extract_payload()
+            
+            elif item.action == MenuAction.EXTRACT_SUPER:
+                self.extract_super()
+            
+            elif item.action == MenuAction.PATCH_MAGISK:
+                self.patch_magisk()
+            
+            elif item.action == MenuAction.EXTRACT_ROM:
+                self.extract_rom()
+            
+            elif item.action == MenuAction.FLASH_ROM:
+                self.flash_rom_archive()
+            
+            elif item.action == MenuAction.DEVICE_INFO:
+                self.show_device_info()
+            
+            elif item.action == MenuAction.REBOOT_BOOTLOADER:
+                self.reboot_all_to_bootloader()
+            
+            elif item.action == MenuAction.WIPE_USERDATA:
+                self.wipe_userdata(item.action_data)
+            
             elif item.action == MenuAction.SHOW_LINK:
                 self.update_status(f"Показ информации: {item.name}")
-                messagebox.showinfo("Информация", item.action_data)
+                messagebox.showinfo("Информация", self.describe_link(item.action_data))
             
             elif item.action == MenuAction.OPEN_URL:
                 webbrowser.open(item.action_data)
@@ -660,6 +759,30 @@ class FlashToolGUI:
             self.update_status(f"Ошибка: {str(e)}")
             messagebox.showerror("Ошибка", f"Действие не выполнено:\n{str(e)}")
     
+    def describe_link(self, action_data):
+        """Текст для SHOW_LINK: для образов boot/vendor_boot - их заголовок"""
+        full_path = os.path.join(self.base_path, action_data)
+        if not action_data.lower().endswith(".img") or not os.path.exists(full_path):
+            return action_data
+        try:
+            with boot_image.open_image(full_path) as image:
+                lines = [full_path, "", f"Заголовок: v{image.header_version}"]
+                if isinstance(image, boot_image.VendorBootImage):
+                    lines.append(f"Плата: {image.name}")
+                    for ramdisk in image.ramdisks():
+                        lines.append(f"Ramdisk {ramdisk.name or '(platform)'}: {len(ramdisk.data)} байт")
+                    lines.append(f"DTB: {image.dtb_size} байт")
+                    lines.append(f"Bootconfig: {image.bootconfig_size} байт")
+                else:
+                    lines.append(f"Ядро: {image.kernel_size} байт")
+                    lines.append(f"Ramdisk: {image.ramdisk_size} байт")
+                    lines.append(f"Android / патч: {image.os_version_string}")
+                if image.cmdline:
+                    lines.append(f"cmdline: {image.cmdline}")
+                return "\n".join(lines)
+        except boot_image.BootImageError as e:
+            return f"{full_path}\n\n{e}"
+    
     def run_bat_file(self, relative_path):
         """Запустить .bat файл"""
         full_path = os.path.join(self.base_path, relative_path)
@@ -667,6 +790,95 @@ class FlashToolGUI:
         if not os.path.exists(full_path):
             raise FileNotFoundError(f"Файл не найден: {full_path}")
         
+        # Проверка образов в фоне, чтобы не блокировать интерфейс
+        self.update_status(f"Проверка образов: {os.path.dirname(full_path)}")
+        threading.Thread(target=self.verify_and_run_bat, args=(full_path,), daemon=True).start()
+    
+    def verify_and_run_bat(self, full_path):
+        """Проверить целостность образов и запустить .bat файл"""
+        def progress(done, total):
+            percent = int(done * 100 / total) if total else 100
+            self.root.after(0, self.update_status, f"Проверка образов: {percent}%")
+        
+        bat_dir = os.path.dirname(full_path)
+        try:
+            plan = self.plan_cache.load(full_path)
+        except Exception:
+            # Скрипт не разобран: проверяем все образы папки и запускаем его как есть
+            plan = None
+        # Образы, пропавшие из папки, но сохранённые в хранилище, возвращаются на место
+        version = firmware_store.tree_version(self.base_path, bat_dir)
+        try:
+            if version in self.firmware_store.versions():
+                self.firmware_store.checkout(version, bat_dir, replace=False)
+        except OSError:
+            pass
+        checksums = self.firmware_store.references(bat_dir)
+        checksums.update(load_checksums(bat_dir))
+        try:
+            digests = verify_images((plan and plan.images) or find_images(bat_dir), checksums,
+                                    self.hash_cache, progress=progress)
+        except VerificationError as e:
+            self.root.after(0, self.update_status, "Проверка образов не пройдена")
+            self.root.after(0, messagebox.showerror, "Ошибка",
+                            f"Образы повреждены, прошивка отменена:\n{e}")
+            return
+        
+        # Без эталона сверять не с чем: запоминаем суммы для следующих прошивок
+        recorded = unreferenced(digests, checksums)
+        if recorded:
+            try:
+                record_checksums(bat_dir, recorded)
+            except OSError:
+                pass
+            names = ", ".join(sorted(os.path.basename(path) for path in recorded))
+            self.root.after(0, messagebox.showwarning, "Внимание",
+                            f"Нет эталонных контрольных сумм, образы не сверены:\n{names}\n\n"
+                            f"Суммы записаны, следующие прошивки будут сверяться с ними.")
+        
+        # Папка переносится в хранилище: одинаковые образы версий хранятся один раз
+        copied = []
+        try:
+            self.firmware_store.adopt(version, bat_dir, digests, copied)
+            self.firmware_store.touch_paths(digests)
+            for path, digest in digests.items():
+                self.hash_cache.put(path, os.stat(path), digest)
+            self.hash_cache.save()
+        except OSError:
+            pass
+        copied = [path for path in copied if path not in self.reported_copies]
+        if copied:
+            self.reported_copies.update(copied)
+            names = ", ".join(sorted(os.path.basename(path) for path in copied))
+            self.root.after(0, messagebox.showwarning, "Хранилище прошивок",
+                            f"Жёсткие ссылки недоступны (другой диск или FAT32), образы "
+                            f"скопированы в хранилище и занимают место дважды:\n{names}")
+        
+        # Встроенный движок, если скрипт разобран полностью и устройство одно
+        try:
+            serials = self.fastboot_serials()
+        except Exception:
+            serials = []
+        if plan is None or not plan.supported or len(serials) != 1:
+            self.root.after(0, self.launch_bat_file, full_path)
+            return
+        
+        def flash_progress(fraction, message):
+            self.root.after(0, self.update_status, f"{int(fraction * 100)}% | {message}")
+        
+        try:
+            PlanRunner(plan, serials[0], progress=flash_progress,
+                       monitor=self.device_monitor,
+                       journal=FlashJournal(self.journal_dir, serials[0]),
+                       image_cache=self.blank_cache).run()
+        except Exception as e:
+            self.root.after(0, self.update_status, f"Ошибка прошивки: {e}")
+            self.root.after(0, messagebox.showerror, "Ошибка", f"Прошивка не выполнена:\n{e}")
+            return
+        self.root.after(0, self.update_status, f"Прошивка завершена: {os.path.basename(full_path)}")
+    
+    def launch_bat_file(self, full_path):
+        """Открыть .bat файл в окне cmd"""
         # Специальная обработка для путей с пробелами
         bat_dir = os.path.dirname(full_path)
         bat_file = os.path.basename(full_path)
@@ -687,6 +899,344 @@ class FlashToolGUI:
         self.update_status(f"Запуск: {full_path}")
         subprocess.Popen(f'"{full_path}"', shell=True)
     
+    def flash_all_devices(self, job):
+        """Прошить все подключённые устройства параллельно"""
+        if self.scheduler is None:
+            self.scheduler = FlashScheduler(
+                self.base_path,
+                progress_callback=lambda fraction, counts: self.root.after(
+                    0, self.show_flash_progress, fraction, counts),
+                monitor=self.device_monitor)
+        
+        cancelled = self.discovery_cancelled = threading.Event()
+        
+        # Поиск устройств может ждать "fastboot devices" до 10 секунд, поэтому в фоне
+        def work():
+            try:
+                tasks = self.scheduler.submit(job)
+                if cancelled.is_set():
+                    self.scheduler.cancel()
+                    self.root.after(0, self.update_status, "Прошивка устройств отменена")
+                    return
+            except Exception as e:
+                self.root.after(0, self.update_status, f"Ошибка: {e}")
+                self.root.after(0, messagebox.showerror, "Ошибка", f"Прошивка не запущена:\n{e}")
+                return
+            if not tasks:
+                self.root.after(0, self.update_status, "Не найдено устройств в режиме fastboot")
+                self.root.after(0, messagebox.showerror, "Ошибка",
+                                "Не найдено устройств в режиме fastboot")
+                return
+            self.root.after(0, self.update_status,
+                            f"Прошивка {job.version} ({job.variant}) на {len(tasks)} устройств")
+        
+        self.update_status("Поиск устройств в режиме fastboot...")
+        threading.Thread(target=work, daemon=True).start()
+    
+    def cancel_flash(self):
+        """Отменить прошивку, запущенную на все устройства"""
+        if self.scheduler is None:
+            self.update_status("Нет запущенной прошивки")
+            return
+        self.discovery_cancelled.set()
+        self.scheduler.cancel()
+        self.update_status("Прошивка устройств отменяется")
+    
+    def show_flash_progress(self, fraction, counts):
+        """Показать общий прогресс прошивки в строке статуса"""
+        states = ", ".join(f"{state}: {count}" for state, count in counts.items())
+        self.update_status(f"Прошивка устройств: {int(fraction * 100)}% ({states})")
+    
+    def extract_payload(self):
+        """Извлечь образы разделов из OTA-пакета"""
+        source = filedialog.askopenfilename(
+            title="OTA-пакет HyperOS/MIUI",
+            filetypes=[("OTA", "*.zip payload.bin"), ("Все файлы", "*.*")])
+        if not source:
+            return
+        try:
+            incremental = not payload_extractor.open_payload(source).is_full
+        except (OSError, payload_extractor.PayloadError) as e:
+            messagebox.showerror("Ошибка", f"Не удалось прочитать OTA:\n{e}")
+            return
+        base_version = None
+        if incremental:
+            # Инкрементальный OTA накладывается на предыдущую версию из хранилища
+            base_version = self.choose_base_version()
+            if not base_version:
+                return
+        output_dir = filedialog.askdirectory(title="Папка для образов")
+        if not output_dir:
+            return
+        
+        def progress(done, total):
+            percent = done * 100 // max(total, 1)
+            self.root.after(0, self.update_status, f"Извлечение payload.bin: {percent}%")
+        
+        def work():
+            try:
+                if base_version:
+                    images = payload_extractor.apply_incremental(source, output_dir, self.firmware_store,
+                                                                 base_version, progress=progress)
+                else:
+                    images = payload_extractor.extract(source, output_dir, progress=progress)
+            except Exception as e:
+                self.root.after(0, self.update_status, f"Ошибка извлечения: {e}")
+                self.root.after(0, messagebox.showerror, "Ошибка", f"Извлечение не выполнено:\n{e}")
+                return
+            self.root.after(0, self.update_status, f"Извлечено образов: {len(images)} в {output_dir}")
+        
+        self.update_status(f"Извлечение: {os.path.basename(source)}")
+        threading.Thread(target=work, daemon=True).start()
+    
+    def choose_base_version(self):
+        """Выбрать базовую версию из хранилища для инкрементального OTA"""
+        versions = self.firmware_store.versions()
+        if not versions:
+            messagebox.showerror("Ошибка", "Инкрементальный OTA: в хранилище нет ни одной версии.\n"
+                                 "Сначала прошейте или перенесите в хранилище исходную версию.")
+            return None
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Базовая версия")
+        dialog.transient(self.root)
+        dialog.grab_set()
+        ttk.Label(dialog, text="Инкрементальный OTA. Версия, на которую он накладывается:").pack(
+            padx=10, pady=(10, 5), anchor="w")
+        listbox = tk.Listbox(dialog, height=min(len(versions), 15), width=60)
+        for version in versions:
+            listbox.insert(tk.END, version)
+        listbox.selection_set(len(versions) - 1)
+        listbox.pack(padx=10, fill=tk.BOTH, expand=True)
+        chosen = []
+        
+        def accept(event=None):
+            selection = listbox.curselection()
+            if selection:
+                chosen.append(versions[selection[0]])
+            dialog.destroy()
+        
+        listbox.bind("<Double-Button-1>", accept)
+        buttons = ttk.Frame(dialog)
+        buttons.pack(pady=10)
+        ttk.Button(buttons, text="Выбрать", command=accept).pack(side=tk.LEFT, padx=5)
+        ttk.Button(buttons, text="Отмена", command=dialog.destroy).pack(side=tk.LEFT, padx=5)
+        self.root.wait_window(dialog)
+        return chosen[0] if chosen else None
+    
+    def extract_super(self):
+        """Извлечь логические разделы из super.img"""
+        source = filedialog.askopenfilename(
+            title="Образ super",
+            filetypes=[("super", "super*.img"), ("Все файлы", "*.*")])
+        if not source:
+            return
+        output_dir = filedialog.askdirectory(title="Папка для образов")
+        if not output_dir:
+            return
+        
+        def progress(done, total):
+            percent = done * 100 // max(total, 1)
+            self.root.after(0, self.update_status, f"Распаковка super: {percent}%")
+        
+        def work():
+            try:
+                images = super_image.extract(source, output_dir, progress=progress)
+            except Exception as e:
+                self.root.after(0, self.update_status, f"Ошибка распаковки: {e}")
+                self.root.after(0, messagebox.showerror, "Ошибка", f"super.img не распакован:\n{e}")
+                return
+            self.root.after(0, self.update_status, f"Извлечено разделов: {len(images)} в {output_dir}")
+        
+        self.update_status(f"Распаковка: {os.path.basename(source)}")
+        threading.Thread(target=work, daemon=True).start()
+    
+    def extract_rom(self):
+        """Распаковать fastboot-прошивку в несколько потоков"""
+        source = filedialog.askopenfilename(
+            title="Fastboot-прошивка Xiaomi",
+            filetypes=[("Архивы", "*.tgz *.tar.gz *.tar *.zip"), ("Все файлы", "*.*")])
+        if not source:
+            return
+        output_dir = filedialog.askdirectory(title="Папка для распаковки")
+        if not output_dir:
+            return
+        
+        def progress(done, total, rate):
+            percent = done * 100 // max(total, 1)
+            self.root.after(0, self.update_status, f"Распаковка: {percent}% ({rate:.0f} МБ/с)")
+        
+        def work():
+            try:
+                files = rom_archive.extract(source, output_dir, progress=progress)
+            except Exception as e:
+                self.root.after(0, self.update_status, f"Ошибка распаковки: {e}")
+                self.root.after(0, messagebox.showerror, "Ошибка", f"Распаковка не выполнена:\n{e}")
+                return
+            script = rom_archive.find_flash_script(output_dir)
+            message = f"Распаковано файлов: {len(files)}"
+            if script:
+                message += f", скрипт: {script}"
+            self.root.after(0, self.update_status, message)
+        
+        self.update_status(f"Распаковка: {os.path.basename(source)}")
+        threading.Thread(target=work, daemon=True).start()
+    
+    def fastboot_serials(self):
+        """Устройства в fastboot/fastbootd: из реестра монитора или опросом шины"""
+        serials = self.device_monitor.serials() if self.device_monitor else []
+        if not serials:
+            # Пустой реестр не окончателен: бэкенд монитора мог не запуститься
+            serials = discover_devices(os.path.join(self.base_path, "fastboot.exe"))
+        return serials
+    
+    def show_device_info(self):
+        """Показать модель, слоты и режим подключённых в fastboot устройств"""
+        def work():
+            blocks = []
+            try:
+                for serial in self.fastboot_serials():
+                    with fastboot_client.FastbootClient.connect(serial) as client:
+                        blocks.append(client.probe().describe())
+                    if self.device_monitor:
+                        self.device_monitor.refresh_mode(serial)
+            except Exception as e:
+                blocks.append(f"Ошибка опроса: {e}")
+            text = "\n\n".join(blocks) or "Нет устройств в режиме fastboot"
+            self.root.after(0, self.update_status, f"Устройств в fastboot: {len(blocks)}")
+            self.root.after(0, messagebox.showinfo, "Подключённые устройства", text)
+        
+        self.update_status("Опрос устройств...")
+        threading.Thread(target=work, daemon=True).start()
+    
+    def reboot_all_to_bootloader(self):
+        """Перезагрузить все устройства с включённой отладкой по USB в fastboot"""
+        def work():
+            try:
+                results = adb_client.reboot_all(adb_client.AdbClient(), monitor=self.device_monitor)
+            except adb_client.AdbError as e:
+                self.root.after(0, self.update_status, f"Ошибка adb: {e}")
+                self.root.after(0, messagebox.showerror, "Ошибка", str(e))
+                return
+            failed = {serial: error for serial, error in results.items() if error is not None}
+            self.root.after(0, self.update_status,
+                            f"В fastboot: {len(results) - len(failed)} из {len(results)}")
+            if failed:
+                text = "\n".join(f"{serial}: {error}" for serial, error in sorted(failed.items()))
+                self.root.after(0, messagebox.showwarning, "Перезагрузка в fastboot", text)
+        
+        self.update_status("Перезагрузка устройств в fastboot...")
+        threading.Thread(target=work, daemon=True).start()
+    
+    def warm_up_blank_images(self):
+        """Пересобрать отсутствующие или устаревшие образы из кэша пустых ФС"""
+        try:
+            results = self.blank_cache.warm_up()
+        except Exception as e:
+            print(f"Blank image cache error: {e}")
+            return
+        failed = [spec for spec, result in results.items() if isinstance(result, Exception)]
+        if failed:
+            print(f"Blank image cache: не собрано {len(failed)} из {len(results)}")
+    
+    def wipe_userdata(self, casefold=False):
+        """Отформатировать userdata образом, собранным на ПК (вместо make_f2fs.exe)"""
+        if not messagebox.askyesno("Очистка userdata",
+                                   "Все данные пользователя на устройстве будут удалены. Продолжить?"):
+            return
+        
+        def progress(sent, total):
+            self.root.after(0, self.update_status, f"Форматирование userdata: {sent * 100 // max(total, 1)}%")
+        
+        def work():
+            try:
+                serials = self.fastboot_serials()
+                if len(serials) != 1:
+                    raise RuntimeError(f"Нужно одно устройство в режиме fastboot, найдено: {len(serials)}")
+                with fastboot_client.FastbootClient.connect(serials[0]) as client:
+                    client.format("userdata", casefold=casefold, progress=progress,
+                                  cache=self.blank_cache)
+            except Exception as e:
+                self.root.after(0, self.update_status, f"Ошибка форматирования: {e}")
+                self.root.after(0, messagebox.showerror, "Ошибка", f"userdata не отформатирован:\n{e}")
+                return
+            self.root.after(0, self.update_status, "userdata отформатирован")
+        
+        self.update_status("Форматирование userdata...")
+        threading.Thread(target=work, daemon=True).start()
+    
+    def flash_rom_archive(self):
+        """Прошить fastboot-прошивку прямо из архива по её flash_all.bat"""
+        source = filedialog.askopenfilename(
+            title="Fastboot-прошивка Xiaomi",
+            filetypes=[("Архивы", "*.tgz *.tar.gz *.tar *.zip"), ("Все файлы", "*.*")])
+        if not source:
+            return
+        
+        def flash_progress(fraction, message):
+            self.root.after(0, self.update_status, f"{int(fraction * 100)}% | {message}")
+        
+        def verify_progress(done, total):
+            percent = int(done * 100 / total) if total else 100
+            self.root.after(0, self.update_status, f"Проверка архива: {percent}%")
+        
+        def work():
+            try:
+                serials = self.fastboot_serials()
+                if len(serials) != 1:
+                    raise RuntimeError(f"Нужно одно устройство в режиме fastboot, найдено: {len(serials)}")
+                # Архив сверяется целиком с SHA256SUMS рядом с ним, без эталона сумма записывается
+                source_dir = os.path.dirname(os.path.abspath(source))
+                checksums = load_checksums(source_dir)
+                digests = verify_images([source], checksums, self.hash_cache, progress=verify_progress)
+                if unreferenced(digests, checksums):
+                    try:
+                        record_checksums(source_dir, digests)
+                    except OSError:
+                        pass
+                    self.root.after(0, messagebox.showwarning, "Внимание",
+                                    f"Нет эталонной контрольной суммы, архив не сверен:\n"
+                                    f"{os.path.basename(source)}\n\n"
+                                    f"Сумма записана, следующие прошивки будут сверяться с ней.")
+                self.root.after(0, self.update_status, f"Чтение архива: {os.path.basename(source)}")
+                with rom_archive.RomArchive(source, os.path.join(self.base_path, "cache", "roms")) as archive:
+                    plan = self.plan_cache.load(archive.script())
+                    PlanRunner(plan, serials[0], progress=flash_progress, archive=archive,
+                               monitor=self.device_monitor,
+                               journal=FlashJournal(self.journal_dir, serials[0]),
+                               image_cache=self.blank_cache).run()
+            except Exception as e:
+                self.root.after(0, self.update_status, f"Ошибка прошивки: {e}")
+                self.root.after(0, messagebox.showerror, "Ошибка", f"Прошивка не выполнена:\n{e}")
+                return
+            self.root.after(0, self.update_status, f"Прошивка завершена: {os.path.basename(source)}")
+        
+        threading.Thread(target=work, daemon=True).start()
+    
+    def patch_magisk(self):
+        """Пропатчить boot/init_boot всех версий выбранным APK Magisk"""
+        apk_path = filedialog.askopenfilename(
+            title="APK Magisk",
+            filetypes=[("Magisk", "*.apk"), ("Все файлы", "*.*")])
+        if not apk_path:
+            return
+        
+        def progress(done, total):
+            self.root.after(0, self.update_status, f"Патчинг Magisk: {done}/{total}")
+        
+        def work():
+            try:
+                outputs = magisk_patch.patch_firmware_versions(
+                    self.base_path, apk_path, os.path.join(self.base_path, "cache", "magisk"),
+                    progress=progress)
+            except Exception as e:
+                self.root.after(0, self.update_status, f"Ошибка патчинга: {e}")
+                self.root.after(0, messagebox.showerror, "Ошибка", f"Патчинг не выполнен:\n{e}")
+                return
+            self.root.after(0, self.update_status, f"Пропатчено версий: {len(outputs)}")
+        
+        self.update_status(f"Патчинг Magisk: {os.path.basename(apk_path)}")
+        threading.Thread(target=work, daemon=True).start()
+    
     def go_back(self):
         """Go back in menu navigation"""
         if self.menu_stack:
@@ -798,4 +1348,7 @@ class FlashToolGUI:
             self.root.mainloop()
         except Exception as e:
             print(f"Error running application: {e}")
-            messagebox.showerror("Ошибка", f"Ошибка приложения: {e}")
\ No newline at end of file
+            messagebox.showerror("Ошибка", f"Ошибка приложения: {e}")
+        finally:
+            if self.device_monitor:
+                self.device_monitor.stop()
\ No newline at end of file
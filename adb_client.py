@@ -0,0 +1,295 @@
+"""
+ADB host-protocol client for ProshivkaTool
+
+Talks to the adb server on localhost:5037 directly instead of spawning
+adb.exe per device. Every request is a 4-hex-digit length plus text; the
+server answers OKAY or FAIL. Host requests (host:devices-l) return a
+length-prefixed payload, device requests are routed with
+host:transport:<serial> first and then stream until the server closes the
+connection.
+
+Batch helpers fan one request out over many serials on a thread pool, so
+a rack of phones is moved into fastboot with one click.
+"""
+import os
+import re
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5037
+DEFAULT_TIMEOUT = 10
+MAX_WORKERS = 16
+# Serials in this state accept shell and reboot requests
+STATE_DEVICE = "device"
+
+PROPERTY_LINE = re.compile(r"^\[(.+?)\]: \[(.*)\]$")
+
+
+class AdbError(Exception):
+    pass
+
+
+class AdbDevice:
+    """One line of host:devices-l"""
+
+    def __init__(self, serial, state, details=None):
+        self.serial = serial
+        self.state = state
+        # product, model, device, transport_id, usb
+        self.details = details or {}
+
+    def __repr__(self):
+        return f"AdbDevice({self.serial!r}, {self.state!r})"
+
+    @property
+    def model(self):
+        return self.details.get("model")
+
+    @property
+    def ready(self):
+        return self.state == STATE_DEVICE
+
+
+def parse_devices(text):
+    """AdbDevice list from the payload of host:devices-l"""
+    devices = []
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        details = {}
+        for field in fields[2:]:
+            key, sep, value = field.partition(":")
+            if sep:
+                details[key] = value
+        devices.append(AdbDevice(fields[0], fields[1], details))
+    return devices
+
+
+def parse_getprop(text):
+    """{name: value} from the "[name]: [value]" output of getprop"""
+    properties = {}
+    for line in text.splitlines():
+        match = PROPERTY_LINE.match(line.strip())
+        if match:
+            properties[match.group(1)] = match.group(2)
+    return properties
+
+
+def server_address():
+    """Address of the adb server, honouring ADB_SERVER_SOCKET=tcp:host:port"""
+    value = os.environ.get("ADB_SERVER_SOCKET", "")
+    if value.startswith("tcp:"):
+        host, _, port = value[4:].rpartition(":")
+        try:
+            return host or DEFAULT_HOST, int(port)
+        except ValueError:
+            pass
+    return DEFAULT_HOST, DEFAULT_PORT
+
+
+class AdbClient:
+    """One short-lived server connection per request"""
+
+    def __init__(self, host=None, port=None, timeout=DEFAULT_TIMEOUT):
+        default_host, default_port = server_address()
+        self.host = host or default_host
+        self.port = port or default_port
+        self.timeout = timeout
+
+    def _connect(self):
+        try:
+            return socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as e:
+            raise AdbError(f"adb-сервер недоступен на {self.host}:{self.port}: {e}") from e
+
+    @staticmethod
+    def _recv_exact(sock, length):
+        data = bytearray()
+        while len(data) < length:
+            try:
+                chunk = sock.recv(length - len(data))
+            except socket.timeout as e:
+                raise AdbError("нет ответа от adb-сервера") from e
+            except OSError as e:
+                raise AdbError(f"обрыв соединения с adb-сервером: {e}") from e
+            if not chunk:
+                raise AdbError("adb-сервер закрыл соединение")
+            data.extend(chunk)
+        return bytes(data)
+
+    @staticmethod
+    def _recv_all(sock):
+        data = bytearray()
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return bytes(data)
+            data.extend(chunk)
+
+    def _read_block(self, sock):
+        header = self._recv_exact(sock, 4)
+        try:
+            length = int(header, 16)
+        except ValueError as e:
+            raise AdbError(f"неверная длина блока {header!r}") from e
+        return self._recv_exact(sock, length)
+
+    def _request(self, sock, request):
+        data = request.encode("utf-8")
+        try:
+            sock.sendall(b"%04x" % len(data) + data)
+        except OSError as e:
+            raise AdbError(f"{request}: обрыв соединения с adb-сервером: {e}") from e
+        status = self._recv_exact(sock, 4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            message = self._read_block(sock).decode("utf-8", "replace")
+            raise AdbError(f"{request}: {message}")
+        raise AdbError(f"{request}: неожиданный ответ {status!r}")
+
+    def host_request(self, request):
+        """Payload of a host:* request"""
+        sock = self._connect()
+        try:
+            self._request(sock, request)
+            return self._read_block(sock).decode("utf-8", "replace")
+        finally:
+            sock.close()
+
+    def version(self):
+        return int(self.host_request("host:version"), 16)
+
+    def devices(self):
+        return parse_devices(self.host_request("host:devices-l"))
+
+    def _open_device(self, serial, request):
+        """Socket routed to serial with request already accepted"""
+        sock = self._connect()
+        try:
+            self._request(sock, f"host:transport:{serial}")
+            self._request(sock, request)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def shell(self, serial, command):
+        """Output of a shell command (stdout and stderr mixed, as adb shell)"""
+        sock = self._open_device(serial, f"shell:{command}")
+        try:
+            return self._recv_all(sock).decode("utf-8", "replace")
+        except socket.timeout as e:
+            raise AdbError(f"{serial}: нет ответа на shell:{command}") from e
+        except OSError as e:
+            raise AdbError(f"{serial}: обрыв соединения на shell:{command}: {e}") from e
+        finally:
+            sock.close()
+
+    def getprop(self, serial, name=None):
+        """One property value, or {name: value} of all of them"""
+        if name is not None:
+            return self.shell(serial, f"getprop {name}").strip()
+        return parse_getprop(self.shell(serial, "getprop"))
+
+    def reboot(self, serial, target="bootloader"):
+        """Request a reboot; the device drops off adb right after OKAY"""
+        sock = self._open_device(serial, f"reboot:{target}")
+        try:
+            self._recv_all(sock)
+        except OSError:
+            # The connection dies with the device, that is the expected end
+            pass
+        finally:
+            sock.close()
+
+
+def fan_out(function, serials, max_workers=MAX_WORKERS):
+    """{serial: result or AdbError} of function(serial) over all serials at once
+
+    Any failure stays with its serial, one device never aborts the batch.
+    """
+    serials = list(serials)
+    if not serials:
+        return {}
+
+    def call(serial):
+        try:
+            return function(serial)
+        except AdbError as e:
+            return e
+        except Exception as e:
+            return AdbError(f"{serial}: {e}")
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(serials)),
+                            thread_name_prefix="adb") as executor:
+        return dict(zip(serials, executor.map(call, serials)))
+
+
+def ready_serials(client):
+    return [device.serial for device in client.devices() if device.ready]
+
+
+def getprop_all(client, name=None, serials=None):
+    """getprop on every ready device (or the given serials)"""
+    if serials is None:
+        serials = ready_serials(client)
+    return fan_out(lambda serial: client.getprop(serial, name), serials)
+
+
+def reboot_all(client, target="bootloader", serials=None, monitor=None, timeout=60):
+    """Reboot every ready device; {serial: None or error}
+
+    With a device_monitor.DeviceMonitor the call also waits until each
+    rebooted serial shows up in fastboot and reports the ones that did not.
+    """
+    if serials is None:
+        serials = ready_serials(client)
+    results = fan_out(lambda serial: client.reboot(serial, target), serials)
+    if monitor is not None and target == "bootloader":
+        def wait(serial):
+            if monitor.wait_for(serial, timeout=timeout) is None:
+                raise AdbError(f"{serial}: не появилось в fastboot за {timeout} с")
+        waited = fan_out(wait, [serial for serial, error in results.items() if error is None])
+        results.update(waited)
+    return results
+
+
+def main():
+    """Command line: adb_client.py devices | getprop [NAME] | reboot-bootloader"""
+    if len(sys.argv) < 2:
+        print(main.__doc__)
+        return 1
+    client = AdbClient()
+    command = sys.argv[1]
+    try:
+        if command == "devices":
+            for device in client.devices():
+                print(f"{device.serial}\t{device.state}\t{device.model or ''}")
+            return 0
+        if command == "getprop":
+            name = sys.argv[2] if len(sys.argv) > 2 else "ro.product.model"
+            results = getprop_all(client, name)
+        elif command == "reboot-bootloader":
+            results = reboot_all(client)
+        else:
+            print(main.__doc__)
+            return 1
+    except AdbError as e:
+        print(f"Ошибка: {e}")
+        return 1
+    failed = 0
+    for serial, result in sorted(results.items()):
+        if isinstance(result, AdbError):
+            failed += 1
+            print(f"{serial}\tошибка: {result}")
+        else:
+            print(f"{serial}\t{result if result is not None else 'OK'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""
+Blank filesystem image cache for ProshivkaTool
+
+Formatting userdata, metadata or cache produces the same sparse image for
+every phone of a model: same filesystem, same partition size, same
+profile. Generated images are kept on disk keyed by (filesystem type,
+partition size, profile, casefold) and flashed from there, so back-to-back
+flashes of identical units never format on the host again. The profile is
+a digest of the mke2fs.conf contents for ext4 and of the feature set for
+F2FS, plus a builder version, so editing the profile or upgrading a
+builder produces new entries instead of reusing stale ones.
+
+Images are written under a temporary name and renamed into place, the
+index the same way. A size quota evicts the images used least recently.
+warm_up() regenerates every indexed entry that is missing or outdated
+(run at station start), so even the first phone of a shift is flashed
+from the cache. Units flashed from one cached image share its filesystem
+UUID, as with a factory userdata image.
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import ext4_image
+import f2fs_image
+
+CACHE_FORMAT = 1
+# Bumped whenever a builder changes its output
+BUILDER_VERSIONS = {"ext4": 1, "f2fs": 1}
+# Blank images are small (a 110 GB userdata is well under 1 MB), the quota
+# only matters for stations that see many partition sizes
+DEFAULT_QUOTA = 256 * 1024 * 1024
+
+ImageKey = namedtuple("ImageKey", "fs_type size profile casefold")
+
+
+def image_name(key):
+    """File name of a cached image"""
+    suffix = "-casefold" if key.casefold else ""
+    return f"{key.fs_type}-{key.size}-{key.profile}{suffix}.img"
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class BlankImageCache:
+    """Sparse blank filesystem images keyed by ImageKey, with LRU eviction"""
+
+    def __init__(self, cache_dir, quota=DEFAULT_QUOTA, conf_path=ext4_image.DEFAULT_CONF):
+        self.cache_dir = cache_dir
+        self.quota = quota
+        self.conf_path = conf_path
+        self.index_path = os.path.join(cache_dir, "index.json")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # One build per key at a time; parallel flashes of one model wait for it
+        self.build_locks = {}
+        # image name -> {"fs_type", "size", "profile", "casefold", "bytes", "last_used"}
+        self.index = {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("format") == CACHE_FORMAT:
+                self.index = data.get("images", {})
+        except (OSError, ValueError):
+            pass
+
+    def _save_index(self):
+        _write_json(self.index_path, {"format": CACHE_FORMAT, "images": self.index})
+
+    def profile(self, fs_type, features=None):
+        """Digest of everything besides size and casefold that shapes the image"""
+        digest = hashlib.sha256(f"{fs_type}:{BUILDER_VERSIONS.get(fs_type)}".encode())
+        if fs_type == "ext4":
+            with open(self.conf_path, "rb") as f:
+                digest.update(f.read())
+        elif fs_type == "f2fs":
+            digest.update(",".join(sorted(features or f2fs_image.ANDROID_FEATURES)).encode())
+        else:
+            raise ValueError(f"Нет генератора образов для {fs_type}")
+        return digest.hexdigest()[:16]
+
+    def key(self, fs_type, size, casefold=False):
+        # casefold is an F2FS feature, the ext4 profile has no such switch
+        casefold = bool(casefold) and fs_type == "f2fs"
+        return ImageKey(fs_type, int(size), self.profile(fs_type), casefold)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, image_name(key))
+
+    def get(self, fs_type, size, casefold=False):
+        """Path of a cached image marked as used, or None"""
+        key = self.key(fs_type, size, casefold)
+        path = self.path(key)
+        with self.lock:
+            entry = self.index.get(image_name(key))
+            if entry is None or not os.path.exists(path):
+                return None
+            entry["last_used"] = time.time()
+            self._save_index()
+        return path
+
+    def _build(self, key):
+        if key.fs_type == "f2fs":
+            builder = f2fs_image.make_builder(key.size, casefold=key.casefold)
+        else:
+            builder = ext4_image.make_builder(key.size, conf_path=self.conf_path)
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            written = builder.write(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self.lock:
+            self.index[image_name(key)] = {"fs_type": key.fs_type, "size": key.size,
+                                           "profile": key.profile, "casefold": key.casefold,
+                                           "bytes": written, "last_used": time.time()}
+            self._save_index()
+        return path
+
+    def get_or_build(self, fs_type, size, casefold=False):
+        """Path of the blank image, generated on first use"""
+        key = self.key(fs_type, size, casefold)
+        with self.lock:
+            build_lock = self.build_locks.setdefault(key, threading.Lock())
+        with build_lock:
+            path = self.get(fs_type, size, casefold)
+            if path is None:
+                path = self._build(key)
+                self.enforce_quota(keep=image_name(key))
+        return path
+
+    def warm_up(self, specs=(), progress=None):
+        """Generate what is missing before the first device arrives
+
+        specs are extra (fs_type, size, casefold) tuples; every image already
+        in the index is checked as well and rebuilt when its file is gone or
+        its profile changed. Returns {spec: path or error}.
+        """
+        with self.lock:
+            known = [(entry["fs_type"], entry["size"], entry["casefold"])
+                     for entry in self.index.values()]
+        wanted = []
+        for spec in list(known) + [tuple(spec) for spec in specs]:
+            if spec not in wanted:
+                wanted.append(spec)
+        results = {}
+        stale = []
+        for number, spec in enumerate(wanted, 1):
+            try:
+                key = self.key(*spec)
+                results[spec] = self.get_or_build(*spec)
+            except (OSError, ValueError, ext4_image.Ext4Error, f2fs_image.F2fsError) as e:
+                results[spec] = e
+            else:
+                with self.lock:
+                    stale += [name for name, entry in self.index.items()
+                              if (entry["fs_type"], entry["size"], entry["casefold"]) == spec
+                              and entry["profile"] != key.profile]
+            if progress:
+                progress(number, len(wanted))
+        for name in stale:
+            self._remove(name)
+        return results
+
+    def _remove(self, name):
+        with self.lock:
+            self.index.pop(name, None)
+            self._save_index()
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except FileNotFoundError:
+            pass
+
+    def total_size(self):
+        with self.lock:
+            return sum(entry["bytes"] for entry in self.index.values())
+
+    def enforce_quota(self, quota=None, keep=None):
+        """Evict least recently used images until the cache fits the quota"""
+        quota = quota if quota is not None else self.quota
+        if quota is None:
+            return []
+        with self.lock:
+            used = sum(entry["bytes"] for entry in self.index.values())
+            victims = []
+            for name, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+                if used <= quota:
+                    break
+                if name == keep:
+                    continue
+                victims.append(name)
+                used -= entry["bytes"]
+        for name in victims:
+            self._remove(name)
+        return victims
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_cache(cache_dir):
+    """One BlankImageCache per directory for the whole process
+
+    Scheduler workers flashing identical phones then wait for a single
+    build instead of formatting the same image in parallel.
+    """
+    cache_dir = os.path.abspath(cache_dir)
+    with _shared_lock:
+        if cache_dir not in _shared:
+            _shared[cache_dir] = BlankImageCache(cache_dir)
+        return _shared[cache_dir]
+
+
+def parse_spec(text):
+    """(fs_type, size, casefold) from "f2fs:110G:casefold" or "ext4:0x4000000" """
+    parts = text.split(":")
+    if len(parts) not in (2, 3) or (len(parts) == 3 and parts[2] != "casefold"):
+        raise ValueError(f"Неверное описание образа: {text}")
+    return parts[0], ext4_image.parse_size(parts[1]), len(parts) == 3
+
+
+def main():
+    """Command line: blank_image_cache.py CACHE_DIR warm [FS:SIZE[:casefold] ...] | list
+
+    warm generates the given images plus every missing or outdated one
+    already in the index, e.g. warm f2fs:110G:casefold ext4:64M.
+    """
+    if len(sys.argv) < 3:
+        print(main.__doc__)
+        return 1
+    cache = BlankImageCache(sys.argv[1])
+    command = sys.argv[2]
+    if command == "warm":
+        try:
+            specs = [parse_spec(text) for text in sys.argv[3:]]
+        except (ValueError, ext4_image.Ext4Error) as e:
+            print(f"Ошибка: {e}")
+            return 1
+        started = time.monotonic()
+        results = cache.warm_up(specs)
+        failed = 0
+        for (fs_type, size, casefold), result in results.items():
+            name = f"{fs_type} {size / 1024 ** 2:.0f} МБ{' casefold' if casefold else ''}"
+            if isinstance(result, Exception):
+                failed += 1
+                print(f"{name}\tошибка: {result}")
+            else:
+                print(f"{name}\t{os.path.basename(result)}")
+        print(f"Готово за {time.monotonic() - started:.2f} с")
+        return 1 if failed else 0
+    if command == "list":
+        for name, entry in sorted(cache.index.items(), key=lambda item: -item[1]["last_used"]):
+            print(f"{name}\t{entry['bytes'] / 1024:.0f} КБ")
+        print(f"Занято: {cache.total_size() / 1024 ** 2:.1f} МБ")
+        return 0
+    print(main.__doc__)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,343 @@
+"""
+Android boot.img / vendor_boot.img (header v3/v4) support for ProshivkaTool
+
+Images are mapped with mmap and sections are handed out as memoryview
+slices, nothing is read until it is used. Repacking writes the sections
+that were not replaced straight from the mapping of the original image.
+"""
+import mmap
+import os
+import struct
+
+BOOT_MAGIC = b"ANDROID!"
+VENDOR_BOOT_MAGIC = b"VNDRBOOT"
+BOOT_PAGE_SIZE = 4096
+AVB_FOOTER_MAGIC = b"AVBf"
+AVB_FOOTER_SIZE = 64
+# magic, version major/minor, original_image_size, vbmeta_offset,
+# vbmeta_size, reserved
+AVB_FOOTER = struct.Struct(">4sIIQQQ28s")
+
+# magic, kernel_size, ramdisk_size, os_version, header_size, reserved[4],
+# header_version, cmdline[1536]
+BOOT_HEADER_V3 = struct.Struct("<8sIIII16sI1536s")
+BOOT_HEADER_V4 = struct.Struct("<8sIIII16sI1536sI")
+
+# magic, header_version, page_size, kernel_addr, ramdisk_addr,
+# vendor_ramdisk_size, cmdline[2048], tags_addr, name[16], header_size,
+# dtb_size, dtb_addr
+VENDOR_HEADER_V3 = struct.Struct("<8sIIIII2048sI16sIIQ")
+# + vendor_ramdisk_table_size, entry_num, entry_size, bootconfig_size
+VENDOR_HEADER_V4 = struct.Struct("<8sIIIII2048sI16sIIQIIII")
+
+# ramdisk_size, ramdisk_offset, ramdisk_type, ramdisk_name[32], board_id[16]
+RAMDISK_ENTRY = struct.Struct("<III32s64s")
+
+RAMDISK_TYPE_NONE = 0
+RAMDISK_TYPE_PLATFORM = 1
+RAMDISK_TYPE_RECOVERY = 2
+RAMDISK_TYPE_DLKM = 3
+
+
+class BootImageError(Exception):
+    """Not a supported boot or vendor_boot image"""
+
+
+def _pages(size, page_size):
+    return (size + page_size - 1) // page_size * page_size
+
+
+def _c_string(raw):
+    return raw.split(b"\0", 1)[0].decode("utf-8", errors="replace")
+
+
+class _MappedImage:
+    """Read-only mapping shared by boot and vendor_boot images"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size < BOOT_PAGE_SIZE:
+            self.file.close()
+            raise BootImageError(f"Файл слишком мал для образа boot: {path}")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Sections are still referenced by the caller
+            pass
+        self.file.close()
+
+    def _section(self, offset, size):
+        if offset + size > self.size:
+            raise BootImageError("Образ обрезан")
+        return self.view[offset:offset + size]
+
+    @property
+    def avb_footer(self):
+        """Raw AVB footer if the image was padded to partition size"""
+        footer = self.view[self.size - AVB_FOOTER_SIZE:]
+        if footer[:4] == AVB_FOOTER_MAGIC:
+            return bytes(footer)
+        return None
+
+    def _finish(self, out, pad_to, keep_avb):
+        """Pad the written image and optionally carry the AVB footer over
+
+        The vbmeta blob is moved right after the new content and the footer
+        is updated the way magiskboot does it. Its hash descriptor still
+        describes the stock image, which an unlocked bootloader accepts.
+        """
+        end = out.tell()
+        footer = self.avb_footer if keep_avb else None
+        if footer:
+            magic, major, minor, _, vbmeta_offset, vbmeta_size, reserved = AVB_FOOTER.unpack(footer)
+            pad_to = pad_to or self.size
+            new_offset = _pages(end, BOOT_PAGE_SIZE)
+            if new_offset + vbmeta_size + AVB_FOOTER_SIZE > pad_to:
+                raise BootImageError(f"Образ не помещается в раздел: {new_offset + vbmeta_size} > {pad_to}")
+            out.write(bytes(new_offset - end))
+            out.write(self._section(vbmeta_offset, vbmeta_size))
+            out.truncate(pad_to)
+            out.seek(pad_to - AVB_FOOTER_SIZE)
+            out.write(AVB_FOOTER.pack(magic, major, minor, end, new_offset, vbmeta_size, reserved))
+        elif pad_to:
+            if end > pad_to:
+                raise BootImageError(f"Образ не помещается в раздел: {end} > {pad_to}")
+            out.truncate(pad_to)
+
+    @staticmethod
+    def _write_section(out, data, page_size):
+        out.write(data)
+        padding = _pages(len(data), page_size) - len(data)
+        if padding:
+            out.write(bytes(padding))
+
+
+class BootImage(_MappedImage):
+    """boot.img / init_boot.img with header version 3 or 4"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        if bytes(self.view[:8]) != BOOT_MAGIC:
+            self.close()
+            raise BootImageError(f"Нет сигнатуры ANDROID!: {path}")
+        self.header_version = struct.unpack_from("<I", self.view, 40)[0]
+        if self.header_version not in (3, 4):
+            self.close()
+            raise BootImageError(f"Поддерживаются заголовки v3/v4, а не v{self.header_version}")
+        header = (BOOT_HEADER_V4 if self.header_version == 4 else BOOT_HEADER_V3).unpack_from(self.view)
+        (_, self.kernel_size, self.ramdisk_size, self.os_version,
+         self.header_size, _, _, cmdline) = header[:8]
+        self.cmdline = _c_string(cmdline)
+        self.signature_size = header[8] if self.header_version == 4 else 0
+        self.page_size = BOOT_PAGE_SIZE
+
+    @property
+    def kernel_offset(self):
+        return BOOT_PAGE_SIZE
+
+    @property
+    def ramdisk_offset(self):
+        return self.kernel_offset + _pages(self.kernel_size, BOOT_PAGE_SIZE)
+
+    @property
+    def signature_offset(self):
+        return self.ramdisk_offset + _pages(self.ramdisk_size, BOOT_PAGE_SIZE)
+
+    @property
+    def kernel(self):
+        return self._section(self.kernel_offset, self.kernel_size)
+
+    @property
+    def ramdisk(self):
+        return self._section(self.ramdisk_offset, self.ramdisk_size)
+
+    @property
+    def signature(self):
+        return self._section(self.signature_offset, self.signature_size)
+
+    @property
+    def os_version_string(self):
+        """Android version and patch level packed in os_version"""
+        version = self.os_version >> 11
+        level = self.os_version & 0x7FF
+        a, b, c = version >> 14, (version >> 7) & 0x7F, version & 0x7F
+        return f"{a}.{b}.{c} {2000 + (level >> 4)}-{level & 0xF:02d}"
+
+    def repack(self, out_path, kernel=None, ramdisk=None, cmdline=None, pad_to=None,
+               keep_avb=False):
+        """Write a new image, replacing only the given sections
+
+        The boot signature of a v4 image no longer matches a changed kernel
+        or ramdisk and is dropped in that case. pad_to pads the output, e.g.
+        to the partition size; keep_avb moves the AVB footer and vbmeta
+        blob of the stock image into the new one (they are not re-signed).
+        """
+        changed = kernel is not None or ramdisk is not None
+        kernel = self.kernel if kernel is None else kernel
+        ramdisk = self.ramdisk if ramdisk is None else ramdisk
+        signature = b"" if changed else self.signature
+        cmdline = self.cmdline if cmdline is None else cmdline
+        encoded_cmdline = cmdline.encode()
+        if len(encoded_cmdline) >= 1536:
+            raise BootImageError("Слишком длинная командная строка ядра")
+
+        fields = [BOOT_MAGIC, len(kernel), len(ramdisk), self.os_version,
+                  self.header_size, bytes(16), self.header_version, encoded_cmdline]
+        if self.header_version == 4:
+            header = BOOT_HEADER_V4.pack(*fields, len(signature))
+        else:
+            header = BOOT_HEADER_V3.pack(*fields)
+
+        with open(out_path, "wb") as out:
+            self._write_section(out, header, BOOT_PAGE_SIZE)
+            self._write_section(out, kernel, BOOT_PAGE_SIZE)
+            self._write_section(out, ramdisk, BOOT_PAGE_SIZE)
+            if signature:
+                self._write_section(out, signature, BOOT_PAGE_SIZE)
+            self._finish(out, pad_to, keep_avb)
+
+
+class VendorRamdisk:
+    """Entry of the v4 vendor ramdisk table"""
+
+    def __init__(self, name, ramdisk_type, data, board_id=bytes(64)):
+        self.name = name
+        self.type = ramdisk_type
+        self.data = data
+        self.board_id = board_id
+
+
+class VendorBootImage(_MappedImage):
+    """vendor_boot.img with header version 3 or 4"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        if bytes(self.view[:8]) != VENDOR_BOOT_MAGIC:
+            self.close()
+            raise BootImageError(f"Нет сигнатуры VNDRBOOT: {path}")
+        self.header_version = struct.unpack_from("<I", self.view, 8)[0]
+        if self.header_version not in (3, 4):
+            self.close()
+            raise BootImageError(f"Поддерживаются заголовки v3/v4, а не v{self.header_version}")
+        header = (VENDOR_HEADER_V4 if self.header_version == 4 else VENDOR_HEADER_V3).unpack_from(self.view)
+        (_, _, self.page_size, self.kernel_addr, self.ramdisk_addr,
+         self.vendor_ramdisk_size, cmdline, self.tags_addr, name,
+         self.header_size, self.dtb_size, self.dtb_addr) = header[:12]
+        self.cmdline = _c_string(cmdline)
+        self.name = _c_string(name)
+        if self.header_version == 4:
+            (self.table_size, self.table_entry_count,
+             self.table_entry_size, self.bootconfig_size) = header[12:16]
+        else:
+            self.table_size = self.table_entry_count = self.table_entry_size = 0
+            self.bootconfig_size = 0
+
+    @property
+    def ramdisk_offset(self):
+        return _pages(self.header_size, self.page_size)
+
+    @property
+    def dtb_offset(self):
+        return self.ramdisk_offset + _pages(self.vendor_ramdisk_size, self.page_size)
+
+    @property
+    def table_offset(self):
+        return self.dtb_offset + _pages(self.dtb_size, self.page_size)
+
+    @property
+    def bootconfig_offset(self):
+        return self.table_offset + _pages(self.table_size, self.page_size)
+
+    @property
+    def vendor_ramdisk(self):
+        """All vendor ramdisks concatenated"""
+        return self._section(self.ramdisk_offset, self.vendor_ramdisk_size)
+
+    @property
+    def dtb(self):
+        return self._section(self.dtb_offset, self.dtb_size)
+
+    @property
+    def bootconfig(self):
+        return self._section(self.bootconfig_offset, self.bootconfig_size)
+
+    def ramdisks(self):
+        """Ramdisk table entries, each with a lazy memoryview of its data"""
+        if self.header_version < 4:
+            return [VendorRamdisk("", RAMDISK_TYPE_PLATFORM, self.vendor_ramdisk)]
+        entries = []
+        table = self._section(self.table_offset, self.table_size)
+        for index in range(self.table_entry_count):
+            size, offset, ramdisk_type, name, board_id = RAMDISK_ENTRY.unpack_from(
+                table, index * self.table_entry_size)
+            data = self._section(self.ramdisk_offset + offset, size)
+            entries.append(VendorRamdisk(_c_string(name), ramdisk_type, data, board_id))
+        return entries
+
+    def repack(self, out_path, ramdisks=None, dtb=None, bootconfig=None, cmdline=None, pad_to=None,
+               keep_avb=False):
+        """Write a new image, replacing only the given sections
+
+        ramdisks is a list of VendorRamdisk; unchanged entries keep their
+        memoryview into this image and are copied without decoding.
+        """
+        ramdisks = self.ramdisks() if ramdisks is None else ramdisks
+        dtb = self.dtb if dtb is None else dtb
+        bootconfig = self.bootconfig if bootconfig is None else bootconfig
+        cmdline = self.cmdline if cmdline is None else cmdline
+        encoded_cmdline = cmdline.encode()
+        if len(encoded_cmdline) >= 2048:
+            raise BootImageError("Слишком длинная командная строка ядра")
+        if self.header_version < 4 and len(ramdisks) != 1:
+            raise BootImageError("vendor_boot v3 содержит ровно один ramdisk")
+
+        table = bytearray()
+        offset = 0
+        for ramdisk in ramdisks:
+            table += RAMDISK_ENTRY.pack(len(ramdisk.data), offset, ramdisk.type,
+                                        ramdisk.name.encode()[:31], ramdisk.board_id)
+            offset += len(ramdisk.data)
+
+        fields = [VENDOR_BOOT_MAGIC, self.header_version, self.page_size, self.kernel_addr,
+                  self.ramdisk_addr, offset, encoded_cmdline, self.tags_addr,
+                  self.name.encode()[:15], self.header_size, len(dtb), self.dtb_addr]
+        if self.header_version == 4:
+            header = VENDOR_HEADER_V4.pack(*fields, len(table), len(ramdisks),
+                                           RAMDISK_ENTRY.size, len(bootconfig))
+        else:
+            header = VENDOR_HEADER_V3.pack(*fields)
+
+        with open(out_path, "wb") as out:
+            self._write_section(out, header, self.page_size)
+            for ramdisk in ramdisks:
+                out.write(ramdisk.data)
+            padding = _pages(offset, self.page_size) - offset
+            out.write(bytes(padding))
+            self._write_section(out, dtb, self.page_size)
+            if self.header_version == 4:
+                self._write_section(out, table, self.page_size)
+                if len(bootconfig):
+                    self._write_section(out, bootconfig, self.page_size)
+            self._finish(out, pad_to, keep_avb)
+
+
+def open_image(path):
+    """BootImage or VendorBootImage depending on the magic"""
+    with open(path, "rb") as f:
+        magic = f.read(8)
+    if magic == VENDOR_BOOT_MAGIC:
+        return VendorBootImage(path)
+    return BootImage(path)
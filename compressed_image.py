@@ -0,0 +1,470 @@
+"""
+Compressed firmware images (.img.xz / .zst / .lz4 / .gz) for ProshivkaTool
+
+Images may be kept compressed in the firmware tree; the flash path reads
+them through DecompressedReader, which decompresses ahead of the transfer
+on background threads. Formats made of independent blocks (multi-block
+xz from `xz -T`, lz4 frames with independent blocks) are decompressed
+block-parallel on a thread pool; the others run on one thread that fills
+a ring of preallocated buffers with readinto. Either way decompression
+overlaps with the USB/TCP transfer.
+
+gzip and lz4 frames without a content size do not record how big the
+image is; such images are flashed without a known total (a sparse image
+is described by its own header) instead of being decompressed twice.
+"""
+import gzip
+import lzma
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import sparse_image
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+try:
+    import lz4.block
+    import lz4.frame
+    LZ4_AVAILABLE = True
+except ImportError:
+    LZ4_AVAILABLE = False
+
+FORMAT_XZ = "xz"
+FORMAT_ZSTD = "zstd"
+FORMAT_LZ4 = "lz4"
+FORMAT_GZIP = "gzip"
+COMPRESSED_EXTENSIONS = {".xz": FORMAT_XZ, ".zst": FORMAT_ZSTD, ".lz4": FORMAT_LZ4, ".gz": FORMAT_GZIP}
+
+RING_BUFFERS = 4
+RING_BUFFER_SIZE = 8 * 1024 * 1024
+# Small lz4 blocks are decompressed in groups of about this many bytes
+PARALLEL_SEGMENT_SIZE = 8 * 1024 * 1024
+
+XZ_HEADER_MAGIC = b"\xfd7zXZ\x00"
+XZ_FOOTER_MAGIC = b"YZ"
+LZ4_FRAME_MAGIC = 0x184D2204
+LZ4_BLOCK_SIZES = {4: 64 * 1024, 5: 256 * 1024, 6: 1024 * 1024, 7: 4 * 1024 * 1024}
+
+# (abs path, size, mtime) -> uncompressed size, for formats without it in the header
+_size_cache = {}
+
+
+class CompressedImageError(Exception):
+    """Compressed image is damaged or its format is not supported"""
+
+
+def compression_format(path):
+    """Format by file extension, None for plain images"""
+    return COMPRESSED_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def is_compressed(path):
+    return compression_format(path) is not None
+
+
+def find_image(path):
+    """path itself, or its compressed variant path.xz/.zst/.lz4/.gz if only that exists"""
+    if os.path.exists(path):
+        return path
+    for extension in COMPRESSED_EXTENSIONS:
+        if os.path.exists(path + extension):
+            return path + extension
+    return path
+
+
+def _require(fmt):
+    if fmt == FORMAT_ZSTD and not ZSTD_AVAILABLE:
+        raise CompressedImageError("Для образов .zst установите пакет zstandard")
+    if fmt == FORMAT_LZ4 and not LZ4_AVAILABLE:
+        raise CompressedImageError("Для образов .lz4 установите пакет lz4")
+
+
+def _open_sequential(path, fmt):
+    if fmt == FORMAT_XZ:
+        return lzma.open(path, "rb")
+    if fmt == FORMAT_GZIP:
+        return gzip.open(path, "rb")
+    if fmt == FORMAT_LZ4:
+        return lz4.frame.open(path, "rb")
+    raw = open(path, "rb")
+    return zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+
+
+# --- xz: the index at the end lists every block ---
+
+def _varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def _encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _xz_blocks(f, file_size):
+    """(stream flags, [(offset, unpadded size, uncompressed size)]) of a single-stream xz"""
+    f.seek(0)
+    header = f.read(12)
+    if header[:6] != XZ_HEADER_MAGIC:
+        raise CompressedImageError("Нет сигнатуры xz")
+    f.seek(file_size - 12)
+    footer = f.read(12)
+    if footer[10:] != XZ_FOOTER_MAGIC or footer[8:10] != header[6:8]:
+        # Stream padding or several concatenated streams
+        return header[6:8], None
+    index_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+    index_start = file_size - 12 - index_size
+    f.seek(index_start)
+    index = f.read(index_size)
+    if index[0] != 0:
+        raise CompressedImageError("Повреждён индекс xz")
+    count, offset = _varint(index, 1)
+    blocks = []
+    position = 12
+    for _ in range(count):
+        unpadded, offset = _varint(index, offset)
+        uncompressed, offset = _varint(index, offset)
+        blocks.append((position, unpadded, uncompressed))
+        position += (unpadded + 3) & ~3
+    if position != index_start:
+        return header[6:8], None
+    return header[6:8], blocks
+
+
+def _xz_single_block(flags, block, unpadded, uncompressed):
+    """A complete xz stream holding one block, so lzma can decode it alone"""
+    header = XZ_HEADER_MAGIC + flags + struct.pack("<I", zlib.crc32(flags))
+    index = b"\0" + _encode_varint(1) + _encode_varint(unpadded) + _encode_varint(uncompressed)
+    index += bytes(-len(index) % 4)
+    index += struct.pack("<I", zlib.crc32(index))
+    backward = struct.pack("<I", len(index) // 4 - 1) + flags
+    footer = struct.pack("<I", zlib.crc32(backward)) + backward + XZ_FOOTER_MAGIC
+    return header + block + index + footer
+
+
+def _xz_segments(f, flags, blocks):
+    for offset, unpadded, uncompressed in blocks:
+        f.seek(offset)
+        block = f.read((unpadded + 3) & ~3)
+        yield _decode_xz_block, (flags, block, unpadded, uncompressed)
+
+
+def _decode_xz_block(flags, block, unpadded, uncompressed):
+    return lzma.decompress(_xz_single_block(flags, block, unpadded, uncompressed),
+                           format=lzma.FORMAT_XZ)
+
+
+# --- lz4 frame: independent blocks are decoded in parallel ---
+
+def _lz4_frame_header(f):
+    """(header size, independent blocks, block checksum, block max, content size)"""
+    head = f.read(15)
+    if len(head) < 7 or struct.unpack_from("<I", head)[0] != LZ4_FRAME_MAGIC:
+        raise CompressedImageError("Нет сигнатуры кадра lz4")
+    flg, bd = head[4], head[5]
+    size = 7
+    content_size = None
+    if flg & 0x08:
+        content_size = struct.unpack_from("<Q", head, 6)[0]
+        size += 8
+    if flg & 0x01:
+        size += 4
+    block_max = LZ4_BLOCK_SIZES.get((bd >> 4) & 0x7)
+    if block_max is None:
+        raise CompressedImageError("Неизвестный размер блока lz4")
+    return size, bool(flg & 0x20), bool(flg & 0x10), block_max, content_size
+
+
+def _lz4_segments(f, header_size, block_checksum, block_max):
+    f.seek(header_size)
+    group = []
+    group_bytes = 0
+    while True:
+        raw = f.read(4)
+        if len(raw) < 4:
+            raise CompressedImageError("Кадр lz4 обрезан")
+        block_size = struct.unpack("<I", raw)[0]
+        if block_size == 0:
+            break
+        stored = bool(block_size & 0x80000000)
+        data = f.read(block_size & 0x7FFFFFFF)
+        if block_checksum:
+            f.read(4)
+        group.append((stored, data))
+        group_bytes += block_max
+        if group_bytes >= PARALLEL_SEGMENT_SIZE:
+            yield _decode_lz4_blocks, (group, block_max)
+            group = []
+            group_bytes = 0
+    if group:
+        yield _decode_lz4_blocks, (group, block_max)
+
+
+def _decode_lz4_blocks(group, block_max):
+    return b"".join(data if stored else lz4.block.decompress(data, uncompressed_size=block_max)
+                    for stored, data in group)
+
+
+def _parallel_plan(path, fmt):
+    """(size, segment generator factory) when the image can be decoded block-parallel"""
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if fmt == FORMAT_XZ:
+            flags, blocks = _xz_blocks(f, file_size)
+            if blocks and len(blocks) > 1:
+                return (sum(block[2] for block in blocks),
+                        lambda handle: _xz_segments(handle, flags, blocks))
+            if blocks:
+                return blocks[0][2], None
+        elif fmt == FORMAT_LZ4:
+            header_size, independent, block_checksum, block_max, content_size = _lz4_frame_header(f)
+            if independent:
+                return content_size, lambda handle: _lz4_segments(handle, header_size,
+                                                                  block_checksum, block_max)
+            return content_size, None
+        elif fmt == FORMAT_ZSTD:
+            size = zstandard.frame_content_size(f.read(18))
+            return (size if size >= 0 else None), None
+    return None, None
+
+
+def stored_size(path):
+    """Size after decompression from the xz index or the zstd/lz4 frame header, or None"""
+    fmt = compression_format(path)
+    _require(fmt)
+    size, _ = _parallel_plan(path, fmt)
+    return size
+
+
+def is_sparse(path):
+    """Whether the decompressed image is a sparse image; only its first bytes are decoded"""
+    fmt = compression_format(path)
+    _require(fmt)
+    with _open_sequential(path, fmt) as f:
+        head = f.read(4)
+    return len(head) == 4 and struct.unpack("<I", head)[0] == sparse_image.SPARSE_MAGIC
+
+
+def uncompressed_size(path):
+    """Size of the image after decompression
+
+    Taken from the xz index or the zstd/lz4 frame header when present;
+    otherwise (gzip) the image is decompressed once and the result cached.
+    The flash path only falls back to this for raw images it has nothing
+    else to size by.
+    """
+    size = stored_size(path)
+    if size is not None:
+        return size
+    fmt = compression_format(path)
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _size_cache:
+        total = 0
+        buffer = bytearray(RING_BUFFER_SIZE)
+        with _open_sequential(path, fmt) as f:
+            while True:
+                count = f.readinto(buffer)
+                if not count:
+                    break
+                total += count
+        _size_cache[key] = total
+    return _size_cache[key]
+
+
+class DecompressedReader:
+    """Read-only file object over a compressed image, decompressed ahead
+
+    Decoded data waits in at most `buffers` slots; read() hands it out in
+    order while the next slots are being filled. size is None when the
+    format does not record it and the caller did not pass it.
+    """
+
+    _EOF = object()
+
+    def __init__(self, path, buffers=RING_BUFFERS, buffer_size=RING_BUFFER_SIZE, max_workers=None,
+                 size=None):
+        self.path = path
+        self.format = compression_format(path)
+        if self.format is None:
+            raise CompressedImageError(f"Образ не сжат: {path}")
+        _require(self.format)
+        self.size = size if size is not None else stored_size(path)
+        self.buffers = buffers
+        self.buffer_size = buffer_size
+        self.max_workers = max_workers or os.cpu_count() or 2
+        self.position = 0
+        self._stop = threading.Event()
+        self._current = None
+        self._offset = 0
+        self._eof = False
+        _, segments = _parallel_plan(path, self.format)
+        self.parallel = segments is not None
+        if self.parallel:
+            self._queue = queue.Queue(maxsize=buffers)
+            target, args = self._decode_parallel, (segments,)
+        else:
+            # One buffer more than can wait in the queue: the one being read
+            self._queue = queue.Queue()
+            self._free = queue.Queue()
+            for _ in range(buffers + 1):
+                self._free.put(bytearray(buffer_size))
+            target, args = self._decode_sequential, ()
+        self._thread = threading.Thread(target=self._produce, args=(target, args),
+                                        daemon=True, name="decompress")
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, target, args):
+        try:
+            target(*args)
+            self._put((self._EOF, None))
+        except Exception as e:
+            self._put((e, None))
+
+    def _decode_sequential(self):
+        with _open_sequential(self.path, self.format) as f:
+            while not self._stop.is_set():
+                try:
+                    buffer = self._free.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                count = f.readinto(buffer)
+                if not count:
+                    return
+                if not self._put((memoryview(buffer)[:count], buffer)):
+                    return
+
+    def _decode_parallel(self, segments):
+        with open(self.path, "rb") as f, \
+                ThreadPoolExecutor(max_workers=self.max_workers,
+                                   thread_name_prefix="decompress") as executor:
+            pending = deque()
+            for function, args in segments(f):
+                if self._stop.is_set():
+                    return
+                pending.append(executor.submit(function, *args))
+                # The oldest segment is handed out before more are queued
+                if len(pending) >= self.buffers:
+                    if not self._put((memoryview(pending.popleft().result()), None)):
+                        return
+            while pending:
+                if not self._put((memoryview(pending.popleft().result()), None)):
+                    return
+
+    def _next(self):
+        if self._current is not None:
+            view, buffer = self._current
+            view.release()
+            if buffer is not None:
+                self._free.put(buffer)
+            self._current = None
+        item, buffer = self._queue.get()
+        if item is self._EOF:
+            self._eof = True
+            return False
+        if isinstance(item, Exception):
+            self._eof = True
+            raise CompressedImageError(f"Ошибка распаковки {os.path.basename(self.path)}: {item}")
+        self._current = (item, buffer)
+        self._offset = 0
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            if self.size is None:
+                return b"".join(iter(lambda: self.read(self.buffer_size), b""))
+            size = max(self.size - self.position, 0)
+        parts = []
+        while size > 0 and not self._eof:
+            if self._current is None or self._offset >= len(self._current[0]):
+                if not self._next():
+                    break
+            view = self._current[0]
+            take = min(size, len(view) - self._offset)
+            parts.append(bytes(view[self._offset:self._offset + take]))
+            self._offset += take
+            self.position += take
+            size -= take
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        if self._current is not None:
+            self._current[0].release()
+            self._current = None
+
+
+def decompress_file(path, out_path, progress=None):
+    """Write the decompressed image to out_path, progress(done, total, mb_per_s)"""
+    started = time.monotonic()
+    with DecompressedReader(path) as reader, open(out_path, "wb") as out:
+        if reader.size is not None:
+            out.truncate(reader.size)
+        while True:
+            data = reader.read(RING_BUFFER_SIZE)
+            if not data:
+                break
+            out.write(data)
+            if progress:
+                elapsed = time.monotonic() - started
+                progress(reader.position, reader.size or reader.position,
+                         reader.position / elapsed / 1024 ** 2 if elapsed > 0 else 0.0)
+    return reader.position
+
+
+def main():
+    """Command line: compressed_image.py IMAGE.xz|.zst|.lz4|.gz [OUTPUT]"""
+    if len(sys.argv) not in (2, 3):
+        print(main.__doc__)
+        return 1
+    source = sys.argv[1]
+    target = sys.argv[2] if len(sys.argv) == 3 else os.path.splitext(source)[0]
+    started = time.monotonic()
+    size = decompress_file(source, target)
+    elapsed = time.monotonic() - started
+    print(f"{target}: {size / 1024 ** 2:.0f} МБ за {elapsed:.1f} с "
+          f"({size / max(elapsed, 1e-6) / 1024 ** 2:.0f} МБ/с)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,530 @@
+"""
+USB hot-plug monitor for ProshivkaTool
+
+Instead of running `fastboot devices` in a loop, a backend reports devices
+as they appear and disappear on the bus. DeviceMonitor keeps the registry
+of attached phones keyed by serial, remembers which mode each one is in
+(adb, bootloader fastboot or fastbootd) and publishes added / removed /
+mode_changed events to subscribers - the GUI status bar and the flash
+scheduler. Reconnect loops wait on the registry instead of retrying.
+
+Backends:
+    SysfsBackend    - kernel uevents over netlink, attributes from sysfs (Linux)
+    PollingBackend  - pyusb enumeration diff (Windows and everything else)
+    FakeBackend     - plug()/unplug() by hand, for tests
+"""
+import os
+import select
+import socket
+import threading
+import time
+
+import device_probe
+import fastboot_client
+
+# Try to import pyusb, needed only by the polling backend
+try:
+    import usb.core
+    import usb.util
+    PYUSB_AVAILABLE = True
+except ImportError:
+    PYUSB_AVAILABLE = False
+
+MODE_ADB = "adb"
+MODE_FASTBOOT = "fastboot"
+MODE_FASTBOOTD = "fastbootd"
+FASTBOOT_MODES = (MODE_FASTBOOT, MODE_FASTBOOTD)
+
+EVENT_ADDED = "added"
+EVENT_REMOVED = "removed"
+EVENT_MODE_CHANGED = "mode_changed"
+
+# (class, subclass, protocol) of the Android USB interfaces
+ADB_INTERFACE = (0xFF, 0x42, 0x01)
+FASTBOOT_INTERFACE = (fastboot_client.FASTBOOT_CLASS, fastboot_client.FASTBOOT_SUBCLASS,
+                      fastboot_client.FASTBOOT_PROTOCOL)
+
+SYSFS_USB_DEVICES = "/sys/bus/usb/devices"
+NETLINK_KOBJECT_UEVENT = 15
+POLL_INTERVAL = 2.0
+# Interfaces of a fresh device show up in sysfs shortly after its uevent
+SETTLE_RETRIES = 10
+SETTLE_DELAY = 0.1
+
+MODE_NAMES = {MODE_ADB: "adb", MODE_FASTBOOT: "fastboot", MODE_FASTBOOTD: "fastbootd"}
+
+
+_last_error = [None]
+
+
+def _log_error(message):
+    """Print a backend error once, not on every failing poll"""
+    if message != _last_error[0]:
+        _last_error[0] = message
+        print(message)
+
+
+def _mode_for_interfaces(interfaces):
+    """Device mode from its interface triples, None for non-Android devices"""
+    if FASTBOOT_INTERFACE in interfaces:
+        return MODE_FASTBOOT
+    if ADB_INTERFACE in interfaces:
+        return MODE_ADB
+    return None
+
+
+class UsbDevice:
+    """One attached phone as seen on the bus"""
+
+    def __init__(self, serial, mode, location, vendor_id=None, product_id=None):
+        self.serial = serial
+        self.mode = mode
+        self.location = location
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.seen_at = time.time()
+
+    def __repr__(self):
+        return f"UsbDevice({self.serial!r}, {self.mode}, {self.location})"
+
+
+class DeviceEvent:
+    def __init__(self, kind, device, previous_mode=None):
+        self.kind = kind
+        self.device = device
+        self.previous_mode = previous_mode
+
+    def __repr__(self):
+        return f"DeviceEvent({self.kind}, {self.device!r})"
+
+    def describe(self):
+        """Status bar text"""
+        mode = MODE_NAMES.get(self.device.mode, self.device.mode)
+        if self.kind == EVENT_ADDED:
+            return f"Подключено: {self.device.serial} ({mode})"
+        if self.kind == EVENT_REMOVED:
+            return f"Отключено: {self.device.serial}"
+        return f"{self.device.serial}: {MODE_NAMES.get(self.previous_mode, '?')} → {mode}"
+
+
+class SysfsBackend:
+    """Kernel uevents from a NETLINK_KOBJECT_UEVENT socket
+
+    The same events udev listens to, without needing udev itself or any
+    extra package. Device attributes are read from sysfs; a device is
+    reported once its adb or fastboot interface has been created.
+    """
+
+    def __init__(self, root=SYSFS_USB_DEVICES):
+        self.root = root
+        self.sock = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @staticmethod
+    def available():
+        return hasattr(socket, "AF_NETLINK") and os.path.isdir(SYSFS_USB_DEVICES)
+
+    @staticmethod
+    def _read(path, name):
+        try:
+            with open(os.path.join(path, name)) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _interfaces(self, path):
+        name = os.path.basename(path)
+        triples = set()
+        try:
+            entries = os.listdir(path)
+        except OSError:
+            return triples
+        for entry in entries:
+            # Interface directories are named "<device>:<config>.<number>"
+            if not entry.startswith(name + ":"):
+                continue
+            values = [self._read(os.path.join(path, entry), attribute)
+                      for attribute in ("bInterfaceClass", "bInterfaceSubClass", "bInterfaceProtocol")]
+            try:
+                triples.add(tuple(int(value, 16) for value in values))
+            except (TypeError, ValueError):
+                continue
+        return triples
+
+    def read_device(self, path):
+        """UsbDevice for a sysfs device directory, None if it is not a phone"""
+        mode = _mode_for_interfaces(self._interfaces(path))
+        serial = self._read(path, "serial")
+        if mode is None or not serial:
+            return None
+        bus, address = self._read(path, "busnum"), self._read(path, "devnum")
+        vendor, product = self._read(path, "idVendor"), self._read(path, "idProduct")
+        try:
+            location = f"usb:{int(bus)}:{int(address)}"
+        except (TypeError, ValueError):
+            return None
+        return UsbDevice(serial, mode, location,
+                         int(vendor, 16) if vendor else None,
+                         int(product, 16) if product else None)
+
+    def scan(self):
+        devices = []
+        try:
+            entries = os.listdir(self.root)
+        except OSError:
+            return devices
+        for entry in entries:
+            if ":" in entry:
+                continue
+            device = self.read_device(os.path.join(self.root, entry))
+            if device:
+                devices.append(device)
+        return devices
+
+    def start(self, added, removed):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        # Port id 0 lets the kernel pick one, group 1 is the kernel uevent group
+        self.sock.bind((0, 1))
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._loop, args=(added, removed), daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _parse(message):
+        """(action, {KEY: value}) of one uevent"""
+        parts = message.split(b"\0")
+        action = parts[0].decode("utf-8", "replace").partition("@")[0]
+        properties = {}
+        for part in parts[1:]:
+            key, sep, value = part.decode("utf-8", "replace").partition("=")
+            if sep:
+                properties[key] = value
+        return action, properties
+
+    def _resync(self, reported, added, removed):
+        """Catch up with the bus after uevents were lost"""
+        current = {device.location: device for device in self.scan()}
+        for location in set(reported) - set(current):
+            removed(location)
+        for device in current.values():
+            added(device)
+
+    def _loop(self, added, removed):
+        # Locations reported so far, to find removals missed with lost uevents
+        reported = {device.location for device in self.scan()}
+
+        def report_added(device):
+            reported.add(device.location)
+            added(device)
+
+        def report_removed(location):
+            reported.discard(location)
+            removed(location)
+
+        while not self.stop_event.is_set():
+            try:
+                readable, _, _ = select.select([self.sock], [], [], 0.5)
+                if not readable:
+                    continue
+                message = self.sock.recv(16384)
+            except (OSError, ValueError) as e:
+                if self.stop_event.is_set():
+                    break
+                # ENOBUFS: the kernel dropped uevents while the queue was full
+                _log_error(f"Device monitor: ошибка netlink, повторное сканирование: {e}")
+                self.stop_event.wait(POLL_INTERVAL)
+                self._resync(reported, report_added, report_removed)
+                continue
+            action, properties = self._parse(message)
+            if properties.get("SUBSYSTEM") != "usb":
+                continue
+            devtype = properties.get("DEVTYPE")
+            if action == "bind" and devtype == "usb_device" or action == "add" and devtype == "usb_interface":
+                path = "/sys" + properties.get("DEVPATH", "")
+                if devtype == "usb_interface":
+                    path = os.path.dirname(path)
+                device = None
+                for _ in range(SETTLE_RETRIES):
+                    device = self.read_device(path)
+                    if device or self.stop_event.wait(SETTLE_DELAY):
+                        break
+                if device:
+                    report_added(device)
+            elif action == "remove" and devtype == "usb_device":
+                try:
+                    # Zero-padded in uevents ("001"), plain in sysfs
+                    location = f"usb:{int(properties['BUSNUM'])}:{int(properties['DEVNUM'])}"
+                except (KeyError, ValueError):
+                    continue
+                report_removed(location)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=2)
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+class PollingBackend:
+    """pyusb enumeration compared every POLL_INTERVAL seconds
+
+    Windows has no uevent socket; enumerating the bus in-process is still
+    far cheaper than spawning fastboot.exe for every check.
+    """
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @staticmethod
+    def available():
+        return PYUSB_AVAILABLE
+
+    def scan(self):
+        if not PYUSB_AVAILABLE:
+            return []
+        devices = []
+        for device in usb.core.find(find_all=True):
+            try:
+                interfaces = {(i.bInterfaceClass, i.bInterfaceSubClass, i.bInterfaceProtocol)
+                              for config in device for i in config}
+            except usb.core.USBError:
+                continue
+            mode = _mode_for_interfaces(interfaces)
+            if mode is None:
+                continue
+            serial = fastboot_client._usb_serial(device)
+            if serial:
+                devices.append(UsbDevice(serial, mode, f"usb:{device.bus}:{device.address}",
+                                         device.idVendor, device.idProduct))
+        return devices
+
+    def start(self, added, removed):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._loop, args=(added, removed), daemon=True)
+        self.thread.start()
+
+    def _scan_or_none(self):
+        """scan(), None when the bus can not be enumerated right now"""
+        try:
+            return {device.location: device for device in self.scan()}
+        except Exception as e:
+            # USBError or NoBackendError: keep polling, the next scan may work
+            _log_error(f"Device monitor: ошибка опроса USB: {e}")
+            return None
+
+    def _loop(self, added, removed):
+        known = self._scan_or_none() or {}
+        while not self.stop_event.wait(self.interval):
+            current = self._scan_or_none()
+            if current is None:
+                continue
+            for location in set(known) - set(current):
+                removed(location)
+            for location in set(current) - set(known):
+                added(current[location])
+            known = current
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=2)
+
+
+class FakeBackend:
+    """Devices plugged and unplugged by the caller"""
+
+    def __init__(self):
+        self.devices = {}
+        self.added = None
+        self.removed = None
+        self.next_address = 1
+
+    def scan(self):
+        return list(self.devices.values())
+
+    def start(self, added, removed):
+        self.added = added
+        self.removed = removed
+
+    def stop(self):
+        self.added = self.removed = None
+
+    def plug(self, serial, mode=MODE_FASTBOOT):
+        """Attach a device; re-plugging gets a new bus address like real hardware"""
+        self.unplug(serial)
+        device = UsbDevice(serial, mode, f"usb:1:{self.next_address}")
+        self.next_address += 1
+        self.devices[serial] = device
+        if self.added:
+            self.added(device)
+        return device
+
+    def unplug(self, serial):
+        device = self.devices.pop(serial, None)
+        if device and self.removed:
+            self.removed(device.location)
+
+
+def default_backend():
+    if SysfsBackend.available():
+        return SysfsBackend()
+    return PollingBackend()
+
+
+class DeviceMonitor:
+    """Registry of attached devices fed by a hot-plug backend
+
+    Subscribers are called from the backend thread with a DeviceEvent;
+    GUI code has to hop back to its own thread (root.after).
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or default_backend()
+        self.condition = threading.Condition()
+        self.devices = {}
+        self.locations = {}
+        # Last mode of every serial seen this session, to report mode changes
+        self.last_modes = {}
+        self.subscribers = []
+        self.running = False
+
+    def subscribe(self, callback):
+        """Register callback(event); returns a function that unsubscribes"""
+        with self.condition:
+            self.subscribers.append(callback)
+
+        def unsubscribe():
+            with self.condition:
+                if callback in self.subscribers:
+                    self.subscribers.remove(callback)
+        return unsubscribe
+
+    def start(self):
+        if self.running:
+            return self
+        self.running = True
+        for device in self.backend.scan():
+            self._added(device)
+        self.backend.start(self._added, self._removed)
+        return self
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.backend.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _publish(self, event):
+        with self.condition:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                # A broken subscriber must not stop hot-plug tracking
+                continue
+
+    def _refine_mode(self, device):
+        """fastbootd and the bootloader share one USB interface, the probe tells them apart"""
+        if device.mode == MODE_FASTBOOT:
+            info = device_probe.cache.get(device.serial, device.location)
+            if info and info.is_userspace:
+                device.mode = MODE_FASTBOOTD
+
+    def _added(self, device):
+        self._refine_mode(device)
+        with self.condition:
+            previous = self.devices.get(device.serial)
+            if previous and previous.location == device.location and previous.mode == device.mode:
+                # Interface and bind uevents of the same device
+                return
+            if previous and previous.location != device.location:
+                self.locations.pop(previous.location, None)
+            self.devices[device.serial] = device
+            self.locations[device.location] = device.serial
+            previous_mode = self.last_modes.get(device.serial)
+            self.last_modes[device.serial] = device.mode
+            self.condition.notify_all()
+        if previous is None or previous.location != device.location:
+            device_probe.cache.invalidate(device.serial)
+        self._publish(DeviceEvent(EVENT_ADDED, device))
+        if previous_mode and previous_mode != device.mode:
+            self._publish(DeviceEvent(EVENT_MODE_CHANGED, device, previous_mode))
+
+    def _removed(self, location):
+        with self.condition:
+            serial = self.locations.pop(location, None)
+            device = self.devices.pop(serial, None) if serial else None
+            self.condition.notify_all()
+        if device:
+            device_probe.cache.invalidate(device.serial)
+            self._publish(DeviceEvent(EVENT_REMOVED, device))
+
+    def refresh_mode(self, serial):
+        """Re-check fastboot vs fastbootd after the device has been probed"""
+        with self.condition:
+            device = self.devices.get(serial)
+        if device is None:
+            return None
+        previous_mode = device.mode
+        self._refine_mode(device)
+        if device.mode != previous_mode:
+            with self.condition:
+                self.last_modes[serial] = device.mode
+                self.condition.notify_all()
+            self._publish(DeviceEvent(EVENT_MODE_CHANGED, device, previous_mode))
+        return device.mode
+
+    def get(self, serial):
+        with self.condition:
+            return self.devices.get(serial)
+
+    def list(self, modes=None):
+        with self.condition:
+            devices = list(self.devices.values())
+        if modes:
+            devices = [device for device in devices if device.mode in modes]
+        return sorted(devices, key=lambda device: device.serial)
+
+    def serials(self, modes=FASTBOOT_MODES):
+        return [device.serial for device in self.list(modes)]
+
+    def wait_for(self, serial, modes=FASTBOOT_MODES, timeout=None, cancel_event=None):
+        """Block until the device is attached in one of modes
+
+        Returns the UsbDevice, or None on timeout or cancellation.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while True:
+                device = self.devices.get(serial)
+                if device and (not modes or device.mode in modes):
+                    return device
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                # Short waits so a cancel_event set elsewhere is noticed
+                self.condition.wait(min(remaining, 0.5) if remaining is not None else 0.5)
+
+    def wait_for_removal(self, serial, timeout=None):
+        """Block until the device leaves the bus; False on timeout"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while serial in self.devices:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
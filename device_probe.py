@@ -0,0 +1,162 @@
+"""
+Device capability probe for ProshivkaTool
+
+One `getvar all` returns every bootloader variable at once. It is parsed
+into a DeviceInfo record and cached per serial, so planning, sparse
+splitting and preflight checks read product, slots, max-download-size and
+partition sizes without further round trips. The record is dropped when
+the device reboots, changes its partition layout or is re-enumerated on
+the bus (a new USB address means a new session).
+"""
+import threading
+import time
+
+# Queried one by one when the bootloader does not implement getvar all
+ESSENTIAL_VARIABLES = ("product", "slot-count", "current-slot", "max-download-size",
+                       "is-userspace", "unlocked", "secure")
+DEFAULT_MAX_DOWNLOAD_SIZE = 512 * 1024 * 1024
+# Variables reported once per partition as "<name>:<partition>:<value>"
+PARTITION_VARIABLES = ("partition-size", "partition-type", "is-logical", "has-slot")
+
+
+def _to_int(value, default=None):
+    try:
+        return int(value.strip(), 0)
+    except (AttributeError, ValueError):
+        return default
+
+
+def _to_bool(value):
+    if value is None:
+        return None
+    return value.strip().lower() in ("yes", "true", "1")
+
+
+def parse_getvar_all(lines):
+    """{variable: value} from the INFO lines of getvar all
+
+    Per-partition variables keep their partition in the key, e.g.
+    "partition-size:boot_a" -> "0x6000000".
+    """
+    variables = {}
+    for line in lines:
+        line = line.strip()
+        if line.startswith("(bootloader)"):
+            line = line[len("(bootloader)"):].strip()
+        if ":" not in line:
+            continue
+        key, value = line.split(":", 1)
+        if key in PARTITION_VARIABLES and ":" in value:
+            partition, value = value.split(":", 1)
+            key = f"{key}:{partition.strip()}"
+        variables[key.strip()] = value.strip()
+    return variables
+
+
+class DeviceInfo:
+    """What the tool needs to know about an attached device"""
+
+    def __init__(self, serial, variables):
+        self.serial = serial
+        self.variables = dict(variables)
+        self.probed_at = time.time()
+        self.product = variables.get("product")
+        self.slot_count = _to_int(variables.get("slot-count"), 0)
+        self.current_slot = variables.get("current-slot") or None
+        self.max_download_size = _to_int(variables.get("max-download-size"), DEFAULT_MAX_DOWNLOAD_SIZE)
+        self.is_userspace = bool(_to_bool(variables.get("is-userspace")))
+        self.unlocked = _to_bool(variables.get("unlocked"))
+        self.secure = _to_bool(variables.get("secure"))
+        self.partition_sizes = {}
+        self.partition_types = {}
+        self.logical_partitions = set()
+        for key, value in variables.items():
+            kind, _, partition = key.partition(":")
+            if not partition:
+                continue
+            if kind == "partition-size":
+                size = _to_int(value)
+                if size is not None:
+                    self.partition_sizes[partition] = size
+            elif kind == "partition-type":
+                self.partition_types[partition] = value
+            elif kind == "is-logical" and _to_bool(value):
+                self.logical_partitions.add(partition)
+
+    def __repr__(self):
+        return (f"DeviceInfo({self.serial!r}, product={self.product!r}, slots={self.slot_count}, "
+                f"current={self.current_slot!r}, userspace={self.is_userspace})")
+
+    @property
+    def has_slots(self):
+        return self.slot_count > 1
+
+    def _resolve(self, partition, table):
+        """Partition name as listed, trying the current slot suffix"""
+        if partition in table:
+            return partition
+        if self.current_slot:
+            slotted = f"{partition}_{self.current_slot.lstrip('_')}"
+            if slotted in table:
+                return slotted
+        return None
+
+    def partition_size(self, partition):
+        name = self._resolve(partition, self.partition_sizes)
+        return self.partition_sizes[name] if name else None
+
+    def partition_type(self, partition):
+        name = self._resolve(partition, self.partition_types)
+        return self.partition_types[name] if name else None
+
+    def is_logical(self, partition):
+        return self._resolve(partition, {name: True for name in self.logical_partitions}) is not None
+
+    def set_current_slot(self, slot):
+        self.current_slot = slot.lstrip("_")
+        self.variables["current-slot"] = self.current_slot
+
+    def describe(self):
+        """Human-readable summary for the GUI"""
+        lines = [f"Серийный номер: {self.serial}",
+                 f"Модель: {self.product or '?'}",
+                 f"Режим: {'fastbootd' if self.is_userspace else 'bootloader'}"]
+        if self.has_slots:
+            lines.append(f"Слоты: {self.slot_count}, активный: {self.current_slot or '?'}")
+        if self.unlocked is not None:
+            lines.append(f"Загрузчик: {'разблокирован' if self.unlocked else 'заблокирован'}")
+        lines.append(f"max-download-size: {self.max_download_size / 1024 ** 2:.0f} МБ")
+        if self.partition_sizes:
+            lines.append(f"Разделов: {len(self.partition_sizes)}")
+        return "\n".join(lines)
+
+
+class ProbeCache:
+    """DeviceInfo per serial, valid for one bus location of the device"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, serial, location=None):
+        with self.lock:
+            entry = self.entries.get(serial)
+        if entry and entry[0] == location:
+            return entry[1]
+        return None
+
+    def put(self, serial, location, info):
+        with self.lock:
+            self.entries[serial] = (location, info)
+
+    def invalidate(self, serial=None):
+        """Forget one device, or all of them"""
+        with self.lock:
+            if serial is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(serial, None)
+
+
+# Shared by every FastbootClient of the process
+cache = ProbeCache()
@@ -0,0 +1,720 @@
+"""
+ext4 image builder for ProshivkaTool
+
+Creates empty ext4 filesystems (userdata, cache) in-process instead of
+running mke2fs.exe. Settings come from the bundled mke2fs.conf the same way
+mke2fs resolves them: [defaults], then the filesystem type (ext4), then the
+usage type picked from the size (small / default / big / huge) or given by
+the caller (largefile ...).
+
+Only metadata is generated: superblock and group descriptor copies,
+bitmaps, the used part of the first inode table, the root and lost+found
+directories and the journal. Everything else is left to the sparse image
+as DONT_CARE (or a zero FILL where stale data would be read back), so a
+blank 100+ GB image is a few MB of sparse file. With uninit_bg, untouched
+groups are flagged uninitialized and the kernel zeroes their inode tables
+lazily after the first mount, as with mke2fs -E lazy_itable_init=1.
+"""
+import os
+import re
+import struct
+import sys
+import time
+import uuid as uuid_module
+
+import sparse_image
+
+DEFAULT_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mke2fs.conf")
+
+EXT4_MAGIC = 0xEF53
+SUPERBLOCK_OFFSET = 1024
+SUPERBLOCK_SIZE = 1024
+GROUP_DESC_SIZE = 32
+GOOD_OLD_INODE_SIZE = 128
+# sizeof(struct ext2_inode_large) - GOOD_OLD_INODE_SIZE
+EXTRA_ISIZE = 32
+FIRST_INODE = 11
+ROOT_INODE = 2
+JOURNAL_INODE = 8
+LOST_FOUND_MIN_SIZE = 16 * 1024
+LOST_FOUND_MAX_BLOCKS = 12
+# mke2fs drops a last group smaller than its metadata plus this
+MIN_LAST_GROUP_DATA = 50
+MAX_EXTENT_LENGTH = 32768
+
+# Feature bits
+COMPAT = {"dir_prealloc": 0x1, "imagic_inodes": 0x2, "has_journal": 0x4, "ext_attr": 0x8,
+          "resize_inode": 0x10, "dir_index": 0x20, "sparse_super2": 0x200}
+INCOMPAT = {"compression": 0x1, "filetype": 0x2, "needs_recovery": 0x4, "journal_dev": 0x8,
+            "meta_bg": 0x10, "extent": 0x40, "64bit": 0x80, "mmp": 0x100, "flex_bg": 0x200,
+            "ea_inode": 0x400, "dirdata": 0x1000, "metadata_csum_seed": 0x2000,
+            "large_dir": 0x4000, "inline_data": 0x8000, "encrypt": 0x10000, "casefold": 0x20000}
+RO_COMPAT = {"sparse_super": 0x1, "large_file": 0x2, "huge_file": 0x8, "uninit_bg": 0x10,
+             "dir_nlink": 0x20, "extra_isize": 0x40, "quota": 0x100, "bigalloc": 0x200,
+             "metadata_csum": 0x400}
+FEATURE_ALIASES = {"extents": "extent", "gdt_csum": "uninit_bg", "uninit_groups": "uninit_bg"}
+# Everything the bundled ext4 profile asks for; the rest is refused, not half-done
+SUPPORTED_FEATURES = {"sparse_super", "large_file", "filetype", "dir_index", "ext_attr",
+                      "has_journal", "extent", "huge_file", "dir_nlink", "extra_isize",
+                      "uninit_bg"}
+DEFAULT_MOUNT_OPTIONS = {"user_xattr": 0x4, "acl": 0x8}
+
+# Group descriptor flags
+BG_INODE_UNINIT = 0x1
+BG_BLOCK_UNINIT = 0x2
+BG_ITABLE_ZEROED = 0x4
+
+# Inode
+S_IFDIR = 0o040000
+S_IFREG = 0o100000
+EXTENTS_FL = 0x80000
+EXTENT_MAGIC = 0xF30A
+EXTENT_HEADER = struct.Struct("<HHHHI")
+EXTENT = struct.Struct("<IHHI")
+EXTENT_INDEX = struct.Struct("<IIHH")
+DIR_ENTRY = struct.Struct("<IHBB")
+FILE_TYPE_DIR = 2
+
+# jbd2 (big-endian)
+JBD2_MAGIC = 0xC03B3998
+JBD2_SUPERBLOCK_V2 = 4
+
+HASH_HALF_MD4 = 1
+FLAGS_SIGNED_HASH = 0x1
+JNL_BACKUP_BLOCKS = 1
+
+
+class Ext4Error(Exception):
+    pass
+
+
+def parse_profile(path=DEFAULT_CONF):
+    """mke2fs.conf as nested dicts: {section: {name: value or {name: value}}}"""
+    profile = {}
+    stack = []
+    with open(path, "r", encoding="utf-8") as f:
+        for raw in f:
+            line = raw.strip()
+            if not line or line[0] in "#;":
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                stack = [profile.setdefault(line[1:-1].strip(), {})]
+                continue
+            if line == "}":
+                if len(stack) > 1:
+                    stack.pop()
+                continue
+            if not stack or "=" not in line:
+                continue
+            key, value = (part.strip() for part in line.split("=", 1))
+            if value == "{":
+                stack.append(stack[-1].setdefault(key, {}))
+            else:
+                stack[-1][key] = value
+    return profile
+
+
+def size_type(size):
+    """Usage type mke2fs picks for a filesystem of size bytes"""
+    mib = 1024 * 1024
+    if size < 3 * mib:
+        return "floppy"
+    if size < 512 * mib:
+        return "small"
+    if size < 4 * 1024 * 1024 * mib:
+        return "default"
+    if size < 16 * 1024 * 1024 * mib:
+        return "big"
+    return "huge"
+
+
+def parse_size(text):
+    """Bytes from "4096", "0x1000", "512M", "128G" ..."""
+    match = re.fullmatch(r"\s*(0x[0-9a-fA-F]+|\d+)\s*([KMGT]?)i?B?\s*", str(text))
+    if not match:
+        raise Ext4Error(f"Неверный размер: {text}")
+    value = int(match.group(1), 0)
+    return value * 1024 ** " KMGT".index(match.group(2) or " ")
+
+
+def _journal_blocks(blocks_count):
+    """Default journal length of mke2fs (ext2fs_default_journal_size)"""
+    if blocks_count < 2048:
+        return 0
+    for limit, length in ((32768, 1024), (256 * 1024, 4096), (512 * 1024, 8192),
+                          (4096 * 1024, 16384), (8192 * 1024, 32768),
+                          (16384 * 1024, 65536), (32768 * 1024, 131072)):
+        if blocks_count < limit:
+            return length
+    return 262144
+
+
+class Ext4Options:
+    """Settings resolved from the profile for one filesystem"""
+
+    def __init__(self, features, block_size, inode_size, inode_ratio, reserved_ratio,
+                 mount_options=(), types=()):
+        self.features = set(features)
+        self.block_size = block_size
+        self.inode_size = inode_size
+        self.inode_ratio = inode_ratio
+        self.reserved_ratio = reserved_ratio
+        self.mount_options = tuple(mount_options)
+        self.types = tuple(types)
+
+    def __repr__(self):
+        return (f"Ext4Options({'/'.join(self.types)}, block={self.block_size}, inode={self.inode_size}, "
+                f"ratio={self.inode_ratio}, features={','.join(sorted(self.features))})")
+
+    @classmethod
+    def from_profile(cls, size, fs_type="ext4", usage=None, profile=None):
+        """mke2fs resolution order: [defaults], fs_type, usage (later wins)"""
+        profile = profile if profile is not None else parse_profile()
+        defaults = profile.get("defaults", {})
+        fs_types = profile.get("fs_types", {})
+        types = [fs_type] + (usage.split(",") if usage else [size_type(size)])
+        sections = [fs_types[name] for name in types if name in fs_types]
+        if fs_type not in fs_types:
+            raise Ext4Error(f"Тип {fs_type} не описан в mke2fs.conf")
+
+        def setting(name, default):
+            value = defaults.get(name, default)
+            for section in sections:
+                value = section.get(name, value)
+            return value
+
+        features = []
+        for entry in [setting("base_features", "")] + [section.get("features", "") for section in sections]:
+            for name in filter(None, (item.strip() for item in entry.split(","))):
+                clear = name.startswith("^")
+                name = FEATURE_ALIASES.get(name.lstrip("^"), name.lstrip("^"))
+                if name in features:
+                    features.remove(name)
+                if not clear:
+                    features.append(name)
+        block_size = int(setting("blocksize", 4096))
+        if block_size <= 0:
+            # -1 in the profile: page size, at least -blocksize
+            block_size = max(4096, -block_size)
+        inode_size = int(setting("inode_size", 256))
+        mount_options = [item.strip() for item in setting("default_mntopts", "").split(",") if item.strip()]
+        return cls(features, block_size, inode_size, int(setting("inode_ratio", 16384)),
+                   float(setting("reserved_ratio", 5.0)), mount_options, types)
+
+
+def _has_super(group, sparse_super):
+    """Groups holding a superblock backup: 0, 1 and powers of 3, 5 and 7"""
+    if not sparse_super or group <= 1:
+        return True
+    if group % 2 == 0:
+        return False
+    for base in (3, 5, 7):
+        value = base
+        while value < group:
+            value *= base
+        if value == group:
+            return True
+    return False
+
+
+_CRC16_TABLE = []
+for _byte in range(256):
+    _crc = _byte
+    for _ in range(8):
+        _crc = (_crc >> 1) ^ 0xA001 if _crc & 1 else _crc >> 1
+    _CRC16_TABLE.append(_crc)
+
+
+def crc16(data, crc=0xFFFF):
+    """CRC16 (ANSI, reflected) as used for uninit_bg group descriptor checksums"""
+    for byte in data:
+        crc = (crc >> 8) ^ _CRC16_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def _set_bits(bitmap, start, count):
+    """Set count bits from bit start, whole bytes at once"""
+    end = start + count
+    while start < end and start & 7:
+        bitmap[start >> 3] |= 1 << (start & 7)
+        start += 1
+    whole = (end - start) >> 3
+    bitmap[start >> 3:(start >> 3) + whole] = b"\xff" * whole
+    start += whole << 3
+    while start < end:
+        bitmap[start >> 3] |= 1 << (start & 7)
+        start += 1
+
+
+class _Allocator:
+    """Hands out data blocks group by group, behind each group's metadata"""
+
+    def __init__(self, layout):
+        self.layout = layout
+        self.group = 0
+        self.next = layout.data_start(0)
+
+    def copy(self):
+        other = _Allocator.__new__(_Allocator)
+        other.layout, other.group, other.next = self.layout, self.group, self.next
+        return other
+
+    def allocate(self, count):
+        """List of (start, length) runs"""
+        runs = []
+        while count:
+            if self.group >= self.layout.groups:
+                raise Ext4Error("Образ слишком мал для метаданных и журнала")
+            end = self.layout.group_end(self.group)
+            take = min(count, end - self.next)
+            if take > 0:
+                if runs and runs[-1][0] + runs[-1][1] == self.next:
+                    runs[-1] = (runs[-1][0], runs[-1][1] + take)
+                else:
+                    runs.append((self.next, take))
+                self.next += take
+                count -= take
+            if self.next >= end:
+                self.group += 1
+                if self.group < self.layout.groups:
+                    self.next = self.layout.data_start(self.group)
+        return runs
+
+
+class Ext4Layout:
+    """Block group geometry, computed like ext2fs_initialize"""
+
+    def __init__(self, size, options):
+        self.options = options
+        block_size = options.block_size
+        if block_size not in (1024, 2048, 4096, 65536) and block_size & (block_size - 1):
+            raise Ext4Error(f"Неподдерживаемый размер блока: {block_size}")
+        self.block_size = block_size
+        self.first_data_block = 1 if block_size == 1024 else 0
+        self.blocks_per_group = 8 * block_size
+        self.inodes_per_block = block_size // options.inode_size
+        self.sparse_super = "sparse_super" in options.features
+        blocks_count = size // block_size
+        while True:
+            self._compute(blocks_count)
+            remainder = (blocks_count - self.first_data_block) % self.blocks_per_group
+            if remainder and remainder < self.overhead(self.groups - 1) + MIN_LAST_GROUP_DATA:
+                if self.groups == 1:
+                    raise Ext4Error(f"Слишком маленький образ: {size} байт")
+                blocks_count -= remainder
+                continue
+            break
+
+    def _compute(self, blocks_count):
+        options = self.options
+        self.blocks_count = blocks_count
+        self.groups = max(1, -(-(blocks_count - self.first_data_block) // self.blocks_per_group))
+        inodes = blocks_count * self.block_size // options.inode_ratio
+        per_group = max(-(-inodes // self.groups), -(-(FIRST_INODE + 1) // self.groups))
+        # Whole inode table blocks, whole bitmap bytes, at most one bitmap block
+        per_group = -(-per_group // self.inodes_per_block) * self.inodes_per_block
+        per_group = (per_group + 7) & ~7
+        self.inodes_per_group = min(per_group, self.blocks_per_group,
+                                    0x10000 - self.inodes_per_block)
+        self.inodes_count = self.inodes_per_group * self.groups
+        self.inode_table_blocks = self.inodes_per_group // self.inodes_per_block
+        self.gdt_blocks = -(-self.groups * GROUP_DESC_SIZE // self.block_size)
+
+    def group_start(self, group):
+        return self.first_data_block + group * self.blocks_per_group
+
+    def group_end(self, group):
+        return min(self.group_start(group) + self.blocks_per_group, self.blocks_count)
+
+    def has_super(self, group):
+        return _has_super(group, self.sparse_super)
+
+    def overhead(self, group):
+        """Metadata blocks at the start of a group"""
+        backup = 1 + self.gdt_blocks if self.has_super(group) else 0
+        return backup + 2 + self.inode_table_blocks
+
+    def block_bitmap(self, group):
+        return self.group_start(group) + (1 + self.gdt_blocks if self.has_super(group) else 0)
+
+    def inode_bitmap(self, group):
+        return self.block_bitmap(group) + 1
+
+    def inode_table(self, group):
+        return self.block_bitmap(group) + 2
+
+    def data_start(self, group):
+        return self.group_start(group) + self.overhead(group)
+
+
+class Ext4Builder:
+    """Generates the metadata blocks of an empty ext4 filesystem"""
+
+    def __init__(self, size, options, label="", fs_uuid=None, timestamp=None, lazy_itable_init=True):
+        unsupported = options.features - SUPPORTED_FEATURES
+        if unsupported:
+            raise Ext4Error("Неподдерживаемые возможности ext4: " + ", ".join(sorted(unsupported)))
+        if "extent" not in options.features:
+            raise Ext4Error("Поддерживаются только профили с extent (ext4)")
+        self.options = options
+        self.layout = Ext4Layout(size, options)
+        self.features = set(options.features)
+        self.label = label.encode("utf-8")[:16]
+        self.uuid = (fs_uuid or uuid_module.uuid4()).bytes
+        self.hash_seed = uuid_module.uuid5(uuid_module.UUID(bytes=self.uuid), "hash_seed").bytes
+        self.timestamp = int(time.time() if timestamp is None else timestamp)
+        self.csum = "uninit_bg" in self.features
+        self.lazy = lazy_itable_init and self.csum
+        self.journal_blocks = _journal_blocks(self.layout.blocks_count) if "has_journal" in self.features else 0
+        if not self.journal_blocks:
+            self.features.discard("has_journal")
+        self.blocks = {}
+        self.fills = []
+        # Allocated data blocks as (start, length)
+        self.data_runs = []
+        self.jnl_blocks = None
+        self._built = False
+
+    @property
+    def block_size(self):
+        return self.layout.block_size
+
+    @property
+    def total_blocks(self):
+        return self.layout.blocks_count
+
+    def _feature_mask(self, table):
+        mask = 0
+        for name in self.features:
+            mask |= table.get(name, 0)
+        return mask
+
+    # --- inodes ---------------------------------------------------------
+
+    def _inode(self, mode=0, links=0, size=0, sectors=0, flags=0, i_block=b""):
+        inode = bytearray(self.options.inode_size)
+        now = self.timestamp if mode else 0
+        struct.pack_into("<HHIIIIIHHII", inode, 0, mode, 0, size & 0xFFFFFFFF, now, now, now, 0,
+                         0, links, sectors, flags)
+        inode[0x28:0x28 + len(i_block)] = i_block
+        struct.pack_into("<I", inode, 0x6C, size >> 32)
+        if self.options.inode_size > GOOD_OLD_INODE_SIZE:
+            struct.pack_into("<H", inode, 0x80, EXTRA_ISIZE)
+            if mode:
+                struct.pack_into("<I", inode, 0x90, now)
+        return inode
+
+    @staticmethod
+    def _extents(runs):
+        """Packed extents mapping runs from logical block 0"""
+        extents = []
+        logical = 0
+        for start, length in runs:
+            while length:
+                take = min(length, MAX_EXTENT_LENGTH)
+                extents.append(EXTENT.pack(logical, take, start >> 32, start & 0xFFFFFFFF))
+                logical += take
+                start += take
+                length -= take
+        return extents
+
+    def _tree(self, runs, leaf_block=None):
+        """(i_block, leaf block bytes or None) for data runs
+
+        Up to four extents live in the inode, more go to one leaf block.
+        """
+        extents = self._extents(runs)
+        if len(extents) <= 4:
+            return EXTENT_HEADER.pack(EXTENT_MAGIC, len(extents), 4, 0, 0) + b"".join(extents), None
+        capacity = (self.block_size - EXTENT_HEADER.size) // EXTENT.size
+        if len(extents) > capacity or leaf_block is None:
+            raise Ext4Error("Журнал слишком фрагментирован")
+        leaf = bytearray(self.block_size)
+        leaf[:EXTENT_HEADER.size] = EXTENT_HEADER.pack(EXTENT_MAGIC, len(extents), capacity, 0, 0)
+        leaf[EXTENT_HEADER.size:EXTENT_HEADER.size + len(extents) * EXTENT.size] = b"".join(extents)
+        root = (EXTENT_HEADER.pack(EXTENT_MAGIC, 1, 4, 1, 0) +
+                EXTENT_INDEX.pack(0, leaf_block & 0xFFFFFFFF, leaf_block >> 32, 0))
+        return root, bytes(leaf)
+
+    def _directory_block(self, entries):
+        """One directory block; the last entry takes up the rest"""
+        block = bytearray(self.block_size)
+        offset = 0
+        file_type = "filetype" in self.features
+        for index, (inode, name) in enumerate(entries):
+            length = (DIR_ENTRY.size + len(name) + 3) & ~3
+            if index == len(entries) - 1:
+                length = self.block_size - offset
+            DIR_ENTRY.pack_into(block, offset, inode, length, len(name),
+                                FILE_TYPE_DIR if file_type and inode else 0)
+            block[offset + DIR_ENTRY.size:offset + DIR_ENTRY.size + len(name)] = name
+            offset += length
+        return bytes(block)
+
+    def _mark(self, runs):
+        self.data_runs.extend(runs)
+
+    # --- build ----------------------------------------------------------
+
+    def _allocate_files(self):
+        """Root, lost+found and journal blocks; returns their inodes"""
+        block_size = self.block_size
+        sectors = block_size // 512
+        allocator = _Allocator(self.layout)
+        inodes = {}
+
+        root_runs = allocator.allocate(1)
+        # Grown like mke2fs does: to 16 KiB, at most the 12 direct blocks
+        lost_found_blocks = min(max(2, LOST_FOUND_MIN_SIZE // block_size), LOST_FOUND_MAX_BLOCKS)
+        lost_found_runs = allocator.allocate(lost_found_blocks)
+        self._mark(root_runs + lost_found_runs)
+
+        root_block = root_runs[0][0]
+        self.blocks[root_block] = self._directory_block(
+            [(ROOT_INODE, b"."), (ROOT_INODE, b".."), (FIRST_INODE, b"lost+found")])
+        inodes[ROOT_INODE] = self._inode(S_IFDIR | 0o755, 3, block_size, sectors, EXTENTS_FL,
+                                         self._tree(root_runs)[0])
+
+        lost_found = [block for start, length in lost_found_runs for block in range(start, start + length)]
+        self.blocks[lost_found[0]] = self._directory_block([(FIRST_INODE, b"."), (ROOT_INODE, b"..")])
+        for block in lost_found[1:]:
+            self.blocks[block] = self._directory_block([(0, b"")])
+        inodes[FIRST_INODE] = self._inode(S_IFDIR | 0o700, 2, lost_found_blocks * block_size,
+                                          lost_found_blocks * sectors, EXTENTS_FL,
+                                          self._tree(lost_found_runs)[0])
+
+        if self.journal_blocks:
+            # A dry run tells whether the extents need a leaf block first
+            leaf_block = None
+            if len(self._extents(allocator.copy().allocate(self.journal_blocks))) > 4:
+                leaf_block = allocator.allocate(1)[0][0]
+                self._mark([(leaf_block, 1)])
+            journal_runs = allocator.allocate(self.journal_blocks)
+            self._mark(journal_runs)
+            i_block, leaf = self._tree(journal_runs, leaf_block)
+            if leaf:
+                self.blocks[leaf_block] = leaf
+            metadata = 1 if leaf else 0
+            size = self.journal_blocks * block_size
+            inodes[JOURNAL_INODE] = self._inode(S_IFREG | 0o600, 1, size,
+                                                (self.journal_blocks + metadata) * sectors,
+                                                EXTENTS_FL, i_block)
+            first = journal_runs[0][0]
+            self.blocks[first] = self._journal_superblock()
+            # Zeroed, so stale transactions of an earlier filesystem never replay
+            for start, length in journal_runs:
+                if start == first:
+                    start, length = start + 1, length - 1
+                if length:
+                    self.fills.append((start, length))
+            self.jnl_blocks = (struct.unpack("<15I", i_block.ljust(60, b"\0")) +
+                               (size >> 32, size & 0xFFFFFFFF))
+        return inodes
+
+    def _journal_superblock(self):
+        block = bytearray(self.block_size)
+        struct.pack_into(">III", block, 0, JBD2_MAGIC, JBD2_SUPERBLOCK_V2, 0)
+        # blocksize, maxlen, first, sequence, start (0: clean)
+        struct.pack_into(">IIIII", block, 0x0C, self.block_size, self.journal_blocks, 1, 1, 0)
+        block[0x30:0x40] = self.uuid
+        struct.pack_into(">I", block, 0x40, 1)
+        return bytes(block)
+
+    def _superblock(self, group, free_blocks, free_inodes):
+        layout = self.layout
+        sb = bytearray(SUPERBLOCK_SIZE)
+        reserved = int(layout.blocks_count * self.options.reserved_ratio / 100)
+        log_block = (self.block_size >> 10).bit_length() - 1
+        struct.pack_into("<13I" "HhHHHH" "4I" "HH" "IHH" "3I", sb, 0,
+                         layout.inodes_count, layout.blocks_count & 0xFFFFFFFF,
+                         reserved & 0xFFFFFFFF, free_blocks & 0xFFFFFFFF, free_inodes,
+                         layout.first_data_block, log_block, log_block,
+                         layout.blocks_per_group, layout.blocks_per_group, layout.inodes_per_group,
+                         0, self.timestamp, 0, -1, EXT4_MAGIC, 1, 1, 0,
+                         self.timestamp, 0, 0, 1, 0, 0, FIRST_INODE, self.options.inode_size, group,
+                         self._feature_mask(COMPAT), self._feature_mask(INCOMPAT),
+                         self._feature_mask(RO_COMPAT))
+        sb[0x68:0x78] = self.uuid
+        sb[0x78:0x78 + len(self.label)] = self.label
+        if self.journal_blocks:
+            struct.pack_into("<I", sb, 0xE0, JOURNAL_INODE)
+            struct.pack_into("<17I", sb, 0x10C, *self.jnl_blocks)
+            struct.pack_into("<B", sb, 0xFD, JNL_BACKUP_BLOCKS)
+        sb[0xEC:0xFC] = self.hash_seed
+        struct.pack_into("<B", sb, 0xFC, HASH_HALF_MD4)
+        mount_options = 0
+        for name in self.options.mount_options:
+            mount_options |= DEFAULT_MOUNT_OPTIONS.get(name, 0)
+        struct.pack_into("<III", sb, 0x100, mount_options, 0, self.timestamp)
+        struct.pack_into("<III", sb, 0x150, layout.blocks_count >> 32, reserved >> 32, free_blocks >> 32)
+        if "extra_isize" in self.features and self.options.inode_size > GOOD_OLD_INODE_SIZE:
+            struct.pack_into("<HH", sb, 0x15C, EXTRA_ISIZE, EXTRA_ISIZE)
+        struct.pack_into("<I", sb, 0x160, FLAGS_SIGNED_HASH)
+        return bytes(sb)
+
+    def build(self):
+        """Fill self.blocks (RAW) and self.fills (zero FILL); idempotent"""
+        if self._built:
+            return
+        layout = self.layout
+        block_size = self.block_size
+        inodes = self._allocate_files()
+        # Allocated data per group, as runs relative to the group start
+        group_runs = {}
+        for start, length in self.data_runs:
+            while length:
+                group = (start - layout.first_data_block) // layout.blocks_per_group
+                end = min(layout.group_end(group), start + length)
+                group_runs.setdefault(group, []).append((start - layout.group_start(group), end - start))
+                length -= end - start
+                start = end
+
+        descriptors = bytearray(layout.gdt_blocks * block_size)
+        total_free_blocks = 0
+        total_free_inodes = 0
+        backups = []
+        for group in range(layout.groups):
+            start, end = layout.group_start(group), layout.group_end(group)
+            used = [(0, layout.overhead(group))] + group_runs.get(group, [])
+            data_used = group in group_runs
+            free_blocks = (end - start) - sum(length for _, length in used)
+            inodes_used = FIRST_INODE if group == 0 else 0
+            free_inodes = layout.inodes_per_group - inodes_used
+            flags = 0
+            if self.csum:
+                if group != 0:
+                    flags |= BG_INODE_UNINIT
+                if not data_used and group != layout.groups - 1:
+                    flags |= BG_BLOCK_UNINIT
+                if not self.lazy:
+                    flags |= BG_ITABLE_ZEROED
+            total_free_blocks += free_blocks
+            total_free_inodes += free_inodes
+
+            # Block bitmap, bits past the end of the last group are set
+            if not flags & BG_BLOCK_UNINIT:
+                bitmap = bytearray(block_size)
+                for index, length in used:
+                    _set_bits(bitmap, index, length)
+                _set_bits(bitmap, end - start, layout.blocks_per_group - (end - start))
+                self.blocks[layout.block_bitmap(group)] = bytes(bitmap)
+            if not flags & BG_INODE_UNINIT:
+                bitmap = bytearray(block_size)
+                _set_bits(bitmap, 0, inodes_used)
+                _set_bits(bitmap, layout.inodes_per_group, 8 * block_size - layout.inodes_per_group)
+                self.blocks[layout.inode_bitmap(group)] = bytes(bitmap)
+
+            # Inode table: the reserved inodes are written, the rest zeroed now or lazily
+            table = layout.inode_table(group)
+            written = 0
+            if group == 0:
+                written = -(-FIRST_INODE // layout.inodes_per_block)
+                data = bytearray()
+                for number in range(1, written * layout.inodes_per_block + 1):
+                    if number in inodes:
+                        data += inodes[number]
+                    elif number <= FIRST_INODE:
+                        data += self._inode()
+                    else:
+                        data += bytes(self.options.inode_size)
+                for index in range(written):
+                    self.blocks[table + index] = bytes(data[index * block_size:(index + 1) * block_size])
+            if not self.lazy and layout.inode_table_blocks > written:
+                self.fills.append((table + written, layout.inode_table_blocks - written))
+
+            itable_unused = layout.inodes_per_group - inodes_used if self.csum else 0
+            descriptor = bytearray(struct.pack("<IIIHHHHIHHH", layout.block_bitmap(group),
+                                               layout.inode_bitmap(group), table, free_blocks,
+                                               free_inodes, 2 if group == 0 else 0, flags, 0, 0, 0,
+                                               itable_unused))
+            if self.csum:
+                checksum = crc16(descriptor, crc16(struct.pack("<I", group), crc16(self.uuid)))
+            else:
+                checksum = 0
+            descriptor += struct.pack("<H", checksum)
+            descriptors[group * GROUP_DESC_SIZE:(group + 1) * GROUP_DESC_SIZE] = descriptor
+            if layout.has_super(group):
+                backups.append(group)
+
+        for group in backups:
+            start = layout.group_start(group)
+            sb = self._superblock(group, total_free_blocks, total_free_inodes)
+            if group == 0:
+                # Block 0 also holds the boot sector area, zeroed like mke2fs does
+                if block_size == 1024:
+                    self.blocks[0] = bytes(block_size)
+                    self.blocks[start] = sb
+                else:
+                    self.blocks[0] = (bytes(SUPERBLOCK_OFFSET) + sb).ljust(block_size, b"\0")
+            else:
+                self.blocks[start] = sb.ljust(block_size, b"\0")
+            for index in range(layout.gdt_blocks):
+                self.blocks[start + 1 + index] = bytes(descriptors[index * block_size:(index + 1) * block_size])
+        self.free_blocks = total_free_blocks
+        self.free_inodes = total_free_inodes
+        self._built = True
+
+    def chunks(self):
+        """Sparse chunks covering the whole image, in block order"""
+        self.build()
+        return sparse_image.build_chunks(self.blocks, self.fills, self.total_blocks)
+
+    def write(self, out_path, sparse=True):
+        """Write the image; a raw image keeps DONT_CARE areas as holes"""
+        chunks = self.chunks()
+        if sparse:
+            return sparse_image.write_sparse(chunks, out_path, self.block_size, self.total_blocks)
+        sparse_image.write_raw(chunks, out_path, self.block_size, self.total_blocks)
+        return self.total_blocks * self.block_size
+
+
+def make_builder(size, fs_type="ext4", usage=None, conf_path=DEFAULT_CONF, label="", fs_uuid=None):
+    options = Ext4Options.from_profile(size, fs_type, usage, parse_profile(conf_path))
+    return Ext4Builder(size, options, label=label, fs_uuid=fs_uuid)
+
+
+def build_image(out_path, size, fs_type="ext4", usage=None, conf_path=DEFAULT_CONF, label="",
+                sparse=True):
+    """Write an empty filesystem of size bytes; returns the file size"""
+    return make_builder(size, fs_type, usage, conf_path, label).write(out_path, sparse)
+
+
+def main():
+    """Command line: ext4_image.py SIZE OUTPUT [-T usage] [-L label] [--raw]
+
+    SIZE in bytes or with a K/M/G/T suffix, e.g. 110G.
+    """
+    args = sys.argv[1:]
+    usage = label = None
+    sparse = True
+    positional = []
+    while args:
+        arg = args.pop(0)
+        if arg == "-T" and args:
+            usage = args.pop(0)
+        elif arg == "-L" and args:
+            label = args.pop(0)
+        elif arg == "--raw":
+            sparse = False
+        else:
+            positional.append(arg)
+    if len(positional) != 2:
+        print(main.__doc__)
+        return 1
+    try:
+        builder = make_builder(parse_size(positional[0]), usage=usage, label=label or "")
+        started = time.monotonic()
+        written = builder.write(positional[1], sparse)
+    except (Ext4Error, OSError) as e:
+        print(f"Ошибка: {e}")
+        return 1
+    layout = builder.layout
+    print(f"{builder.options}")
+    print(f"Блоков: {layout.blocks_count}, групп: {layout.groups}, inode: {layout.inodes_count}, "
+          f"журнал: {builder.journal_blocks} блоков")
+    print(f"Записано {written / 1024 ** 2:.1f} МБ за {time.monotonic() - started:.2f} с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
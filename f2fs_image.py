@@ -0,0 +1,507 @@
+"""
+F2FS image builder for ProshivkaTool
+
+Creates empty F2FS filesystems (userdata) in-process instead of running
+make_f2fs.exe / make_f2fs_casefold.exe. The layout follows make_f2fs -g
+android: 4 KB sectors, 2 MB segments, one segment per section and zone,
+the same overprovision search and the features Android formats userdata
+with (encrypt, extra_attr, project_quota, verity), casefold on request.
+
+The area boundaries come from the partition size alone: two superblocks,
+the checkpoint (two packs), SIT, NAT and SSA, then the main area. Only a
+handful of blocks carry data: both superblocks, the checkpoint pack with
+its summaries, the first NAT block, the root inode and its dentry block.
+The valid SIT and NAT copies and the current node segments are zero
+FILL, so stale data on the partition is never read back; the rest of the
+partition is DONT_CARE. A 100+ GB userdata is a sparse file of a few KB
+and is flashed in seconds.
+"""
+import struct
+import sys
+import time
+import uuid as uuid_module
+import zlib
+
+import sparse_image
+from ext4_image import Ext4Error, parse_size
+
+F2FS_MAGIC = 0xF2F52010
+MAJOR_VERSION = 1
+MINOR_VERSION = 16
+SUPERBLOCK_OFFSET = 1024
+SUPERBLOCK_SIZE = 3072
+BLOCK_SIZE = 4096
+LOG_BLOCK_SIZE = 12
+# make_f2fs -g android uses 4 KB sectors
+LOG_SECTOR_SIZE = 12
+LOG_BLOCKS_PER_SEGMENT = 9
+BLOCKS_PER_SEGMENT = 1 << LOG_BLOCKS_PER_SEGMENT
+CHECKPOINT_PACKS = 2
+# Hot, warm and cold logs for both nodes and data
+CURRENT_SEGMENT_TYPES = 6
+MAX_ACTIVE_LOGS = 16
+MAX_ACTIVE_NODE_LOGS = 8
+MIN_SEGMENTS = 9
+MAX_SEGMENTS = 16 * 1024 * 1024 // 2
+MAX_VOLUME_NAME = 512
+EXTENSION_LENGTH = 8
+NODE_INO = 1
+META_INO = 2
+ROOT_INO = 3
+
+# On-disk record sizes
+SIT_ENTRY = struct.Struct("<H64sQ")
+SIT_ENTRY_PER_BLOCK = BLOCK_SIZE // SIT_ENTRY.size
+SIT_VBLOCKS_SHIFT = 10
+NAT_ENTRY = struct.Struct("<BII")
+NAT_ENTRY_PER_BLOCK = BLOCK_SIZE // NAT_ENTRY.size
+SUMMARY = struct.Struct("<IBH")
+ENTRIES_IN_SUMMARY = 512
+SUMMARY_FOOTER_SIZE = 5
+SUM_JOURNAL_SIZE = BLOCK_SIZE - SUMMARY_FOOTER_SIZE - SUMMARY.size * ENTRIES_IN_SUMMARY
+SUM_TYPE_NODE = 1
+
+# Checkpoint block; sit_nat_version_bitmap follows the fixed part
+CHECKPOINT = struct.Struct("<QQQIII8I8H8I8HIIIIIIIIIQ16s")
+CP_CHECKSUM_OFFSET = BLOCK_SIZE - 4
+MAX_BITMAP_BYTES = CP_CHECKSUM_OFFSET - CHECKPOINT.size
+# At least this much of the version bitmap is left for NAT
+MAX_SIT_BITMAP_IN_CHECKPOINT = MAX_BITMAP_BYTES - 64
+CP_UMOUNT_FLAG = 0x1
+CP_COMPACT_SUM_FLAG = 0x4
+
+SUPERBLOCK_HEADER = struct.Struct("<IHH7IQ16I")
+SB_CHECKSUM_OFFSET = SUPERBLOCK_SIZE - 4
+
+# Inode
+INODE = struct.Struct("<HBBIIIQQQQQIIIIIIIII255sB3I")
+NODE_FOOTER = struct.Struct("<IIIQI")
+NODE_FOOTER_OFFSET = BLOCK_SIZE - NODE_FOOTER.size
+INLINE_EXTRA_ATTR = 0x20
+# Offsets of i_projid and i_inode_checksum inside the extra attribute area
+EXTRA_ISIZE_BASE = 4
+EXTRA_ISIZE_PROJID = 8
+S_IFDIR = 0o040000
+
+# Dentry block: bitmap, reserved, 214 entries, 214 name slots
+DENTRY_IN_BLOCK = 214
+DENTRY_BITMAP_SIZE = (DENTRY_IN_BLOCK + 7) // 8
+DIR_ENTRY = struct.Struct("<IIHB")
+SLOT_LENGTH = 8
+DENTRY_OFFSET = DENTRY_BITMAP_SIZE + 3
+FILENAME_OFFSET = DENTRY_OFFSET + DIR_ENTRY.size * DENTRY_IN_BLOCK
+FILE_TYPE_DIR = 2
+
+FEATURES = {"encrypt": 0x1, "extra_attr": 0x8, "project_quota": 0x10, "sb_checksum": 0x800,
+            "verity": 0x400, "casefold": 0x1000}
+# make_f2fs -g android
+ANDROID_FEATURES = ("encrypt", "extra_attr", "project_quota", "verity")
+ENCODING_UTF8_12_1 = 1
+
+# Extensions make_f2fs places into the cold data log; "db" goes to the hot one
+COLD_EXTENSIONS = ("mp", "wm", "og", "jp", "avi", "m4v", "m4p", "mkv", "mov", "webm",
+                   "wav", "m4a", "3gp", "opus", "flac", "gif", "png", "svg", "webp",
+                   "jar", "deb", "iso", "gz", "xz", "zst", "pdf", "pyc", "ttc", "ttf",
+                   "exe", "apk", "cnt", "exo", "odex", "vdex", "so")
+HOT_EXTENSIONS = ("db",)
+
+
+class F2fsError(Exception):
+    pass
+
+
+def f2fs_crc32(data, crc=F2FS_MAGIC):
+    """CRC32 as f2fs computes it: seeded with the magic, no final inversion"""
+    return ~zlib.crc32(data, ~crc & 0xFFFFFFFF) & 0xFFFFFFFF
+
+
+def _size_align(value, size):
+    return (value + size - 1) // size
+
+
+def best_overprovision(main_segments):
+    """Overprovision ratio in percent leaving the most space to files
+
+    Same search as make_f2fs, including its float stepping, so the
+    reserved and overprovision segment counts match.
+    """
+    if main_segments < 256:
+        candidate, end, step = 10.0, 95.0, 5.0
+    else:
+        candidate, end, step = 0.01, 10.0, 0.01
+    best, best_space = 0.0, 0.0
+    while candidate <= end:
+        reserved = (2 * (100 / candidate + 1) + CURRENT_SEGMENT_TYPES)
+        overprovision = (main_segments - reserved) * candidate / 100
+        space = main_segments - reserved - overprovision
+        if best_space < space:
+            best_space, best = space, candidate
+        candidate += step
+    return best
+
+
+class F2fsLayout:
+    """Area boundaries of an F2FS filesystem of a given size, in blocks"""
+
+    def __init__(self, size):
+        self.block_count = size // BLOCK_SIZE
+        # Superblocks sit in the first two blocks, segment 0 starts at the next zone
+        self.segment0 = BLOCKS_PER_SEGMENT
+        self.segment_count = (self.block_count - self.segment0) // BLOCKS_PER_SEGMENT
+        if self.segment_count < MIN_SEGMENTS:
+            raise F2fsError(f"Раздел слишком мал для F2FS: {size} байт")
+        if self.segment_count > MAX_SEGMENTS:
+            raise F2fsError(f"Раздел слишком велик для F2FS: {size} байт")
+
+        self.segment_count_ckpt = CHECKPOINT_PACKS
+        self.cp_blkaddr = self.segment0
+        self.sit_blkaddr = self.cp_blkaddr + self.segment_count_ckpt * BLOCKS_PER_SEGMENT
+        sit_segments = _size_align(_size_align(self.segment_count, SIT_ENTRY_PER_BLOCK),
+                                   BLOCKS_PER_SEGMENT)
+        self.segment_count_sit = sit_segments * 2
+        self.nat_blkaddr = self.sit_blkaddr + self.segment_count_sit * BLOCKS_PER_SEGMENT
+
+        available = (self.segment_count - self.segment_count_ckpt
+                     - self.segment_count_sit) * BLOCKS_PER_SEGMENT
+        nat_segments = _size_align(_size_align(available, NAT_ENTRY_PER_BLOCK), BLOCKS_PER_SEGMENT)
+        # The SIT and NAT version bitmaps share the checkpoint block; a SIT
+        # bitmap too large for it moves into cp_payload blocks after it
+        sit_bitmap_size = (sit_segments << LOG_BLOCKS_PER_SEGMENT) // 8
+        max_sit_bitmap = min(sit_bitmap_size, (_size_align(_size_align(MAX_SEGMENTS, SIT_ENTRY_PER_BLOCK),
+                                                           BLOCKS_PER_SEGMENT) * BLOCKS_PER_SEGMENT // 8))
+        if max_sit_bitmap > MAX_SIT_BITMAP_IN_CHECKPOINT:
+            max_nat_bitmap = MAX_BITMAP_BYTES
+            self.cp_payload = _size_align(max_sit_bitmap, BLOCK_SIZE)
+        else:
+            max_nat_bitmap = MAX_BITMAP_BYTES - max_sit_bitmap
+            self.cp_payload = 0
+        nat_segments = min(nat_segments, (max_nat_bitmap * 8) >> LOG_BLOCKS_PER_SEGMENT)
+        self.segment_count_nat = nat_segments * 2
+        self.ssa_blkaddr = self.nat_blkaddr + self.segment_count_nat * BLOCKS_PER_SEGMENT
+
+        available = (self.segment_count - self.segment_count_ckpt - self.segment_count_sit
+                     - self.segment_count_nat) * BLOCKS_PER_SEGMENT
+        self.segment_count_ssa = _size_align(available // BLOCKS_PER_SEGMENT + 1, BLOCKS_PER_SEGMENT)
+        meta_segments = (self.segment_count_ckpt + self.segment_count_sit
+                         + self.segment_count_nat + self.segment_count_ssa)
+        self.main_blkaddr = self.segment0 + meta_segments * BLOCKS_PER_SEGMENT
+        if meta_segments >= self.segment_count:
+            raise F2fsError(f"Раздел слишком мал для F2FS: {size} байт")
+        self.segment_count_main = self.segment_count - meta_segments
+        self.section_count = self.segment_count_main
+
+        self.overprovision = best_overprovision(self.segment_count_main)
+        if not self.overprovision:
+            raise F2fsError(f"Раздел слишком мал для F2FS: {size} байт")
+        self.reserved_segments = int(2 * (100 / self.overprovision + 1) + CURRENT_SEGMENT_TYPES)
+        if self.segment_count_main - 2 < self.reserved_segments:
+            raise F2fsError(f"Раздел слишком мал для F2FS: {size} байт")
+        self.overprovision_segments = int((self.segment_count_main - self.reserved_segments)
+                                          * self.overprovision / 100) + self.reserved_segments
+        if self.overprovision_segments >= self.segment_count_main:
+            raise F2fsError(f"Раздел слишком мал для F2FS: {size} байт")
+        self.user_block_count = ((self.segment_count_main - self.overprovision_segments)
+                                 * BLOCKS_PER_SEGMENT)
+
+        # Current segments of the six logs, as make_f2fs without heap allocation
+        hot_node, warm_node, cold_node, hot_data = 0, 1, 2, 3
+        cold_data = max((self.segment_count_main >> 2) - 1, hot_data + 1)
+        warm_data = max((self.segment_count_main >> 1) - 1, cold_data + 1)
+        self.node_segments = (hot_node, warm_node, cold_node)
+        self.data_segments = (hot_data, warm_data, cold_data)
+
+    @property
+    def sit_bitmap_size(self):
+        return ((self.segment_count_sit // 2) << LOG_BLOCKS_PER_SEGMENT) // 8
+
+    @property
+    def nat_bitmap_size(self):
+        return ((self.segment_count_nat // 2) << LOG_BLOCKS_PER_SEGMENT) // 8
+
+    def segment_block(self, segment):
+        """First block of a main area segment"""
+        return self.main_blkaddr + segment * BLOCKS_PER_SEGMENT
+
+
+class F2fsBuilder:
+    """Metadata blocks of an empty F2FS filesystem"""
+
+    def __init__(self, size, features=ANDROID_FEATURES, casefold=False, label="",
+                 fs_uuid=None, timestamp=None):
+        features = set(features)
+        if casefold:
+            features.add("casefold")
+        unknown = sorted(name for name in features if name not in FEATURES)
+        if unknown:
+            raise F2fsError("Неподдерживаемые возможности F2FS: " + ", ".join(unknown))
+        if "project_quota" in features and "extra_attr" not in features:
+            raise F2fsError("project_quota требует extra_attr")
+        self.features = features
+        self.layout = F2fsLayout(size)
+        self.label = label or ""
+        self.uuid = (fs_uuid or uuid_module.uuid4()).bytes
+        self.timestamp = int(time.time() if timestamp is None else timestamp)
+        self.blocks = {}
+        self.fills = []
+        self._built = False
+
+    @property
+    def block_size(self):
+        return BLOCK_SIZE
+
+    @property
+    def total_blocks(self):
+        return self.layout.block_count
+
+    @property
+    def casefold(self):
+        return "casefold" in self.features
+
+    def _feature_mask(self):
+        mask = 0
+        for name in self.features:
+            mask |= FEATURES[name]
+        return mask
+
+    def _superblock(self):
+        layout = self.layout
+        sb = bytearray(SUPERBLOCK_SIZE)
+        checksum_offset = SB_CHECKSUM_OFFSET if "sb_checksum" in self.features else 0
+        SUPERBLOCK_HEADER.pack_into(
+            sb, 0, F2FS_MAGIC, MAJOR_VERSION, MINOR_VERSION, LOG_SECTOR_SIZE,
+            LOG_BLOCK_SIZE - LOG_SECTOR_SIZE, LOG_BLOCK_SIZE, LOG_BLOCKS_PER_SEGMENT, 1, 1,
+            checksum_offset, layout.block_count, layout.section_count, layout.segment_count,
+            layout.segment_count_ckpt, layout.segment_count_sit, layout.segment_count_nat,
+            layout.segment_count_ssa, layout.segment_count_main, layout.segment0,
+            layout.cp_blkaddr, layout.sit_blkaddr, layout.nat_blkaddr, layout.ssa_blkaddr,
+            layout.main_blkaddr, ROOT_INO, NODE_INO, META_INO)
+        sb[108:124] = self.uuid
+        name = self.label.encode("utf-16-le")[:2 * MAX_VOLUME_NAME]
+        sb[124:124 + len(name)] = name
+        extensions = COLD_EXTENSIONS + HOT_EXTENSIONS
+        struct.pack_into("<I", sb, 1148, len(COLD_EXTENSIONS))
+        for index, extension in enumerate(extensions):
+            offset = 1152 + index * EXTENSION_LENGTH
+            sb[offset:offset + len(extension)] = extension.encode("ascii")
+        struct.pack_into("<I", sb, 1664, layout.cp_payload)
+        version = b"ProshivkaTool f2fs_image"
+        sb[1668:1668 + len(version)] = version
+        sb[1924:1924 + len(version)] = version
+        struct.pack_into("<I", sb, 2180, self._feature_mask())
+        sb[2757] = len(HOT_EXTENSIONS)
+        if self.casefold:
+            struct.pack_into("<HH", sb, 2758, ENCODING_UTF8_12_1, 0)
+        if checksum_offset:
+            struct.pack_into("<I", sb, checksum_offset, f2fs_crc32(bytes(sb[:checksum_offset])))
+        return bytes(sb)
+
+    def _checkpoint(self, version):
+        layout = self.layout
+        no_log = [0xFFFFFFFF] * (MAX_ACTIVE_NODE_LOGS - 3)
+        node_segments = list(layout.node_segments) + no_log
+        data_segments = list(layout.data_segments) + no_log
+        # The root inode and its dentry block are the first block of the hot logs
+        offsets = [1, 0, 0] + [0] * (MAX_ACTIVE_NODE_LOGS - 3)
+        free_segments = layout.segment_count_main - CURRENT_SEGMENT_TYPES
+        cp = bytearray(BLOCK_SIZE)
+        CHECKPOINT.pack_into(
+            cp, 0, version, layout.user_block_count, 2, layout.reserved_segments,
+            layout.overprovision_segments, free_segments, *node_segments, *offsets,
+            *data_segments, *offsets, CP_UMOUNT_FLAG | CP_COMPACT_SUM_FLAG,
+            CURRENT_SEGMENT_TYPES + layout.cp_payload, 1 + layout.cp_payload,
+            1, 1, ROOT_INO + 1, layout.sit_bitmap_size, layout.nat_bitmap_size,
+            CP_CHECKSUM_OFFSET, 0, bytes(MAX_ACTIVE_LOGS))
+        struct.pack_into("<I", cp, CP_CHECKSUM_OFFSET, f2fs_crc32(bytes(cp[:CP_CHECKSUM_OFFSET])))
+        return bytes(cp)
+
+    def _compact_summary(self):
+        """NAT and SIT journals plus the data log summaries in one block"""
+        layout = self.layout
+        block = bytearray(BLOCK_SIZE)
+        root_node = layout.segment_block(layout.node_segments[0])
+        # NAT journal: the root inode
+        struct.pack_into("<H", block, 0, 1)
+        struct.pack_into("<I", block, 2, ROOT_INO)
+        NAT_ENTRY.pack_into(block, 6, 0, ROOT_INO, root_node)
+        # SIT journal: the six current segments, one valid block in the hot ones
+        offset = SUM_JOURNAL_SIZE
+        struct.pack_into("<H", block, offset, CURRENT_SEGMENT_TYPES)
+        offset += 2
+        first_block = b"\x80" + bytes(63)
+        logs = [(segment, 3 + index) for index, segment in enumerate(layout.node_segments)]
+        logs += [(segment, index) for index, segment in enumerate(layout.data_segments)]
+        for segment, log_type in logs:
+            used = 1 if log_type in (0, 3) else 0
+            struct.pack_into("<I", block, offset, segment)
+            SIT_ENTRY.pack_into(block, offset + 4, (log_type << SIT_VBLOCKS_SHIFT) | used,
+                                first_block if used else bytes(64), 0)
+            offset += 4 + SIT_ENTRY.size
+        # Hot data summary: block 0 belongs to the root inode, offset 0
+        SUMMARY.pack_into(block, 2 * SUM_JOURNAL_SIZE, ROOT_INO, 0, 0)
+        return bytes(block)
+
+    @staticmethod
+    def _node_summary(root=False):
+        block = bytearray(BLOCK_SIZE)
+        if root:
+            SUMMARY.pack_into(block, 0, ROOT_INO, 0, 0)
+        block[BLOCK_SIZE - SUMMARY_FOOTER_SIZE] = SUM_TYPE_NODE
+        return bytes(block)
+
+    def _nat_block(self):
+        layout = self.layout
+        block = bytearray(BLOCK_SIZE)
+        # Node and meta inodes are marked in use with a dummy address
+        NAT_ENTRY.pack_into(block, NODE_INO * NAT_ENTRY.size, 0, NODE_INO, 1)
+        NAT_ENTRY.pack_into(block, META_INO * NAT_ENTRY.size, 0, META_INO, 1)
+        NAT_ENTRY.pack_into(block, ROOT_INO * NAT_ENTRY.size, 0, ROOT_INO,
+                            layout.segment_block(layout.node_segments[0]))
+        return bytes(block)
+
+    def _root_inode(self):
+        layout = self.layout
+        node = bytearray(BLOCK_SIZE)
+        inline = 0
+        extra_isize = 0
+        if "extra_attr" in self.features:
+            inline = INLINE_EXTRA_ATTR
+            extra_isize = EXTRA_ISIZE_PROJID if "project_quota" in self.features else EXTRA_ISIZE_BASE
+        now = self.timestamp
+        INODE.pack_into(node, 0, S_IFDIR | 0o755, 0, inline, 0, 0, 2, BLOCK_SIZE, 2,
+                        now, now, now, 0, 0, 0, 0, 1, 0, 0, 0, 0, b"", 0, 0, 0, 0)
+        if extra_isize:
+            # i_extra_isize, i_inline_xattr_size, i_projid (default project 0)
+            struct.pack_into("<HH", node, INODE.size, extra_isize, 0)
+        address = INODE.size + extra_isize
+        struct.pack_into("<I", node, address, layout.segment_block(layout.data_segments[0]))
+        root_node = layout.segment_block(layout.node_segments[0])
+        NODE_FOOTER.pack_into(node, NODE_FOOTER_OFFSET, ROOT_INO, ROOT_INO, 0, 1, root_node + 1)
+        return bytes(node)
+
+    @staticmethod
+    def _root_dentries():
+        block = bytearray(BLOCK_SIZE)
+        # "." and "..", both the root itself; hash 0 like make_f2fs
+        block[0] = 0x03
+        for slot, name in enumerate((b".", b"..")):
+            DIR_ENTRY.pack_into(block, DENTRY_OFFSET + slot * DIR_ENTRY.size, 0, ROOT_INO,
+                                len(name), FILE_TYPE_DIR)
+            offset = FILENAME_OFFSET + slot * SLOT_LENGTH
+            block[offset:offset + len(name)] = name
+        return bytes(block)
+
+    def build(self):
+        """Fill self.blocks (RAW) and self.fills (zero FILL); idempotent"""
+        if self._built:
+            return
+        layout = self.layout
+        sb = self._superblock()
+        block0 = (bytes(SUPERBLOCK_OFFSET) + sb).ljust(BLOCK_SIZE, b"\0")
+        self.blocks[0] = block0
+        self.blocks[1] = block0
+
+        # Checkpoint pack 1: cp, payload, compact data summary, 3 node summaries, cp
+        cp = self._checkpoint(1)
+        start = layout.cp_blkaddr
+        self.blocks[start] = cp
+        if layout.cp_payload:
+            self.fills.append((start + 1, layout.cp_payload))
+        summary = start + 1 + layout.cp_payload
+        self.blocks[summary] = self._compact_summary()
+        self.blocks[summary + 1] = self._node_summary(root=True)
+        self.blocks[summary + 2] = self._node_summary()
+        self.blocks[summary + 3] = self._node_summary()
+        self.blocks[summary + 4] = cp
+        # Pack 2 is valid but older (version 0), the kernel mounts pack 1
+        cp = self._checkpoint(0)
+        start = layout.cp_blkaddr + BLOCKS_PER_SEGMENT
+        self.blocks[start] = cp
+        self.fills.append((start + 1, layout.cp_payload + 4))
+        self.blocks[start + 5 + layout.cp_payload] = cp
+
+        # SIT: the first copy is in use (version bitmaps are zero), all free
+        self.fills.append((layout.sit_blkaddr, layout.segment_count_sit // 2 * BLOCKS_PER_SEGMENT))
+        # NAT: copy 0 of each segment pair is in use, its first block has the
+        # node, meta and root entries
+        self.blocks[layout.nat_blkaddr] = self._nat_block()
+        self.fills.append((layout.nat_blkaddr + 1, BLOCKS_PER_SEGMENT - 1))
+        for pair in range(1, layout.segment_count_nat // 2):
+            self.fills.append((layout.nat_blkaddr + 2 * pair * BLOCKS_PER_SEGMENT, BLOCKS_PER_SEGMENT))
+
+        # Root inode and its only dentry block; the rest of the node logs is
+        # zeroed so roll-forward recovery finds no stale node chain
+        hot_node = layout.segment_block(layout.node_segments[0])
+        self.blocks[hot_node] = self._root_inode()
+        self.fills.append((hot_node + 1, BLOCKS_PER_SEGMENT - 1))
+        for segment in layout.node_segments[1:]:
+            self.fills.append((layout.segment_block(segment), BLOCKS_PER_SEGMENT))
+        self.blocks[layout.segment_block(layout.data_segments[0])] = self._root_dentries()
+        self._built = True
+
+    def chunks(self):
+        """Sparse chunks covering the whole image, in block order"""
+        self.build()
+        return sparse_image.build_chunks(self.blocks, self.fills, self.total_blocks)
+
+    def write(self, out_path, sparse=True):
+        """Write the image; a raw image keeps DONT_CARE areas as holes"""
+        chunks = self.chunks()
+        if sparse:
+            return sparse_image.write_sparse(chunks, out_path, self.block_size, self.total_blocks)
+        sparse_image.write_raw(chunks, out_path, self.block_size, self.total_blocks)
+        return self.total_blocks * self.block_size
+
+
+def make_builder(size, casefold=False, features=ANDROID_FEATURES, label="", fs_uuid=None):
+    return F2fsBuilder(size, features, casefold=casefold, label=label, fs_uuid=fs_uuid)
+
+
+def build_image(out_path, size, casefold=False, features=ANDROID_FEATURES, label="", sparse=True):
+    """Write an empty filesystem of size bytes; returns the file size"""
+    return make_builder(size, casefold, features, label).write(out_path, sparse)
+
+
+def main():
+    """Command line: f2fs_image.py SIZE OUTPUT [-C] [-O feature,...] [-L label] [--raw]
+
+    SIZE in bytes or with a K/M/G/T suffix, e.g. 110G. -C enables casefold
+    (make_f2fs_casefold), -O replaces the Android feature set.
+    """
+    args = sys.argv[1:]
+    casefold = False
+    features = ANDROID_FEATURES
+    label = ""
+    sparse = True
+    positional = []
+    while args:
+        arg = args.pop(0)
+        if arg == "-C":
+            casefold = True
+        elif arg == "-O" and args:
+            features = [name for name in args.pop(0).split(",") if name]
+        elif arg == "-L" and args:
+            label = args.pop(0)
+        elif arg == "--raw":
+            sparse = False
+        else:
+            positional.append(arg)
+    if len(positional) != 2:
+        print(main.__doc__)
+        return 1
+    try:
+        builder = make_builder(parse_size(positional[0]), casefold, features, label)
+        started = time.monotonic()
+        written = builder.write(positional[1], sparse)
+    except (F2fsError, Ext4Error, OSError) as e:
+        print(f"Ошибка: {e}")
+        return 1
+    layout = builder.layout
+    print(f"Возможности: {', '.join(sorted(builder.features))}")
+    print(f"Сегментов: {layout.segment_count}, основных: {layout.segment_count_main}, "
+          f"резерв: {layout.reserved_segments}, overprovision: {layout.overprovision:.2f}%")
+    print(f"Записано {written / 1024 ** 2:.1f} МБ за {time.monotonic() - started:.2f} с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,699 @@
+"""
+Native fastboot protocol client for ProshivkaTool
+
+Talks to the bootloader directly instead of spawning fastboot.exe for every
+step, so one session per device can be kept open for a whole flash plan.
+"""
+import contextlib
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+import compressed_image
+import device_probe
+import ext4_image
+import f2fs_image
+import sparse_image
+
+# Try to import pyusb, the TCP transport works without it
+try:
+    import usb.core
+    import usb.util
+    PYUSB_AVAILABLE = True
+except ImportError:
+    PYUSB_AVAILABLE = False
+
+# USB interface triple used by fastboot (bootloader and fastbootd)
+FASTBOOT_CLASS = 0xFF
+FASTBOOT_SUBCLASS = 0x42
+FASTBOOT_PROTOCOL = 0x03
+
+DEFAULT_TCP_PORT = 5554
+MAX_COMMAND_LENGTH = 4096
+MAX_RESPONSE_LENGTH = 256
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Double-buffered transfers: chunks grow or shrink between these bounds so
+# one chunk takes about TARGET_CHUNK_SECONDS on the wire
+TRANSFER_BUFFERS = 2
+MIN_TRANSFER_CHUNK = 256 * 1024
+MAX_TRANSFER_CHUNK = 16 * 1024 * 1024
+TARGET_CHUNK_SECONDS = 0.1
+# Commands after which partition sizes and types reported by getvar change
+LAYOUT_COMMANDS = ("create-logical-partition", "delete-logical-partition",
+                   "resize-logical-partition", "update-super", "flash:super")
+# Sparse pieces cut from streamed images are held in memory, one being
+# sent and one read ahead, so they are kept well below max-download-size
+STREAM_PIECE_SIZE = 64 * 1024 * 1024
+
+
+class FastbootError(Exception):
+    """Device answered FAIL or broke the protocol"""
+
+
+class FastbootDisconnected(FastbootError):
+    """The link to the device was lost (cable, reboot, USB reset)"""
+
+
+class FastbootTransport:
+    """Base class for a byte pipe to a fastboot device"""
+
+    serial = None
+    # Where the device sits on the bus; it changes when the device is re-enumerated
+    location = None
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def read(self, max_length):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class TcpTransport(FastbootTransport):
+    """Fastboot over TCP (fastboot -s tcp:host:port)"""
+
+    def __init__(self, host, port=DEFAULT_TCP_PORT, timeout=30):
+        self.serial = f"tcp:{host}:{port}"
+        self.location = self.serial
+        try:
+            self.sock = socket.create_connection((host, port), timeout=timeout)
+        except OSError as e:
+            raise FastbootDisconnected(f"Нет соединения с {self.serial}: {e}") from e
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._pending = 0
+        self._handshake()
+
+    def _handshake(self):
+        self.sock.sendall(b"FB01")
+        reply = self._recv_exact(4)
+        if reply[:2] != b"FB":
+            raise FastbootError(f"Неверный ответ на рукопожатие: {reply!r}")
+
+    def _recv_exact(self, length):
+        buffer = bytearray(length)
+        view = memoryview(buffer)
+        received = 0
+        while received < length:
+            try:
+                count = self.sock.recv_into(view[received:])
+            except OSError as e:
+                raise FastbootDisconnected(f"Соединение с устройством потеряно: {e}") from e
+            if not count:
+                raise FastbootDisconnected("Соединение с устройством закрыто")
+            received += count
+        return bytes(buffer)
+
+    def write(self, data):
+        try:
+            self.sock.sendall(struct.pack(">Q", len(data)))
+            self.sock.sendall(data)
+        except OSError as e:
+            raise FastbootDisconnected(f"Соединение с устройством потеряно: {e}") from e
+
+    def read(self, max_length):
+        # Every message is framed with a 64-bit length, a frame may be
+        # consumed over several reads
+        if not self._pending:
+            self._pending = struct.unpack(">Q", self._recv_exact(8))[0]
+        length = min(max_length, self._pending)
+        data = self._recv_exact(length)
+        self._pending -= length
+        return data
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class UsbTransport(FastbootTransport):
+    """Fastboot over USB bulk endpoints (requires pyusb)"""
+
+    def __init__(self, device, timeout=30000):
+        if not PYUSB_AVAILABLE:
+            raise FastbootError("pyusb не установлен")
+        self.device = device
+        self.timeout = timeout
+        self.interface = _find_fastboot_interface(device)
+        if self.interface is None:
+            raise FastbootError("У устройства нет интерфейса fastboot")
+        try:
+            if device.is_kernel_driver_active(self.interface.bInterfaceNumber):
+                device.detach_kernel_driver(self.interface.bInterfaceNumber)
+        except (NotImplementedError, usb.core.USBError):
+            pass
+        usb.util.claim_interface(device, self.interface.bInterfaceNumber)
+        self.ep_out = usb.util.find_descriptor(
+            self.interface,
+            custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
+        self.ep_in = usb.util.find_descriptor(
+            self.interface,
+            custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN)
+        self.serial = _usb_serial(device)
+        self.location = f"usb:{device.bus}:{device.address}"
+
+    def write(self, data):
+        try:
+            self.ep_out.write(data, self.timeout)
+        except usb.core.USBError as e:
+            raise FastbootDisconnected(f"Ошибка USB: {e}") from e
+
+    def read(self, max_length):
+        try:
+            return bytes(self.ep_in.read(max_length, self.timeout))
+        except usb.core.USBError as e:
+            raise FastbootDisconnected(f"Ошибка USB: {e}") from e
+
+    def close(self):
+        try:
+            usb.util.release_interface(self.device, self.interface.bInterfaceNumber)
+            usb.util.dispose_resources(self.device)
+        except usb.core.USBError:
+            pass
+
+
+def _find_fastboot_interface(device):
+    """Return the fastboot interface of a USB device or None"""
+    for config in device:
+        for interface in config:
+            if (interface.bInterfaceClass == FASTBOOT_CLASS and
+                    interface.bInterfaceSubClass == FASTBOOT_SUBCLASS and
+                    interface.bInterfaceProtocol == FASTBOOT_PROTOCOL):
+                return interface
+    return None
+
+
+def _usb_serial(device):
+    try:
+        return usb.util.get_string(device, device.iSerialNumber)
+    except (usb.core.USBError, ValueError):
+        return None
+
+
+def list_usb_devices():
+    """List serial numbers of devices in fastboot mode"""
+    if not PYUSB_AVAILABLE:
+        return []
+    try:
+        devices = list(usb.core.find(find_all=True))
+    except (usb.core.NoBackendError, ValueError, OSError):
+        # pyusb without libusb: no way to scan the bus
+        return []
+    serials = []
+    for device in devices:
+        try:
+            if _find_fastboot_interface(device) is None:
+                continue
+        except usb.core.USBError:
+            continue
+        serial = _usb_serial(device)
+        if serial:
+            serials.append(serial)
+    return serials
+
+
+def open_transport(serial=None):
+    """Open a transport by serial: 'tcp:host[:port]' or a USB serial number"""
+    if serial and serial.startswith("tcp:"):
+        host, _, port = serial[4:].partition(":")
+        return TcpTransport(host, int(port) if port else DEFAULT_TCP_PORT)
+
+    if not PYUSB_AVAILABLE:
+        raise FastbootError("pyusb не установлен, USB-устройства недоступны")
+    for device in usb.core.find(find_all=True):
+        try:
+            if _find_fastboot_interface(device) is None:
+                continue
+        except usb.core.USBError:
+            continue
+        if serial is None or _usb_serial(device) == serial:
+            return UsbTransport(device)
+    raise FastbootError(f"Устройство в режиме fastboot не найдено: {serial or 'любое'}")
+
+
+class TransferPipeline:
+    """Double-buffered sender for one download
+
+    A reader thread fills preallocated buffers from a file (readinto) or
+    from an iterable of bytes-like chunks (mapped image pieces, decompressed
+    data) while the calling thread writes the previous buffer to the
+    transport, so disk reads and page faults never stall the link. The
+    chunk size adapts to the measured link speed.
+    """
+
+    def __init__(self, write, buffers=TRANSFER_BUFFERS, buffer_size=MAX_TRANSFER_CHUNK):
+        self.write = write
+        self.buffers = [bytearray(buffer_size) for _ in range(buffers)]
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        self.rate = 0.0
+
+    def _adapt(self, length, seconds):
+        if seconds <= 0:
+            return
+        rate = length / seconds
+        self.rate = rate if not self.rate else self.rate * 0.7 + rate * 0.3
+        target = int(self.rate * TARGET_CHUNK_SECONDS) // MIN_TRANSFER_CHUNK * MIN_TRANSFER_CHUNK
+        self.chunk_size = max(MIN_TRANSFER_CHUNK, min(target, len(self.buffers[0])))
+
+    def _fill(self, source, free, filled, stop):
+        try:
+            if hasattr(source, "readinto"):
+                while not stop.is_set():
+                    buffer = free.get()
+                    if buffer is None:
+                        return
+                    count = source.readinto(buffer[:self.chunk_size])
+                    filled.put((buffer, count))
+                    if not count:
+                        return
+                return
+            pieces = iter(source.read, b"") if hasattr(source, "read") else iter(source)
+            pending = None
+            while not stop.is_set():
+                buffer = free.get()
+                if buffer is None:
+                    return
+                limit = self.chunk_size
+                count = 0
+                while count < limit:
+                    if pending is None or not pending.nbytes:
+                        piece = next(pieces, None)
+                        if piece is None:
+                            break
+                        pending = memoryview(piece).cast("B")
+                    take = min(limit - count, pending.nbytes)
+                    buffer[count:count + take] = pending[:take]
+                    pending = pending[take:]
+                    count += take
+                filled.put((buffer, count))
+                if not count:
+                    return
+        except Exception as e:
+            filled.put((None, e))
+
+    def send(self, source, size, progress=None):
+        """Send exactly size bytes of source, returns seconds spent"""
+        free = queue.Queue()
+        filled = queue.Queue()
+        stop = threading.Event()
+        for buffer in self.buffers:
+            free.put(memoryview(buffer))
+        reader = threading.Thread(target=self._fill, args=(source, free, filled, stop),
+                                  daemon=True, name="transfer-reader")
+        reader.start()
+        started = time.monotonic()
+        sent = 0
+        try:
+            while True:
+                buffer, count = filled.get()
+                if buffer is None:
+                    raise count
+                if not count:
+                    break
+                if sent + count > size:
+                    raise FastbootError("Источник длиннее заявленного размера")
+                chunk_started = time.monotonic()
+                self.write(buffer[:count])
+                self._adapt(count, time.monotonic() - chunk_started)
+                free.put(buffer)
+                sent += count
+                if progress:
+                    progress(sent, size)
+                if sent == size:
+                    break
+        finally:
+            stop.set()
+            free.put(None)
+            reader.join()
+        if sent != size:
+            raise FastbootError(f"Передано {sent} байт из {size}")
+        return time.monotonic() - started
+
+
+def _read_ahead(iterable, depth=1):
+    """Yield items of iterable produced on a background thread
+
+    At most depth items wait ahead of the consumer, so reading and
+    decompressing the next piece overlaps the transfer of the current one.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            items.put((done, None))
+        except Exception as e:
+            items.put((done, e))
+
+    thread = threading.Thread(target=produce, daemon=True, name="read-ahead")
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        # Unblock a producer waiting on a full queue
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.5)
+            except queue.Empty:
+                pass
+
+
+class FastbootClient:
+    """One open fastboot session to a single device"""
+
+    def __init__(self, transport, info_callback=None):
+        self.transport = transport
+        self.serial = transport.serial
+        self.info_callback = info_callback
+        self.lock = threading.Lock()
+        self._variables = {}
+        self._pipeline = None
+        # Bytes and seconds of all downloads, MB/s of the last flash per partition
+        self.transferred = [0, 0.0]
+        self.partition_rates = {}
+
+    @classmethod
+    def connect(cls, serial=None, info_callback=None):
+        """Open a session to the device with the given serial"""
+        return cls(open_transport(serial), info_callback)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.transport.close()
+
+    def _send_command(self, command):
+        data = command.encode("ascii")
+        if len(data) > MAX_COMMAND_LENGTH:
+            raise FastbootError(f"Слишком длинная команда: {command[:40]}...")
+        self.transport.write(data)
+
+    def _read_response(self, info_lines=None):
+        """Read replies until OKAY/FAIL/DATA, return (status, payload)"""
+        while True:
+            reply = self.transport.read(MAX_RESPONSE_LENGTH)
+            if len(reply) < 4:
+                raise FastbootError(f"Некорректный ответ устройства: {reply!r}")
+            status = reply[:4]
+            payload = reply[4:].decode("ascii", errors="replace")
+            if status in (b"INFO", b"TEXT"):
+                if info_lines is not None:
+                    info_lines.append(payload)
+                if self.info_callback:
+                    self.info_callback(payload)
+                continue
+            if status == b"OKAY" or status == b"DATA":
+                return status.decode(), payload
+            if status == b"FAIL":
+                raise FastbootError(payload or "FAIL")
+            raise FastbootError(f"Неизвестный ответ устройства: {reply!r}")
+
+    def command(self, command, info_lines=None):
+        """Send a simple command and return the OKAY payload"""
+        with self.lock:
+            self._send_command(command)
+            status, payload = self._read_response(info_lines)
+            if status != "OKAY":
+                raise FastbootError(f"Неожиданный ответ {status} на {command}")
+        self._track(command)
+        return payload
+
+    def _track(self, command):
+        """Keep the cached probe in step with commands that change the device"""
+        if command.startswith(("reboot", "continue")) or command.startswith(LAYOUT_COMMANDS):
+            self._variables.clear()
+            device_probe.cache.invalidate(self.serial)
+        elif command.startswith("set_active:"):
+            info = device_probe.cache.get(self.serial, self.transport.location)
+            if info:
+                info.set_current_slot(command.split(":", 1)[1])
+
+    def probe(self, refresh=False):
+        """DeviceInfo from one getvar all, cached per serial until reboot
+
+        Bootloaders without getvar all are asked for the essential
+        variables one by one instead.
+        """
+        info = None if refresh else device_probe.cache.get(self.serial, self.transport.location)
+        if info is not None:
+            return info
+        lines = []
+        try:
+            self.command("getvar:all", info_lines=lines)
+            variables = device_probe.parse_getvar_all(lines)
+        except FastbootError:
+            variables = {}
+        if not variables:
+            for name in device_probe.ESSENTIAL_VARIABLES:
+                try:
+                    variables[name] = self.command(f"getvar:{name}")
+                except FastbootError:
+                    pass
+        info = device_probe.DeviceInfo(self.serial, variables)
+        device_probe.cache.put(self.serial, self.transport.location, info)
+        return info
+
+    def getvar(self, name):
+        """Read a bootloader variable, from the probe when it has it"""
+        if name in self._variables:
+            return self._variables[name]
+        info = device_probe.cache.get(self.serial, self.transport.location)
+        if info is not None and name in info.variables:
+            return info.variables[name]
+        value = self.command(f"getvar:{name}")
+        # Values that change at runtime are not cached
+        if name not in ("current-slot", "all"):
+            self._variables[name] = value
+        return value
+
+    def max_download_size(self):
+        """Largest payload accepted by one download command"""
+        try:
+            return int(self.getvar("max-download-size"), 0)
+        except (FastbootError, ValueError):
+            return 512 * 1024 * 1024
+
+    def download(self, source, size=None, progress=None):
+        """Send a payload to the device
+
+        source may be bytes-like, a readable file object or an iterable of
+        bytes-like chunks. size is required for the last two.
+        """
+        in_memory = isinstance(source, (bytes, bytearray, memoryview))
+        if in_memory:
+            view = memoryview(source).cast("B")
+            size = view.nbytes
+        if size is None:
+            raise FastbootError("Для потоковой загрузки нужен размер")
+        if size > 0xFFFFFFFF:
+            raise FastbootError("Образ больше 4 ГБ нужно разбивать на части")
+
+        with self.lock:
+            self._send_command(f"download:{size:08x}")
+            status, payload = self._read_response()
+            if status != "DATA":
+                raise FastbootError(f"Устройство не готово к приёму данных: {status}")
+            accepted = int(payload, 16)
+            if accepted != size:
+                raise FastbootError(f"Устройство приняло {accepted} байт вместо {size}")
+
+            if in_memory:
+                # Already in memory, nothing to read ahead
+                started = time.monotonic()
+                for offset in range(0, size, DEFAULT_CHUNK_SIZE):
+                    self.transport.write(view[offset:offset + DEFAULT_CHUNK_SIZE])
+                    if progress:
+                        progress(min(offset + DEFAULT_CHUNK_SIZE, size), size)
+                seconds = time.monotonic() - started
+            else:
+                if self._pipeline is None:
+                    self._pipeline = TransferPipeline(self.transport.write)
+                seconds = self._pipeline.send(source, size, progress)
+            self.transferred[0] += size
+            self.transferred[1] += seconds
+            self._read_response()
+
+    @contextlib.contextmanager
+    def _measure(self, partition):
+        """Record the sustained download rate of one partition in MB/s"""
+        size, seconds = self.transferred
+        yield
+        size = self.transferred[0] - size
+        seconds = self.transferred[1] - seconds
+        if size and seconds > 0:
+            self.partition_rates[partition] = size / seconds / 1024 ** 2
+
+    def flash(self, partition, source=None, size=None, progress=None):
+        """Download source (if given) and flash it to partition"""
+        if source is not None:
+            with self._measure(partition):
+                self.download(source, size, progress)
+        return self.command(f"flash:{partition}")
+
+    def flash_file(self, partition, path, progress=None):
+        """Flash an image file that fits into one download"""
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            return self.flash(partition, f, size, progress)
+
+    def flash_image(self, partition, path, progress=None):
+        """Flash a raw or sparse image of any size
+
+        Images larger than max-download-size are split into sparse pieces
+        that are streamed from the mapped file straight into the transfer.
+        Compressed images (.img.xz/.zst/.lz4/.gz) are decompressed on
+        background threads while they are sent.
+        """
+        if compressed_image.is_compressed(path):
+            size = compressed_image.stored_size(path)
+            if (size is None and not self.probe().partition_size(partition)
+                    and not compressed_image.is_sparse(path)):
+                # A raw image with nothing else to size it by is counted first
+                size = compressed_image.uncompressed_size(path)
+            with compressed_image.DecompressedReader(path, size=size) as reader:
+                return self.flash_stream(partition, reader, size, progress)
+        max_size = self.max_download_size()
+        with sparse_image.SparseImage(path) as image:
+            if not image.sparse and image.size <= max_size:
+                return self.flash_file(partition, path, progress)
+            return self.flash_chunks(partition, image.chunks(), image.block_size,
+                                     image.total_blocks, progress)
+
+    def flash_chunks(self, partition, chunks, block_size, total_blocks, progress=None):
+        """Flash an image given as sparse chunks
+
+        The chunks are split into sparse pieces of at most
+        max-download-size; RAW data is sent from wherever the chunks point
+        (a mapped file or a generated filesystem) without an image file.
+        """
+        pieces = sparse_image.split_plan(chunks, block_size, total_blocks, self.max_download_size())
+        sizes = [piece.size for piece in pieces]
+        total = sum(sizes)
+        done = 0
+        with self._measure(partition):
+            for piece, size in zip(pieces, sizes):
+                reporter = None
+                if progress:
+                    reporter = lambda sent, _, base=done: progress(base + sent, total)
+                self.download(piece.iter_bytes(), size, reporter)
+                self.command(f"flash:{partition}")
+                done += size
+
+    def flash_stream(self, partition, stream, size, progress=None):
+        """Flash an image read front to back from a stream
+
+        For archive members and decompressors: an image that fits into one
+        download is passed through unchanged, a larger one is cut into
+        sparse pieces of STREAM_PIECE_SIZE while it is read, the next piece
+        being read on a background thread during the current transfer.
+        With size None the image is always cut into pieces; a raw one then
+        spans the partition, the blocks past its end being DONT_CARE.
+        """
+        max_size = self.max_download_size()
+        image = sparse_image.StreamImage(stream, size)
+        if size is None and not image.sparse:
+            partition_size = self.probe().partition_size(partition)
+            if not partition_size:
+                raise FastbootError(f"Неизвестен размер образа для раздела {partition}")
+            image.total_blocks = -(-partition_size // image.block_size)
+        if size is not None and size <= max_size:
+            return self.flash(partition, image.iter_bytes(), size, progress)
+        block_size = image.block_size
+        total = image.total_blocks * block_size
+        pieces = sparse_image.iter_split(image.chunks(), block_size, image.total_blocks,
+                                         min(max_size, STREAM_PIECE_SIZE))
+        with self._measure(partition):
+            for piece in _read_ahead(pieces):
+                self.download(piece.iter_bytes(), piece.size)
+                self.command(f"flash:{partition}")
+                if progress and piece.chunks:
+                    last = piece.chunks[-1]
+                    progress((last.start + last.blocks) * block_size, total)
+
+    def format(self, partition, fs_type=None, casefold=False, progress=None, cache=None):
+        """Write an empty filesystem built on the host, like fastboot format
+
+        Size and type come from getvar partition-size / partition-type
+        (fs_type overrides the latter). Only the filesystem metadata is
+        transferred, the rest of the partition is DONT_CARE. With a
+        BlankImageCache the image is generated once per size and profile
+        and flashed from disk afterwards.
+        """
+        info = self.probe()
+        size = info.partition_size(partition)
+        if not size:
+            raise FastbootError(f"Устройство не сообщает размер раздела {partition}")
+        fs_type = fs_type or info.partition_type(partition)
+        if cache is not None and fs_type in ("f2fs", "ext4"):
+            try:
+                path = cache.get_or_build(fs_type, size, casefold)
+            except (OSError, f2fs_image.F2fsError, ext4_image.Ext4Error) as e:
+                raise FastbootError(f"{partition}: {e}") from e
+            return self.flash_image(partition, path, progress)
+        try:
+            if fs_type == "f2fs":
+                builder = f2fs_image.make_builder(size, casefold=casefold)
+            elif fs_type == "ext4":
+                builder = ext4_image.make_builder(size)
+            else:
+                raise FastbootError(f"Форматирование раздела {partition} в {fs_type or '?'} не поддерживается")
+            chunks = builder.chunks()
+        except (f2fs_image.F2fsError, ext4_image.Ext4Error) as e:
+            raise FastbootError(f"{partition}: {e}") from e
+        return self.flash_chunks(partition, chunks, builder.block_size, builder.total_blocks, progress)
+
+    def update_super(self, metadata_image, wipe=False):
+        """Replace the logical partition table in one transfer (fastbootd)
+
+        metadata_image is a super_empty.img blob. fastbootd keeps the other
+        slot's partitions unless wipe is set.
+        """
+        super_name = self.probe().variables.get("super-partition-name") or "super"
+        self.download(metadata_image)
+        return self.command(f"update-super:{super_name}" + (":wipe" if wipe else ""))
+
+    def erase(self, partition):
+        return self.command(f"erase:{partition}")
+
+    def set_active(self, slot):
+        self._variables.clear()
+        return self.command(f"set_active:{slot}")
+
+    def oem(self, *args):
+        return self.command("oem " + " ".join(args))
+
+    def reboot(self, target=None):
+        """Reboot to system, or to 'bootloader'/'fastboot'/'recovery'"""
+        self._variables.clear()
+        return self.command(f"reboot-{target}" if target else "reboot")
+
+    def continue_boot(self):
+        self._variables.clear()
+        return self.command("continue")
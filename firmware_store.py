@@ -0,0 +1,438 @@
+"""
+Content-addressed firmware image store for ProshivkaTool
+
+Images are stored once under their SHA-256, every firmware version is a
+manifest of relative paths pointing into the store. Byte-identical
+partitions shared by several HyperOS/MIUI versions take disk space once,
+and a disk quota evicts the blobs that were flashed least recently.
+
+The firmware tree itself is migrated in place: adopt() takes the images of
+a version directory into the store and leaves hardlinks to the blobs
+behind, so the .bat scripts keep working while duplicates share one copy.
+The flash path marks the blobs it flashes with touch_paths().
+
+The quota (settings.json in the store, set with the "quota" command)
+counts the space only the store holds: a blob hardlinked into the tree
+shares the tree file's space. Eviction removes a blob only when another
+copy of its content still exists outside the store (a tree file or the
+directory it was imported from); firmware tree files are never deleted.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+from ext4_image import Ext4Error, parse_size
+from image_verify import find_images
+
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def hash_file(path):
+    """SHA-256 of a file as hex"""
+    digest = hashlib.sha256()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            digest.update(view[:count])
+    return digest.hexdigest()
+
+
+def _write_json(path, data):
+    """Write JSON atomically so a crash never leaves a torn index"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _read_json(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+class FirmwareStore:
+    """Blobs keyed by hash plus per-version manifests"""
+
+    def __init__(self, root, quota=None):
+        self.root = root
+        self.blob_dir = os.path.join(root, "blobs")
+        self.manifest_dir = os.path.join(root, "manifests")
+        self.index_path = os.path.join(root, "index.json")
+        self.settings_path = os.path.join(root, "settings.json")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        # sha256 -> {"size": bytes, "last_used": unix time}
+        self.index = _read_json(self.index_path, {})
+        self.quota = quota if quota is not None else _read_json(self.settings_path, {}).get("quota")
+
+    def set_quota(self, quota):
+        """Store the quota in settings.json (None removes it) and apply it"""
+        settings = _read_json(self.settings_path, {})
+        settings["quota"] = quota
+        _write_json(self.settings_path, settings)
+        self.quota = quota
+        return self.enforce_quota()
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def has_blob(self, digest):
+        return digest in self.index and os.path.exists(self.blob_path(digest))
+
+    def _manifest_path(self, version):
+        return os.path.join(self.manifest_dir, f"{version}.json")
+
+    def _save_index(self):
+        _write_json(self.index_path, self.index)
+
+    def add_file(self, path, move=False, digest=None, link=False, copied=None):
+        """Put a file into the store and return its hash
+
+        With link the blob is a hardlink to path when the volume allows it;
+        otherwise it is a copy and path is appended to the copied list.
+        """
+        digest = digest or hash_file(path)
+        with self.lock:
+            if self.has_blob(digest):
+                if move:
+                    os.remove(path)
+                self.index[digest]["last_used"] = time.time()
+                return digest
+        target = self.blob_path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_target = target + ".tmp"
+        if move:
+            shutil.move(path, tmp_target)
+        elif link:
+            try:
+                os.link(path, tmp_target)
+            except OSError:
+                shutil.copyfile(path, tmp_target)
+                if copied is not None:
+                    copied.append(path)
+        else:
+            shutil.copyfile(path, tmp_target)
+        os.replace(tmp_target, target)
+        with self.lock:
+            self.index[digest] = {"size": os.path.getsize(target), "last_used": time.time()}
+            self._save_index()
+        return digest
+
+    def import_version(self, version, directory, move=False):
+        """Store every file under directory as the manifest of version"""
+        files = {}
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                relative = os.path.relpath(path, directory).replace(os.sep, "/")
+                size = os.path.getsize(path)
+                files[relative] = {"sha256": self.add_file(path, move), "size": size}
+        manifest = {"version": version, "files": files}
+        if not move:
+            # The originals stay in place, eviction may count on them
+            manifest["source"] = os.path.abspath(directory)
+        _write_json(self._manifest_path(version), manifest)
+        self.enforce_quota()
+        return files
+
+    def versions(self):
+        return sorted(name[:-5] for name in os.listdir(self.manifest_dir)
+                      if name.endswith(".json"))
+
+    def manifest(self, version):
+        """{relative path: {"sha256", "size"}} of a version"""
+        data = _read_json(self._manifest_path(version), None)
+        if data is None:
+            raise FileNotFoundError(f"Версия отсутствует в хранилище: {version}")
+        return data["files"]
+
+    def missing(self, version):
+        """Relative paths of a version whose blobs were evicted"""
+        return [relative for relative, entry in self.manifest(version).items()
+                if not self.has_blob(entry["sha256"])]
+
+    def open_image(self, version, relative):
+        """Blob path of one file of a version, marked as used"""
+        entry = self.manifest(version).get(relative)
+        if entry is None or not self.has_blob(entry["sha256"]):
+            raise FileNotFoundError(f"Образ отсутствует в хранилище: {version}/{relative}")
+        self.touch(entry["sha256"])
+        return self.blob_path(entry["sha256"])
+
+    def touch(self, *digests):
+        """Mark blobs as just flashed"""
+        now = time.time()
+        with self.lock:
+            known = [digest for digest in digests if digest in self.index]
+            for digest in known:
+                self.index[digest]["last_used"] = now
+            if known:
+                self._save_index()
+
+    @staticmethod
+    def _link(source, destination, copy=True):
+        """Make destination a hardlink of source, replacing it atomically"""
+        if os.path.exists(destination) and os.path.samefile(source, destination):
+            return
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        tmp_path = destination + ".tmp"
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            if not copy:
+                # Another volume: the file stays a copy of its own
+                return
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, destination)
+
+    def checkout(self, version, target, replace=True):
+        """Recreate the version's directory tree, hardlinking blobs
+
+        Without replace only missing files are restored, files present in
+        target are left alone.
+        """
+        for relative, entry in self.manifest(version).items():
+            source = self.blob_path(entry["sha256"])
+            destination = os.path.join(target, *relative.split("/"))
+            if not replace and os.path.exists(destination):
+                continue
+            if not os.path.exists(source):
+                raise FileNotFoundError(f"Образ вытеснен из хранилища: {version}/{relative}")
+            self._link(source, destination)
+            self.touch(entry["sha256"])
+
+    def adopt(self, version, directory, digests, copied=None):
+        """Migrate the images of a firmware directory into the store in place
+
+        digests is {path: sha256} of the images (from image verification, so
+        nothing is hashed twice). Each image becomes a hardlink to its blob
+        and the manifest remembers directory, so touch_paths() and eviction
+        find the tree files again. Images that could not be hardlinked
+        (store on another volume, FAT32) are stored as copies and listed in
+        copied, which doubles their disk use.
+        """
+        directory = os.path.abspath(directory)
+        try:
+            files = self.manifest(version)
+        except FileNotFoundError:
+            files = {}
+        for path, digest in digests.items():
+            path = os.path.abspath(path)
+            relative = os.path.relpath(path, directory).replace(os.sep, "/")
+            if relative.startswith("../"):
+                continue
+            digest = self.add_file(path, digest=digest, link=True, copied=copied)
+            self._link(self.blob_path(digest), path, copy=False)
+            if (copied is not None and path not in copied
+                    and not os.path.samefile(self.blob_path(digest), path)):
+                # A duplicate that could not be replaced by a link
+                copied.append(path)
+            files[relative] = {"sha256": digest, "size": os.path.getsize(path)}
+        _write_json(self._manifest_path(version),
+                    {"version": version, "files": files, "directory": directory})
+        self.enforce_quota()
+        return files
+
+    def _tree_files(self, key="directory"):
+        """{path: sha256} of every adopted directory (or import source with key="source")"""
+        files = {}
+        for version in self.versions():
+            data = _read_json(self._manifest_path(version), None)
+            directory = data and data.get(key)
+            if not directory:
+                continue
+            for relative, entry in data["files"].items():
+                path = os.path.join(directory, *relative.split("/"))
+                files[path] = entry["sha256"]
+        return files
+
+    def references(self, directory):
+        """{abs path: sha256} recorded for the files under directory"""
+        prefix = os.path.normcase(os.path.join(os.path.abspath(directory), ""))
+        return {path: digest for path, digest in self._tree_files().items()
+                if os.path.normcase(path).startswith(prefix)}
+
+    def touch_paths(self, paths):
+        """Mark the blobs behind flashed tree files as just flashed"""
+        files = {os.path.normcase(path): digest for path, digest in self._tree_files().items()}
+        digests = {files.get(os.path.normcase(os.path.abspath(path))) for path in paths}
+        digests.discard(None)
+        self.touch(*digests)
+        return digests
+
+    def total_size(self):
+        with self.lock:
+            return sum(entry["size"] for entry in self.index.values())
+
+    def _own_size(self, digest, entry):
+        """Bytes the blob occupies on its own, 0 when it shares a tree file's inode"""
+        try:
+            return entry["size"] if os.stat(self.blob_path(digest)).st_nlink == 1 else 0
+        except FileNotFoundError:
+            return 0
+
+    def own_size(self):
+        """Disk space held only by the store, what the quota limits"""
+        with self.lock:
+            entries = list(self.index.items())
+        return sum(self._own_size(digest, entry) for digest, entry in entries)
+
+    def _copy_elsewhere(self, digest, size, paths):
+        """A file outside the store with the blob's content, or None"""
+        blob = self.blob_path(digest)
+        for path in paths:
+            try:
+                if os.path.samefile(path, blob) or os.path.getsize(path) != size:
+                    continue
+                if hash_file(path) == digest:
+                    return path
+            except OSError:
+                continue
+        return None
+
+    def enforce_quota(self, quota=None):
+        """Evict least recently flashed blobs until the store fits the quota
+
+        Only blobs whose content survives elsewhere are evicted; the
+        remaining ones are kept even when the quota can not be met.
+        """
+        quota = quota if quota is not None else self.quota
+        if quota is None:
+            return []
+        copies = {}
+        for key in ("directory", "source"):
+            for path, digest in self._tree_files(key).items():
+                copies.setdefault(digest, []).append(path)
+        with self.lock:
+            entries = sorted(self.index.items(), key=lambda item: item[1]["last_used"])
+        used = sum(self._own_size(digest, entry) for digest, entry in entries)
+        evicted = []
+        for digest, entry in entries:
+            if used <= quota:
+                break
+            size = self._own_size(digest, entry)
+            # A hardlinked blob frees nothing, an only copy must stay
+            if not size or self._copy_elsewhere(digest, size, copies.get(digest, ())) is None:
+                continue
+            with self.lock:
+                try:
+                    os.remove(self.blob_path(digest))
+                except FileNotFoundError:
+                    pass
+                self.index.pop(digest, None)
+                self._save_index()
+            used -= size
+            evicted.append(digest)
+        return evicted
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_store(root, quota=None):
+    """One FirmwareStore per directory for the whole process
+
+    The index lives in memory, separate instances would overwrite each
+    other's last_used updates.
+    """
+    root = os.path.abspath(root)
+    with _shared_lock:
+        if root not in _shared:
+            _shared[root] = FirmwareStore(root, quota)
+        return _shared[root]
+
+
+def tree_version(base_path, directory):
+    """Store version name of a firmware directory under base_path"""
+    relative = os.path.relpath(os.path.abspath(directory), os.path.abspath(base_path))
+    return relative.replace(os.sep, "_").replace("/", "_")
+
+
+def migrate_tree(store, base_path, progress=None, copied=None):
+    """Adopt every folder of base_path holding .bat scripts; {version: files}
+
+    Images that had to be copied instead of hardlinked are appended to copied.
+    """
+    versions = {}
+    store_root = os.path.abspath(store.root)
+    folders = []
+    for dirpath, dirnames, filenames in os.walk(base_path):
+        # The store and the caches are not firmware
+        dirnames[:] = [name for name in dirnames
+                       if os.path.abspath(os.path.join(dirpath, name)) != store_root
+                       and name != "cache"]
+        if any(name.lower().endswith(".bat") for name in filenames):
+            folders.append(dirpath)
+    for number, folder in enumerate(folders, 1):
+        digests = {path: hash_file(path) for path in find_images(folder)}
+        if digests:
+            version = tree_version(base_path, folder)
+            versions[version] = store.adopt(version, folder, digests, copied)
+        if progress:
+            progress(number, len(folders))
+    return versions
+
+
+def main():
+    """Command line: firmware_store.py STORE import VERSION DIR | checkout VERSION DIR |
+    migrate BASE | quota SIZE|off | list"""
+    if len(sys.argv) < 3:
+        print(main.__doc__)
+        return 1
+    store = FirmwareStore(sys.argv[1])
+    command = sys.argv[2]
+    if command == "quota" and len(sys.argv) == 4:
+        try:
+            quota = None if sys.argv[3] == "off" else parse_size(sys.argv[3])
+        except Ext4Error as e:
+            print(f"Ошибка: {e}")
+            return 1
+        evicted = store.set_quota(quota)
+        print(f"Вытеснено образов: {len(evicted)}, занято хранилищем: "
+              f"{store.own_size() / 1024 ** 3:.2f} ГБ")
+        return 0
+    if command == "import" and len(sys.argv) == 5:
+        files = store.import_version(sys.argv[3], sys.argv[4])
+        print(f"Импортировано файлов: {len(files)}")
+    elif command == "checkout" and len(sys.argv) == 5:
+        store.checkout(sys.argv[3], sys.argv[4])
+    elif command == "migrate" and len(sys.argv) == 4:
+        copied = []
+        versions = migrate_tree(store, sys.argv[3], copied=copied)
+        print(f"Перенесено версий: {len(versions)}, занято: {store.total_size() / 1024 ** 3:.2f} ГБ")
+        if copied:
+            print(f"Жёсткие ссылки недоступны, образы скопированы (место не сэкономлено): "
+                  f"{len(copied)}")
+            for path in copied:
+                print(f"  {path}")
+    elif command == "list":
+        for version in store.versions():
+            missing = store.missing(version)
+            print(f"{version}{' (неполная)' if missing else ''}")
+        print(f"Занято: {store.total_size() / 1024 ** 3:.2f} ГБ, "
+              f"из них только в хранилище: {store.own_size() / 1024 ** 3:.2f} ГБ")
+        if store.quota is not None:
+            print(f"Квота: {store.quota / 1024 ** 3:.2f} ГБ")
+    else:
+        print(main.__doc__)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+Flash checkpoint journal for ProshivkaTool
+
+Every completed step of a flash plan is appended to a per-serial journal
+and fsync'ed before the next step starts. A run interrupted by a dropped
+cable or a crashed PC can then continue from the first unfinished step of
+the same script instead of starting over. Each record also keeps the slot
+and mode (bootloader / fastbootd) the device was in, so a resumed run can
+put the device back into that state first.
+
+The journal is one JSON object per line: a header naming the plan, then
+one line per completed step. A torn last line (power loss mid-write) is
+ignored. The file is removed when the plan finishes.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+
+JOURNAL_FORMAT = 2
+# Progress older than this is not resumed, the device was likely used since
+MAX_JOURNAL_AGE = 7 * 24 * 3600
+
+
+class JournalState:
+    """Where an interrupted run stopped"""
+
+    def __init__(self, completed, slot=None, userspace=False, updated=None):
+        # Number of leading plan steps that finished
+        self.completed = completed
+        self.slot = slot
+        self.userspace = userspace
+        self.updated = updated
+
+    def __repr__(self):
+        return f"JournalState(completed={self.completed}, slot={self.slot!r}, userspace={self.userspace})"
+
+
+def _safe_name(serial):
+    """Serial usable as a file name on Windows ("tcp:host:port" has colons)"""
+    return re.sub(r"[^\w.-]", "_", serial) or "device"
+
+
+def plan_key(plan):
+    """Identity of a plan run: script text, script location and the images it flashes
+
+    The same Оригинал.bat sits in every version folder, so the script hash
+    alone would let a run of one version resume with another.
+    """
+    digest = hashlib.sha256(plan.script_hash.encode())
+    digest.update(os.path.normcase(os.path.abspath(plan.script_path)).encode("utf-8"))
+    for step in plan.steps:
+        if step.image:
+            digest.update(b"\0" + os.path.normcase(os.path.abspath(step.image)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class FlashJournal:
+    """Durable log of completed plan steps for one device"""
+
+    def __init__(self, journal_dir, serial):
+        self.journal_dir = journal_dir
+        self.serial = serial
+        self.path = os.path.join(journal_dir, f"{_safe_name(serial)}.jsonl")
+        self._file = None
+
+    def _records(self):
+        """(records, bytes of the file that hold complete lines)"""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return [], 0
+        records = []
+        valid = 0
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Only the last line can be torn, everything after it is lost anyway
+                break
+            valid += len(line)
+        return records, valid
+
+    def load(self, plan):
+        """JournalState of an unfinished run of plan on this device, or None"""
+        records, _ = self._records()
+        if not records:
+            return None
+        header = records[0]
+        if (header.get("format") != JOURNAL_FORMAT or header.get("serial") != self.serial
+                or header.get("plan") != plan_key(plan)
+                or header.get("script") != os.path.abspath(plan.script_path)
+                or header.get("steps") != len(plan.steps)):
+            # Another plan (or another version folder with the same script)
+            self.discard()
+            return None
+        state = JournalState(0, header.get("slot"), header.get("userspace", False),
+                             header.get("started"))
+        for record in records[1:]:
+            # Steps are recorded in order; a gap means the journal is not ours
+            if record.get("step") != state.completed:
+                break
+            state = JournalState(state.completed + 1, record.get("slot"),
+                                 record.get("userspace", False), record.get("time"))
+        if not state.completed or state.completed >= len(plan.steps):
+            return None
+        if time.time() - (state.updated or 0) > MAX_JOURNAL_AGE:
+            return None
+        return state
+
+    def begin(self, plan, slot=None, userspace=False):
+        """Start a fresh journal for plan"""
+        self.close()
+        os.makedirs(self.journal_dir, exist_ok=True)
+        header = {"format": JOURNAL_FORMAT, "serial": self.serial, "plan": plan_key(plan),
+                  "script": os.path.abspath(plan.script_path), "steps": len(plan.steps),
+                  "slot": slot, "userspace": userspace, "started": time.time()}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(header, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def reopen(self):
+        """Continue appending to an existing journal after load()"""
+        self.close()
+        _, valid = self._records()
+        self._file = open(self.path, "a", encoding="utf-8")
+        # Cut a torn last line so the next record starts on a line of its own
+        self._file.truncate(valid)
+
+    def record(self, index, step, slot=None, userspace=False):
+        """Mark step index done; returns once the line is on disk"""
+        if self._file is None:
+            self.reopen()
+        line = {"step": index, "kind": step.kind, "args": step.args,
+                "slot": slot, "userspace": userspace, "time": time.time()}
+        self._file.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def finish(self):
+        """The plan completed, nothing to resume"""
+        self.discard()
+
+    def discard(self):
+        """Drop the journal, the next run starts from the first step"""
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,717 @@
+"""
+Flash plan compiler and runner for ProshivkaTool
+
+Turns the fastboot lines of Оригинал.bat / Magisk.bat style scripts into a
+structured list of steps, caches the result by script hash and runs it
+through the native fastboot client. Knowing every step up front gives
+preflight checks, byte-accurate progress and read-ahead of the next image.
+"""
+import hashlib
+import json
+import os
+import re
+import shlex
+import threading
+import time
+
+import fastboot_client
+import sparse_image
+import super_image
+from compressed_image import find_image
+from fastboot_client import FastbootClient, FastbootDisconnected, FastbootError
+
+PLAN_FORMAT = 4
+PREFETCH_BUFFER_SIZE = 8 * 1024 * 1024
+RECONNECT_TIMEOUT = 90
+# How long a rebooting device may stay on the bus before it is assumed gone
+REBOOT_DETACH_TIMEOUT = 10
+# Reconnects attempted for one step after the link drops mid-flash
+MAX_RESUME_ATTEMPTS = 3
+
+# Step kinds
+FLASH = "flash"
+ERASE = "erase"
+SET_ACTIVE = "set_active"
+REBOOT = "reboot"
+OEM = "oem"
+CHECK_VAR = "check_var"
+LOGICAL = "logical"
+FORMAT = "format"
+WIPE = "wipe"
+LAYOUT = "layout"
+
+# cmd.exe lines without any effect on the device
+_IGNORED_COMMANDS = ("echo", "echo.", "pause", "title", "cls", "color", "chcp", "rem",
+                     "setlocal", "endlocal", "timeout", "exit", "cd", "pushd", "popd")
+_FASTBOOT_OPTIONS_WITH_VALUE = ("-s", "--slot", "-S")
+_FASTBOOT_FLAGS = ("--disable-verity", "--disable-verification", "--skip-secondary",
+                   "--skip-reboot", "--force")
+# fastboot -w formats each of these that reports a partition-type
+WIPE_PARTITIONS = ("userdata", "cache", "metadata")
+_LOGICAL_COMMANDS = ("create-logical-partition", "delete-logical-partition",
+                     "resize-logical-partition")
+# Steps that may sit between logical partition commands merged into one LAYOUT
+_LAYOUT_RUN_KINDS = (LOGICAL, FLASH, ERASE, FORMAT)
+# Firmware images the super geometry and groups are taken from, script dir or images/
+SUPER_TEMPLATES = ("super_empty.img", "super.img")
+
+
+class PlanError(Exception):
+    """Script can not be compiled or a step failed"""
+
+
+def _is_inside(path, directory):
+    try:
+        return os.path.commonpath([os.path.abspath(path), os.path.abspath(directory)]) == os.path.abspath(directory)
+    except ValueError:
+        return False
+
+
+class FlashStep:
+    """One device operation of a flash plan"""
+
+    def __init__(self, kind, args, image=None, line=0):
+        self.kind = kind
+        self.args = list(args)
+        self.image = image
+        self.line = line
+
+    def describe(self):
+        if self.kind == LAYOUT:
+            names = []
+            for command in self.args:
+                name = command.split(":")[1]
+                if name not in names:
+                    names.append(name)
+            return f"{self.kind} {', '.join(names)}"
+        target = " ".join(arg for arg in self.args if arg)
+        if self.image:
+            return f"{self.kind} {target} {os.path.basename(self.image)}"
+        return f"{self.kind} {target}".strip()
+
+    def to_json(self, script_dir):
+        image = self.image
+        # Scripts with the same content live in every version folder, so
+        # images next to the script are cached relative to it
+        if image and _is_inside(image, script_dir):
+            image = {"relative": os.path.relpath(image, script_dir)}
+        return {"kind": self.kind, "args": self.args, "image": image, "line": self.line}
+
+    @classmethod
+    def from_json(cls, data, script_dir):
+        image = data["image"]
+        if isinstance(image, dict):
+            image = os.path.join(script_dir, image["relative"])
+        return cls(data["kind"], data["args"], image, data["line"])
+
+
+class FlashPlan:
+    """Compiled script: ordered steps plus lines that could not be understood"""
+
+    def __init__(self, script_path, script_hash, steps=None, unsupported=None):
+        self.script_path = script_path
+        self.script_hash = script_hash
+        self.steps = steps or []
+        self.unsupported = unsupported or []
+
+    @property
+    def supported(self):
+        """True when every device command of the script is understood"""
+        return not self.unsupported
+
+    @property
+    def images(self):
+        """Image files used, a compressed variant (.img.xz etc.) where only that exists"""
+        seen = []
+        for step in self.steps:
+            if step.image and find_image(step.image) not in seen:
+                seen.append(find_image(step.image))
+        return seen
+
+    def image_bytes(self, archive=None):
+        """Bytes sent by all flash steps, an image flashed twice counts twice"""
+        if archive:
+            return sum(archive.size(step.image) for step in self.steps
+                       if step.image and archive.has(step.image))
+        images = [find_image(step.image) for step in self.steps if step.image]
+        return sum(os.path.getsize(image) for image in images if os.path.exists(image))
+
+    def to_json(self):
+        script_dir = os.path.dirname(self.script_path)
+        return {"format": PLAN_FORMAT, "hash": self.script_hash,
+                "steps": [step.to_json(script_dir) for step in self.steps],
+                "unsupported": self.unsupported}
+
+    @classmethod
+    def from_json(cls, script_path, data):
+        script_dir = os.path.dirname(script_path)
+        steps = [FlashStep.from_json(step, script_dir) for step in data["steps"]]
+        return cls(script_path, data["hash"], steps, [tuple(item) for item in data["unsupported"]])
+
+
+def _expand(text, variables, script_dir):
+    """Expand %*, %VAR% and %~dp0 the way cmd.exe does for simple scripts
+
+    %~dp0 becomes empty: paths are resolved against the script directory
+    anyway, and the firmware folders contain spaces that would break
+    unquoted arguments.
+    """
+    text = text.replace("%~dp0", "").replace("%*", "")
+
+    def lookup(match):
+        return variables.get(match.group(1).upper(), "")
+    return re.sub(r"%([^%\s]+)%", lookup, text)
+
+
+def _split_command(line):
+    """Split a cmd line into words, dropping redirections"""
+    line = re.sub(r"\s*\d?>>?\s*&?\S+", " ", line)
+    try:
+        return shlex.split(line, posix=False)
+    except ValueError:
+        return line.split()
+
+
+def _is_fastboot(word):
+    name = os.path.basename(word.strip('"').replace("\\", "/")).lower()
+    return name in ("fastboot", "fastboot.exe")
+
+
+def _resolve_image(word, script_dir):
+    path = word.strip('"').replace("\\", os.sep).replace("/", os.sep)
+    if not os.path.isabs(path) and not re.match(r"^[A-Za-z]:", path):
+        path = os.path.join(script_dir, path)
+    return os.path.normpath(path)
+
+
+def _parse_product_check(line):
+    """fastboot getvar product 2>&1 | findstr /r /c:"^product: *aristotle" """
+    match = re.search(r'\^product:\s*\*?\s*([\w-]+)', line)
+    if "getvar" in line and "product" in line and match:
+        return FlashStep(CHECK_VAR, ["product", match.group(1)])
+    return None
+
+
+def _parse_fastboot(words, script_dir, number):
+    """Steps for one fastboot invocation, or None if not understood"""
+    slot = None
+    set_active = None
+    wipe = False
+    fs_options = []
+    args = []
+    index = 1
+    while index < len(words):
+        word = words[index].strip('"')
+        if word in _FASTBOOT_OPTIONS_WITH_VALUE and index + 1 < len(words):
+            if word == "--slot":
+                slot = words[index + 1].strip('"')
+            index += 2
+            continue
+        if word.startswith("--slot="):
+            slot = word.split("=", 1)[1]
+        elif word.startswith("--set-active"):
+            set_active = word.split("=", 1)[1] if "=" in word else "other"
+        elif word == "-w":
+            wipe = True
+        elif word.startswith("--fs-options="):
+            fs_options = [option for option in word.split("=", 1)[1].split(",") if option]
+        elif word in _FASTBOOT_FLAGS:
+            pass
+        else:
+            args.append(words[index])
+        index += 1
+
+    wipe_steps = [FlashStep(WIPE, fs_options, line=number)] if wipe else []
+    if not args:
+        return wipe_steps
+    command = args[0].lower()
+    steps = []
+    if command == "flash" and len(args) == 3:
+        partition = args[1].strip('"')
+        image = _resolve_image(args[2], script_dir)
+        if slot == "all":
+            steps = [FlashStep(FLASH, [f"{partition}_a"], image, number),
+                     FlashStep(FLASH, [f"{partition}_b"], image, number)]
+        elif slot and slot != "other":
+            steps = [FlashStep(FLASH, [f"{partition}_{slot}"], image, number)]
+        elif slot is None:
+            steps = [FlashStep(FLASH, [partition], image, number)]
+        else:
+            return None
+    elif command == "erase" and len(args) == 2:
+        steps = [FlashStep(ERASE, [args[1].strip('"')], line=number)]
+    elif command.startswith("format") and len(args) == 2:
+        # format[:fs_type[:size]] partition; the size always comes from the device
+        fs_type = command.split(":")[1] if ":" in command else ""
+        steps = [FlashStep(FORMAT, [args[1].strip('"'), fs_type] + fs_options, line=number)]
+    elif command == "set_active" and len(args) == 2:
+        steps = [FlashStep(SET_ACTIVE, [args[1].strip('"')], line=number)]
+    elif command in ("reboot", "reboot-bootloader", "reboot-fastboot", "reboot-recovery"):
+        target = command[7:] if "-" in command else (args[1].strip('"') if len(args) > 1 else "")
+        steps = [FlashStep(REBOOT, [target] if target else [], line=number)]
+    elif command == "oem" and len(args) > 1:
+        steps = [FlashStep(OEM, [arg.strip('"') for arg in args[1:]], line=number)]
+    elif command in _LOGICAL_COMMANDS and len(args) >= 2:
+        steps = [FlashStep(LOGICAL, [command] + [arg.strip('"') for arg in args[1:]], line=number)]
+    elif command in ("getvar", "devices"):
+        steps = []
+    else:
+        return None
+
+    if set_active is not None:
+        if set_active == "other":
+            return None
+        steps.append(FlashStep(SET_ACTIVE, [set_active], line=number))
+    return steps + wipe_steps
+
+
+def _base_name(partition):
+    return partition[:-2] if partition.endswith(("_a", "_b")) else partition
+
+
+def _batch_layout(steps):
+    """Merge the logical partition commands of each fastbootd run into one LAYOUT step
+
+    A run is a stretch of flash, erase, format and logical steps. The
+    commands move up to the first of them, which is only done when none
+    of the steps they jump over touches their partition.
+    """
+    result = []
+    run = []
+
+    def flush():
+        logical = [step for step in run if step.kind == LOGICAL]
+        movable = len(logical) >= 2
+        if movable:
+            first = run.index(logical[0])
+            passed = set()
+            for step in run[first:]:
+                if step.kind != LOGICAL:
+                    passed.add(_base_name(step.args[0]))
+                elif len(step.args) < 2 or _base_name(step.args[1]) in passed:
+                    movable = False
+        if movable:
+            result.extend(run[:first])
+            result.append(FlashStep(LAYOUT, [":".join(step.args) for step in logical],
+                                    line=logical[0].line))
+            result.extend(step for step in run[first:] if step.kind != LOGICAL)
+        else:
+            result.extend(run)
+        run.clear()
+
+    for step in steps:
+        if step.kind in _LAYOUT_RUN_KINDS and not (step.kind == FLASH and step.args[0] == "super"):
+            run.append(step)
+        else:
+            flush()
+            result.append(step)
+    flush()
+    return result
+
+
+def compile_script(script_path):
+    """Parse a .bat script into a FlashPlan"""
+    with open(script_path, "rb") as f:
+        raw = f.read()
+    script_hash = hashlib.sha256(raw).hexdigest()
+    for encoding in ("utf-8", "cp866", "cp1251"):
+        try:
+            text = raw.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    script_dir = os.path.dirname(os.path.abspath(script_path))
+    plan = FlashPlan(script_path, script_hash)
+    variables = {}
+
+    for number, original in enumerate(text.splitlines(), 1):
+        line = original.strip().lstrip("@")
+        lowered = line.lower()
+        if not line or line.startswith(":"):
+            continue
+        first = lowered.split()[0]
+        if first in _IGNORED_COMMANDS or lowered.startswith("echo"):
+            continue
+        if first == "set":
+            assignment = line[3:].strip()
+            if assignment.startswith('"'):
+                # set "VAR=value" form
+                assignment = assignment.strip('"')
+            if assignment.startswith("/"):
+                plan.unsupported.append((number, original))
+                continue
+            name, _, value = assignment.partition("=")
+            variables[name.strip().upper()] = _expand(value, variables, script_dir)
+            continue
+
+        expanded = _expand(line, variables, script_dir)
+        check = _parse_product_check(expanded)
+        if check:
+            check.line = number
+            plan.steps.append(check)
+            continue
+        if re.search(r"\bgetvar\b", expanded, re.IGNORECASE) and re.search(r"\||&&", expanded):
+            # A guard on anything but the product is only enforced by cmd.exe
+            plan.unsupported.append((number, original))
+            continue
+        if "||" in expanded:
+            expanded = expanded.split("||", 1)[0]
+        words = _split_command(expanded)
+        if words and _is_fastboot(words[0]):
+            steps = _parse_fastboot(words, script_dir, number)
+            if steps is None:
+                plan.unsupported.append((number, original))
+            else:
+                plan.steps.extend(steps)
+        else:
+            plan.unsupported.append((number, original))
+    plan.steps = _batch_layout(plan.steps)
+    return plan
+
+
+class PlanCache:
+    """Compiled plans stored as JSON, keyed by the script's sha256"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def load(self, script_path):
+        with open(script_path, "rb") as f:
+            script_hash = hashlib.sha256(f.read()).hexdigest()
+        path = os.path.join(self.cache_dir, f"{script_hash}.json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("format") == PLAN_FORMAT:
+                return FlashPlan.from_json(script_path, data)
+        except (OSError, ValueError, KeyError):
+            pass
+        plan = compile_script(script_path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(plan.to_json(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return plan
+
+
+def prefetch(path):
+    """Pull an image into the page cache ahead of its transfer"""
+    try:
+        with open(path, "rb", buffering=0) as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                return
+            buffer = bytearray(PREFETCH_BUFFER_SIZE)
+            while f.readinto(buffer):
+                pass
+    except OSError:
+        pass
+
+
+class PlanRunner:
+    """Executes a FlashPlan on one device through one fastboot session
+
+    With archive (a rom_archive.RomArchive the plan was compiled from),
+    images are streamed out of the archive instead of read from disk.
+    With monitor (a device_monitor.DeviceMonitor), reconnects wait for the
+    device's hot-plug event instead of retrying every second.
+    With journal (a flash_journal.FlashJournal), completed steps are
+    checkpointed and an interrupted run of the same plan on the same
+    device continues from the first unfinished step.
+    With image_cache (a blank_image_cache.BlankImageCache), format and
+    wipe steps flash cached blank filesystems instead of building them.
+    Merged logical partition commands are sent as one update-super when
+    the firmware's super image next to the script gives the geometry and
+    groups, and one by one otherwise.
+    """
+
+    def __init__(self, plan, serial, progress=None, cancel_event=None, connect=None,
+                 archive=None, monitor=None, journal=None, image_cache=None):
+        self.plan = plan
+        self.archive = archive
+        self.image_cache = image_cache
+        self.monitor = monitor
+        self.journal = journal
+        # Slot and mode the plan has left the device in, restored after a reconnect
+        self.expected_slot = None
+        self.expected_userspace = None
+        self.resumed_from = 0
+        self.serial = serial
+        self.progress = progress
+        self.cancel_event = cancel_event or threading.Event()
+        self.connect = connect or FastbootClient.connect
+        self.client = None
+        self.total_bytes = 0
+        self.done_bytes = 0
+        # Sustained transfer rate per flashed partition, MB/s
+        self.rates = {}
+        self.super_template = None
+
+    def preflight(self):
+        """Fail before touching the device if an image is missing"""
+        if not self.plan.supported:
+            lines = ", ".join(str(number) for number, _ in self.plan.unsupported)
+            raise PlanError(f"Неподдерживаемые строки скрипта: {lines}")
+        exists = self.archive.has if self.archive else os.path.exists
+        missing = [image for image in self.plan.images if not exists(image)]
+        if missing:
+            raise PlanError("Не найдены образы: " + ", ".join(os.path.basename(m) for m in missing))
+
+    def _report(self, message):
+        if self.progress:
+            fraction = self.done_bytes / self.total_bytes if self.total_bytes else 0.0
+            self.progress(fraction, message)
+
+    def _reconnect(self, detach=True):
+        """Wait for the device to come back after a reboot or a dropped link"""
+        if self.client:
+            self.client.close()
+            self.client = None
+        deadline = time.time() + RECONNECT_TIMEOUT
+        watched = self.monitor is not None and not self.serial.startswith("tcp:")
+        if watched and detach:
+            # The old session stays listed until its unplug event arrives
+            self.monitor.wait_for_removal(self.serial, timeout=REBOOT_DETACH_TIMEOUT)
+        while time.time() < deadline:
+            if watched:
+                self.monitor.wait_for(self.serial, timeout=deadline - time.time(),
+                                      cancel_event=self.cancel_event)
+            elif self.cancel_event.wait(1.0):
+                return
+            if self.cancel_event.is_set():
+                return
+            try:
+                self.client = self.connect(self.serial)
+                self.client.probe()
+                return
+            except FastbootError:
+                # Listed but not answering yet (permissions, interface still busy)
+                if watched and self.cancel_event.wait(0.5):
+                    return
+                continue
+        raise PlanError(f"Устройство {self.serial} не вернулось после перезагрузки")
+
+    def _image_size(self, step):
+        if self.archive:
+            return self.archive.size(step.image)
+        return os.path.getsize(find_image(step.image))
+
+    def _device_state(self, refresh=False):
+        """(current slot, fastbootd?) from the cached probe"""
+        info = self.client.probe(refresh)
+        return (info.current_slot.lstrip("_") if info.current_slot else None), info.is_userspace
+
+    def _restore_state(self):
+        """Re-probe a reconnected device and put it back into the plan's slot and mode"""
+        slot, userspace = self._device_state(refresh=True)
+        if self.expected_userspace is not None and userspace != self.expected_userspace:
+            self._report("Возврат в " + ("fastbootd" if self.expected_userspace else "bootloader"))
+            self.client.reboot("fastboot" if self.expected_userspace else "bootloader")
+            self._reconnect()
+            if self.client is None:
+                raise PlanError("Прошивка отменена")
+            slot, userspace = self._device_state()
+        if self.expected_slot and slot and slot != self.expected_slot:
+            self.client.set_active(self.expected_slot)
+
+    def _resume(self):
+        """Index of the first step to run, continuing an interrupted journal"""
+        state = self.journal.load(self.plan) if self.journal else None
+        if state is None:
+            if self.journal:
+                slot, userspace = self._device_state()
+                self.journal.begin(self.plan, slot, userspace)
+            return 0
+        start = state.completed
+        self.done_bytes = sum(self._image_size(step) for step in self.plan.steps[:start]
+                              if step.kind == FLASH)
+        self._report(f"Продолжение с шага {start + 1} из {len(self.plan.steps)}")
+        # Product checks are cheap and make sure it is still the same kind of device
+        for step in self.plan.steps[:start]:
+            if step.kind == CHECK_VAR:
+                self.run_step(step)
+        self.expected_slot, self.expected_userspace = state.slot, state.userspace
+        self._restore_state()
+        self.journal.reopen()
+        return start
+
+    def _checkpoint(self, index, step):
+        if self.client is None:
+            # Cancelled while waiting for the device to come back
+            raise PlanError("Прошивка отменена")
+        if not (step.kind == REBOOT and step.args[:1] not in (["bootloader"], ["fastboot"])):
+            self.expected_slot, self.expected_userspace = self._device_state()
+        if self.journal:
+            self.journal.record(index, step, self.expected_slot, self.expected_userspace)
+
+    def _run_resumable(self, step):
+        """run_step, reconnecting and retrying the step when the link drops"""
+        for attempt in range(MAX_RESUME_ATTEMPTS + 1):
+            base = self.done_bytes
+            try:
+                self.run_step(step)
+                return
+            except FastbootDisconnected as e:
+                if attempt == MAX_RESUME_ATTEMPTS or self.cancel_event.is_set():
+                    raise PlanError(f"Связь с {self.serial} потеряна: {e}") from e
+                self.done_bytes = base
+                self._report(f"Связь потеряна, ожидание устройства: {step.describe()}")
+                self._reconnect(detach=False)
+                if self.client is None:
+                    raise PlanError("Прошивка отменена")
+                self._restore_state()
+
+    def run(self):
+        self.preflight()
+        self.total_bytes = self.plan.image_bytes(self.archive) or 1
+        self.client = self.connect(self.serial)
+        # One getvar all up front, checks and splitting then read the cached record
+        self.client.probe()
+        prefetcher = None
+        try:
+            self.resumed_from = self._resume()
+            if self.archive:
+                # Lets a tar.gz keep images it passes before their turn
+                self.archive.expect([step.image for step in self.plan.steps[self.resumed_from:]
+                                     if step.kind == FLASH and step.image])
+            for index, step in enumerate(self.plan.steps):
+                if index < self.resumed_from:
+                    continue
+                if self.cancel_event.is_set():
+                    raise PlanError("Прошивка отменена")
+                # Warm the page cache with the next image while this one transfers
+                following = next((s.image for s in self.plan.steps[index + 1:] if s.image), None)
+                if following and not self.archive and (prefetcher is None or not prefetcher.is_alive()):
+                    prefetcher = threading.Thread(target=prefetch, args=(find_image(following),), daemon=True)
+                    prefetcher.start()
+                self._report(step.describe())
+                self._run_resumable(step)
+                self._checkpoint(index, step)
+            self._report("Готово")
+            if self.journal:
+                self.journal.finish()
+        finally:
+            if self.journal:
+                self.journal.close()
+            if self.client:
+                self.client.close()
+
+    def run_step(self, step):
+        client = self.client
+        if step.kind == FLASH:
+            base = self.done_bytes
+            image = step.image if self.archive else find_image(step.image)
+            size = self._image_size(step)
+
+            started = time.monotonic()
+
+            def progress(sent, total):
+                self.done_bytes = base + size * sent // max(total, 1)
+                elapsed = time.monotonic() - started
+                rate = sent / elapsed / 1024 ** 2 if elapsed > 0 else 0.0
+                self._report(f"{step.describe()} ({rate:.0f} МБ/с)")
+            if self.archive:
+                self.archive.flash(client, step.args[0], image, progress)
+            else:
+                client.flash_image(step.args[0], image, progress)
+            self.done_bytes = base + size
+            if step.args[0] in client.partition_rates:
+                self.rates[step.args[0]] = client.partition_rates[step.args[0]]
+        elif step.kind == ERASE:
+            client.erase(step.args[0])
+        elif step.kind == FORMAT:
+            partition, fs_type = step.args[:2]
+            client.format(partition, fs_type or None, casefold="casefold" in step.args[2:],
+                          cache=self.image_cache)
+        elif step.kind == WIPE:
+            info = client.probe()
+            for partition in WIPE_PARTITIONS:
+                if info.partition_type(partition):
+                    self._report(f"{step.kind} {partition}")
+                    client.format(partition, casefold="casefold" in step.args,
+                                  cache=self.image_cache)
+        elif step.kind == SET_ACTIVE:
+            client.set_active(step.args[0])
+        elif step.kind == OEM:
+            client.oem(*step.args)
+        elif step.kind == LOGICAL:
+            client.command(":".join(step.args))
+        elif step.kind == LAYOUT:
+            self._update_layout(step)
+        elif step.kind == CHECK_VAR:
+            name, expected = step.args
+            actual = client.getvar(name)
+            if actual != expected:
+                raise PlanError(f"Прошивка для {expected}, а подключено {actual}")
+        elif step.kind == REBOOT:
+            target = step.args[0] if step.args else None
+            try:
+                client.reboot(target)
+            except FastbootDisconnected:
+                # Some bootloaders drop the link before answering OKAY
+                pass
+            if target in ("bootloader", "fastboot"):
+                self._reconnect()
+        else:
+            raise PlanError(f"Неизвестный шаг: {step.kind}")
+
+    def _template(self):
+        """lpmetadata of the firmware's super image, None when there is none"""
+        if self.super_template is None and not self.archive:
+            script_dir = os.path.dirname(os.path.abspath(self.plan.script_path))
+            for directory in (script_dir, os.path.join(script_dir, "images")):
+                for name in SUPER_TEMPLATES:
+                    path = os.path.join(directory, name)
+                    if os.path.exists(path):
+                        with super_image.SuperImage(path) as image:
+                            self.super_template = image.metadata()
+                        return self.super_template
+        return self.super_template
+
+    def _layout_metadata(self, step, commands):
+        info = self.client.probe()
+        if not info.is_userspace:
+            raise super_image.SuperError("устройство не в fastbootd")
+        template = self._template()
+        if template is None:
+            raise super_image.SuperError("рядом со скриптом нет " + " или ".join(SUPER_TEMPLATES))
+        slot = (info.current_slot or "").lstrip("_")
+        # Partitions written right after the commands, their old data does not matter
+        rewritten = set()
+        for following in self.plan.steps[self.plan.steps.index(step) + 1:]:
+            if following.kind not in _LAYOUT_RUN_KINDS:
+                break
+            name = following.args[0]
+            rewritten.add(f"{name}_{slot}" if f"{name}_{slot}" in info.logical_partitions else name)
+        partitions = {name: info.partition_sizes.get(name, 0) for name in info.logical_partitions}
+        super_name = info.variables.get("super-partition-name") or "super"
+        return super_image.batched_update(template, info.partition_size(super_name), partitions,
+                                          commands, slot, rewritten)
+
+    def _update_layout(self, step):
+        """Apply a LAYOUT step with one update-super, or command by command"""
+        try:
+            commands = []
+            for text in step.args:
+                command, name, *size = text.split(":")
+                commands.append((command, name, int(size[0], 0) if size else 0))
+            metadata = self._layout_metadata(step, commands)
+            self.client.update_super(metadata.empty_image())
+            return
+        except FastbootDisconnected:
+            raise
+        except FastbootError as e:
+            reason = f"update-super отклонён: {e}"
+        except (super_image.SuperError, sparse_image.SparseError, OSError, ValueError) as e:
+            reason = str(e)
+        self._report(f"{step.describe()}: по одной команде ({reason})")
+        for command in step.args:
+            self.client.command(command)
+
+
+def native_available(serial=None):
+    """Whether the in-process engine can reach devices at all"""
+    if serial and serial.startswith("tcp:"):
+        return True
+    return fastboot_client.PYUSB_AVAILABLE
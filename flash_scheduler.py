@@ -0,0 +1,283 @@
+"""
+Parallel multi-device flash scheduler for ProshivkaTool
+
+Fans a flash job out to every connected device. Each serial has its own
+job queue, a bounded worker pool limits how many devices are flashed at
+once, and progress of all devices is aggregated for the status bar.
+"""
+import os
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import blank_image_cache
+import fastboot_client
+import firmware_store
+import flash_plan
+import image_verify
+from flash_journal import FlashJournal
+
+FIRMWARE_ROOT = "Прошивка оригинального boot и с вшитым magisk"
+
+# Job states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Workers verify one after another: the first hashes, the rest hit the cache
+_verify_lock = threading.Lock()
+
+
+class FlashCancelled(Exception):
+    """Raised inside a runner when its job was cancelled"""
+
+
+class FlashJob:
+    """Firmware version plus variant ("Оригинал" or "Magisk")"""
+
+    def __init__(self, version, variant):
+        self.version = version
+        self.variant = variant
+
+    @property
+    def family(self):
+        """HyperOS 1 / HyperOS 2 folder the version lives in"""
+        return f"HyperOS {self.version.split('.')[0]}"
+
+    def script_path(self, base_path):
+        return os.path.join(base_path, FIRMWARE_ROOT, self.family,
+                            f"HyperOS {self.version}", f"{self.variant}.bat")
+
+    def __repr__(self):
+        return f"FlashJob({self.version!r}, {self.variant!r})"
+
+
+class DeviceTask:
+    """One job scheduled on one device"""
+
+    def __init__(self, serial, job):
+        self.serial = serial
+        self.job = job
+        self.state = PENDING
+        self.progress = 0.0
+        self.message = ""
+        self.cancel_event = threading.Event()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise FlashCancelled(self.serial)
+
+
+def discover_devices(fastboot_path=None):
+    """Serials of all devices currently in fastboot mode"""
+    serials = fastboot_client.list_usb_devices()
+    if serials or not fastboot_path:
+        return serials
+    # Without pyusb fall back to a single "fastboot devices" call
+    try:
+        output = subprocess.run([fastboot_path, "devices"], capture_output=True,
+                                text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return []
+    return [line.split()[0] for line in output.splitlines() if line.strip()]
+
+
+def run_script(base_path, task, report):
+    """Default runner: the job's .bat script pinned to one serial
+
+    fastboot honours ANDROID_SERIAL, so the unmodified scripts only talk
+    to the device they were started for.
+    """
+    script = task.job.script_path(base_path)
+    if not os.path.exists(script):
+        raise FileNotFoundError(f"Файл не найден: {script}")
+    env = dict(os.environ, ANDROID_SERIAL=task.serial)
+    process = subprocess.Popen(["cmd", "/c", os.path.basename(script)],
+                               cwd=os.path.dirname(script), env=env,
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    while process.poll() is None:
+        if task.cancel_event.wait(0.5):
+            process.kill()
+            process.wait()
+            raise FlashCancelled(task.serial)
+    if process.returncode != 0:
+        raise RuntimeError(f"Скрипт завершился с кодом {process.returncode}")
+    report(1.0, "Готово")
+
+
+def run_plan(base_path, task, report, monitor=None):
+    """Runner using the compiled script and the in-process fastboot engine
+
+    Scripts with lines the compiler does not understand, or setups where
+    the device can not be reached natively, fall back to run_script.
+    With a device_monitor.DeviceMonitor, reboots inside the plan wait for
+    the hot-plug event instead of polling the bus. Completed steps are
+    journaled per serial, so a failed run continues where it stopped.
+    Format and wipe steps share one blank image cache across workers.
+    Images are verified against their reference checksums first, those
+    without one get their digests recorded; a mismatch fails the task
+    before anything is sent. The firmware store marks the flashed images
+    as recently used.
+    """
+    script = task.job.script_path(base_path)
+    if not os.path.exists(script):
+        raise FileNotFoundError(f"Файл не найден: {script}")
+    cache = flash_plan.PlanCache(os.path.join(base_path, "cache", "plans"))
+    plan = cache.load(script)
+    store = firmware_store.shared_store(os.path.join(base_path, "store"))
+    script_dir = os.path.dirname(script)
+
+    def verify_progress(done, total):
+        report(0.0, f"Проверка образов: {done * 100 // total if total else 100}%")
+
+    with _verify_lock:
+        task.check_cancelled()
+        checksums = store.references(script_dir)
+        checksums.update(image_verify.load_checksums(script_dir))
+        digests = image_verify.verify_images(
+            plan.images or image_verify.find_images(script_dir), checksums,
+            image_verify.shared_cache(os.path.join(base_path, "cache", "verify_cache.json")),
+            progress=verify_progress)
+        recorded = image_verify.unreferenced(digests, checksums)
+        if recorded:
+            try:
+                image_verify.record_checksums(script_dir, recorded)
+            except OSError:
+                pass
+    try:
+        store.touch_paths(digests)
+    except OSError:
+        pass
+    if not plan.supported or not flash_plan.native_available(task.serial):
+        return run_script(base_path, task, report)
+    runner = flash_plan.PlanRunner(plan, task.serial, progress=report,
+                                   cancel_event=task.cancel_event, monitor=monitor,
+                                   journal=FlashJournal(os.path.join(base_path, "cache", "journal"),
+                                                        task.serial),
+                                   image_cache=blank_image_cache.shared_cache(
+                                       os.path.join(base_path, "cache", "blank")))
+    try:
+        runner.run()
+    except flash_plan.PlanError:
+        if task.cancel_event.is_set():
+            raise FlashCancelled(task.serial)
+        raise
+
+
+class FlashScheduler:
+    """Bounded worker pool with a job queue per device serial
+
+    monitor (a started device_monitor.DeviceMonitor) replaces bus scans:
+    submit() takes the fastboot devices from its registry and scans the
+    bus only when the registry is empty.
+    """
+
+    def __init__(self, base_path, runner=None, max_workers=4, progress_callback=None,
+                 monitor=None):
+        self.base_path = base_path
+        self.monitor = monitor
+        self.runner = runner or (lambda task, report: run_plan(self.base_path, task, report,
+                                                               self.monitor))
+        self.progress_callback = progress_callback
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="flash")
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.active = set()
+        self.tasks = []
+
+    def submit(self, job, serials=None):
+        """Queue job on the given serials (all connected devices by default)
+
+        Finished tasks of earlier batches are dropped, summary() and
+        cancel() only cover the work still queued or running and the new
+        batch.
+        """
+        if serials is None and self.monitor is not None:
+            # An empty registry may only mean the monitor backend is not working
+            serials = self.monitor.serials() or None
+        if serials is None:
+            serials = discover_devices(os.path.join(self.base_path, "fastboot.exe"))
+        tasks = []
+        with self.lock:
+            self.tasks = [task for task in self.tasks if task.state not in FINISHED]
+            for serial in serials:
+                task = DeviceTask(serial, job)
+                self.queues.setdefault(serial, deque()).append(task)
+                self.tasks.append(task)
+                tasks.append(task)
+                if serial not in self.active:
+                    self.active.add(serial)
+                    self.executor.submit(self._drain, serial)
+        self._notify()
+        return tasks
+
+    def _drain(self, serial):
+        """Run the queued tasks of one device, one after another"""
+        while True:
+            with self.lock:
+                queue = self.queues.get(serial)
+                if not queue:
+                    self.active.discard(serial)
+                    return
+                task = queue.popleft()
+            self._run_task(task)
+
+    def _run_task(self, task):
+        if task.cancel_event.is_set():
+            task.state = CANCELLED
+            self._notify()
+            return
+        task.state = RUNNING
+        self._notify()
+        try:
+            self.runner(task, lambda fraction, message=None: self.update_progress(task, fraction, message))
+            task.state = DONE
+            task.progress = 1.0
+        except FlashCancelled:
+            task.state = CANCELLED
+        except Exception as e:
+            task.state = FAILED
+            task.message = str(e)
+        self._notify()
+
+    def update_progress(self, task, fraction, message=None):
+        """Per-device progress, runners get it bound as their report argument"""
+        task.progress = max(0.0, min(1.0, fraction))
+        if message is not None:
+            task.message = message
+        self._notify()
+
+    def cancel(self, serial=None):
+        """Cancel queued and running tasks of one device or of all devices"""
+        with self.lock:
+            for task in self.tasks:
+                if serial is None or task.serial == serial:
+                    task.cancel_event.set()
+
+    def summary(self):
+        """Aggregate progress: (fraction done, {state: count})"""
+        with self.lock:
+            tasks = list(self.tasks)
+        counts = {}
+        for task in tasks:
+            counts[task.state] = counts.get(task.state, 0) + 1
+        if not tasks:
+            return 0.0, counts
+        total = sum(1.0 if task.state in FINISHED else task.progress for task in tasks)
+        return total / len(tasks), counts
+
+    def _notify(self):
+        if self.progress_callback:
+            self.progress_callback(*self.summary())
+
+    def shutdown(self, cancel=True):
+        if cancel:
+            self.cancel()
+        self.executor.shutdown(wait=False)
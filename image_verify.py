@@ -0,0 +1,268 @@
+"""
+Firmware image integrity verification for ProshivkaTool
+
+Hashes every image of a firmware version in a thread pool before flashing.
+Hashes are cached per file by (path, size, mtime, inode), so flashing the
+same version again does not read the images a second time.
+
+References come from a SHA256SUMS-style file shipped with the firmware or
+from the firmware store manifest. Images without one get their digest
+recorded on first verification (RECORDED_CHECKSUMS), so later runs detect
+any change; the caller is told which images were taken on trust.
+"""
+import hashlib
+import json
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_WINDOW_SIZE = 16 * 1024 * 1024
+IMAGE_EXTENSIONS = (".img", ".bin", ".mbn", ".elf")
+# Images kept compressed in the tree, e.g. super.img.zst
+COMPRESSED_SUFFIXES = (".xz", ".zst", ".lz4", ".gz")
+CHECKSUM_FILES = ("SHA256SUMS", "sha256sums.txt", "checksums.sha256")
+# Digests recorded by the tool itself for images that came without a reference
+RECORDED_CHECKSUMS = "recorded.sha256"
+
+
+class VerificationError(Exception):
+    """One or more images are missing or do not match their checksum"""
+
+    def __init__(self, problems):
+        self.problems = problems
+        super().__init__("\n".join(f"{os.path.basename(path)}: {reason}"
+                                   for path, reason in problems))
+
+
+def _file_key(stat):
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+class HashCache:
+    """sha256 of files, valid while size, mtime and inode are unchanged"""
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def get(self, path, stat):
+        with self.lock:
+            entry = self.entries.get(os.path.abspath(path))
+        if entry and entry["key"] == _file_key(stat):
+            return entry["sha256"]
+        return None
+
+    def put(self, path, stat, digest):
+        with self.lock:
+            self.entries[os.path.abspath(path)] = {"key": _file_key(stat), "sha256": digest}
+
+    def save(self):
+        if not self.cache_path:
+            return
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        # Held while writing: scheduler workers save the shared cache concurrently
+        with self.lock:
+            data = json.dumps(self.entries, ensure_ascii=False)
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, self.cache_path)
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_cache(cache_path):
+    """One HashCache per file for the whole process
+
+    Separate instances would overwrite each other's entries on save.
+    """
+    cache_path = os.path.abspath(cache_path)
+    with _shared_lock:
+        if cache_path not in _shared:
+            _shared[cache_path] = HashCache(cache_path)
+        return _shared[cache_path]
+
+
+def hash_file(path, progress=None):
+    """SHA-256 of a file read through mmap in large windows
+
+    hashlib releases the GIL on big buffers, so several files hash in
+    parallel on separate threads.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return digest.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, HASH_WINDOW_SIZE):
+                    window = view[offset:offset + HASH_WINDOW_SIZE]
+                    digest.update(window)
+                    if progress:
+                        progress(window.nbytes)
+                    window.release()
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+def find_images(directory):
+    """Image files of a firmware version directory"""
+    images = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            name = filename.lower()
+            if name.endswith(COMPRESSED_SUFFIXES):
+                name = os.path.splitext(name)[0]
+            if name.endswith(IMAGE_EXTENSIONS):
+                images.append(os.path.join(dirpath, filename))
+    return images
+
+
+def _read_checksum_file(directory, path):
+    checksums = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.strip().split(None, 1)
+            if len(parts) != 2:
+                continue
+            digest, filename = parts
+            filename = filename.lstrip("*").replace("/", os.sep)
+            checksums[os.path.abspath(os.path.join(directory, filename))] = digest.lower()
+    return checksums
+
+
+def load_checksums(directory):
+    """Reference hashes from a sha256sum-style file, {abs path: sha256}
+
+    Digests recorded by record_checksums() fill in the images the shipped
+    file does not list.
+    """
+    checksums = {}
+    recorded = os.path.join(directory, RECORDED_CHECKSUMS)
+    if os.path.exists(recorded):
+        checksums.update(_read_checksum_file(directory, recorded))
+    for name in CHECKSUM_FILES:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            checksums.update(_read_checksum_file(directory, path))
+            break
+    return checksums
+
+
+def unreferenced(digests, expected):
+    """{path: sha256} of verified images that had no reference to compare with"""
+    return {path: digest for path, digest in digests.items()
+            if os.path.abspath(path) not in expected}
+
+
+def record_checksums(directory, digests):
+    """Add digests to the RECORDED_CHECKSUMS file of directory
+
+    Used on the first verification of images without a reference: what is
+    on disk now becomes the reference for every later run.
+    """
+    path = os.path.join(directory, RECORDED_CHECKSUMS)
+    checksums = _read_checksum_file(directory, path) if os.path.exists(path) else {}
+    checksums.update((os.path.abspath(image), digest) for image, digest in digests.items())
+    lines = []
+    for image, digest in sorted(checksums.items()):
+        relative = os.path.relpath(image, directory).replace(os.sep, "/")
+        lines.append(f"{digest} *{relative}\n")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    os.replace(tmp_path, path)
+
+
+def verify_images(paths, expected=None, cache=None, max_workers=4, progress=None,
+                  strict=False):
+    """Hash paths in parallel and compare with expected hashes
+
+    progress(done_bytes, total_bytes) is called from worker threads.
+    Returns {path: sha256}, raises VerificationError on any problem; with
+    strict an image without a reference hash is a problem too, otherwise
+    the caller checks unreferenced() and records or reports those.
+    """
+    expected = expected or {}
+    problems = []
+    stats = {}
+    for path in paths:
+        try:
+            stats[path] = os.stat(path)
+        except OSError:
+            problems.append((path, "файл не найден"))
+
+    results = {}
+    to_hash = []
+    for path, stat in stats.items():
+        digest = cache.get(path, stat) if cache else None
+        if digest:
+            results[path] = digest
+        else:
+            to_hash.append(path)
+
+    total = sum(stats[path].st_size for path in to_hash)
+    done = [0]
+    lock = threading.Lock()
+
+    def advance(count):
+        with lock:
+            done[0] += count
+            current = done[0]
+        if progress:
+            progress(current, total)
+
+    def work(path):
+        digest = hash_file(path, advance)
+        if cache:
+            cache.put(path, stats[path], digest)
+        return path, digest
+
+    # Biggest files first so one huge super image does not run last
+    to_hash.sort(key=lambda path: stats[path].st_size, reverse=True)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="verify") as executor:
+        for future in [executor.submit(work, path) for path in to_hash]:
+            try:
+                path, digest = future.result()
+                results[path] = digest
+            except OSError as e:
+                problems.append((getattr(e, "filename", None) or "?", f"ошибка чтения: {e}"))
+    if cache:
+        cache.save()
+
+    for path, digest in results.items():
+        reference = expected.get(os.path.abspath(path))
+        if reference and reference != digest:
+            problems.append((path, "контрольная сумма не совпадает"))
+        elif not reference and strict:
+            problems.append((path, "нет эталонной контрольной суммы"))
+    if problems:
+        raise VerificationError(problems)
+    return results
+
+
+def verify_directory(directory, cache=None, max_workers=4, progress=None):
+    """Verify all images of a firmware version directory
+
+    Images without a reference have their digests recorded. Returns
+    ({path: sha256}, {path: sha256} of the images recorded just now).
+    """
+    expected = load_checksums(directory)
+    digests = verify_images(find_images(directory), expected, cache, max_workers, progress)
+    recorded = unreferenced(digests, expected)
+    if recorded:
+        record_checksums(directory, recorded)
+    return digests, recorded
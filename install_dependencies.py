@@ -87,6 +87,11 @@ def main():
     packages = [
         "pygame>=2.5.0",           # For music player
         "pillow>=10.0.0",           # For image processing
+        "pyusb",                    # Native fastboot over USB
+        "numpy",                    # Fast sparse image scanning
+        "brotli",                   # Incremental OTA patches
+        "lz4",                      # LZ4 ramdisks and .img.lz4 images
+        "zstandard",                # .img.zst images
         "pyinstaller",              # For creating executables
         "pywin32; platform_system=='Windows'",  # Windows API integration
         "pyaudio",                  # Audio backend
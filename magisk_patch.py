@@ -0,0 +1,471 @@
+"""
+Host-side Magisk patching of boot/init_boot images for ProshivkaTool
+
+Does what the Magisk app does on the phone: unpacks the ramdisk cpio,
+adds magiskinit and the compressed Magisk binaries, keeps the stock init
+in .backup and packs the image again. Images of several firmware versions
+are patched in a process pool, results are cached by (stock image sha256,
+Magisk version) so a version is patched once per Magisk release.
+"""
+import gzip
+import hashlib
+import lzma
+import os
+import re
+import shutil
+import struct
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import lz4.block
+    import lz4.frame
+    LZ4_AVAILABLE = True
+except ImportError:
+    LZ4_AVAILABLE = False
+
+import boot_image
+from firmware_store import hash_file
+from flash_scheduler import FIRMWARE_ROOT
+
+MAGISK_ABI = "arm64-v8a"
+MAGISK_ABI32 = "armeabi-v7a"
+# Searched in this order, init_boot carries the ramdisk on Android 13+ devices
+STOCK_IMAGE_NAMES = ("init_boot.img", "boot.img")
+PATCHED_SUFFIX = "_magisk"
+
+CPIO_MAGIC = b"070701"
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = "TRAILER!!!"
+
+# Ramdisk compression formats
+FORMAT_CPIO = "cpio"
+FORMAT_GZIP = "gzip"
+FORMAT_LZ4_LEGACY = "lz4_legacy"
+FORMAT_LZ4_FRAME = "lz4"
+
+LZ4_LEGACY_MAGIC = b"\x02\x21\x4c\x18"
+LZ4_FRAME_MAGIC = b"\x04\x22\x4d\x18"
+LZ4_LEGACY_BLOCK_SIZE = 8 * 1024 * 1024
+
+S_IFDIR = 0o040000
+S_IFREG = 0o100000
+
+
+class MagiskPatchError(Exception):
+    """Image or Magisk APK can not be patched"""
+
+
+class CpioEntry:
+    """One member of a newc cpio archive"""
+
+    def __init__(self, name, mode, data=b"", uid=0, gid=0, mtime=0,
+                 dev=(0, 0), rdev=(0, 0)):
+        self.name = name
+        self.mode = mode
+        self.data = data
+        self.uid = uid
+        self.gid = gid
+        self.mtime = mtime
+        self.dev = dev
+        self.rdev = rdev
+
+    def __repr__(self):
+        return f"CpioEntry({self.name!r}, {self.mode:o}, {len(self.data)} bytes)"
+
+
+def _align4(offset):
+    return (offset + 3) & ~3
+
+
+def parse_cpio(data):
+    """{name: CpioEntry} of a newc archive in archive order"""
+    data = memoryview(data)
+    entries = {}
+    offset = 0
+    while offset + CPIO_HEADER_SIZE <= len(data):
+        if bytes(data[offset:offset + 6]) != CPIO_MAGIC:
+            raise MagiskPatchError(f"Ramdisk не является cpio newc (смещение {offset})")
+        fields = [int(bytes(data[offset + 6 + i * 8:offset + 14 + i * 8]), 16) for i in range(13)]
+        (_, mode, uid, gid, _, mtime, file_size,
+         dev_major, dev_minor, rdev_major, rdev_minor, name_size, _) = fields
+        name_start = offset + CPIO_HEADER_SIZE
+        name = bytes(data[name_start:name_start + name_size - 1]).decode("utf-8", errors="surrogateescape")
+        data_start = _align4(name_start + name_size)
+        if name == CPIO_TRAILER:
+            break
+        entries[name] = CpioEntry(name, mode, bytes(data[data_start:data_start + file_size]),
+                                  uid, gid, mtime, (dev_major, dev_minor), (rdev_major, rdev_minor))
+        offset = _align4(data_start + file_size)
+    return entries
+
+
+def write_cpio(entries):
+    """newc archive of entries sorted by name, inodes renumbered"""
+    parts = []
+    size = 0
+
+    def add(entry, ino):
+        nonlocal size
+        name = entry.name.encode("utf-8", errors="surrogateescape") + b"\0"
+        header = b"%s%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x" % (
+            CPIO_MAGIC, ino, entry.mode, entry.uid, entry.gid, 1, entry.mtime,
+            len(entry.data), entry.dev[0], entry.dev[1], entry.rdev[0], entry.rdev[1],
+            len(name), 0)
+        for part in (header + name, entry.data):
+            parts.append(part)
+            size += len(part)
+            padding = _align4(size) - size
+            if padding:
+                parts.append(bytes(padding))
+                size += padding
+
+    names = sorted(entries)
+    for ino, name in enumerate(names, 300000):
+        add(entries[name], ino)
+    add(CpioEntry(CPIO_TRAILER, 0), 0)
+    return b"".join(parts)
+
+
+def detect_format(data):
+    head = bytes(data[:6])
+    if head.startswith(b"\x1f\x8b"):
+        return FORMAT_GZIP
+    if head.startswith(LZ4_LEGACY_MAGIC):
+        return FORMAT_LZ4_LEGACY
+    if head.startswith(LZ4_FRAME_MAGIC):
+        return FORMAT_LZ4_FRAME
+    if head == CPIO_MAGIC:
+        return FORMAT_CPIO
+    raise MagiskPatchError("Неизвестный формат сжатия ramdisk")
+
+
+def _require_lz4():
+    if not LZ4_AVAILABLE:
+        raise MagiskPatchError("Ramdisk сжат LZ4, установите пакет lz4")
+
+
+def _lz4_legacy_decompress(data):
+    data = memoryview(data)
+    out = []
+    offset = len(LZ4_LEGACY_MAGIC)
+    while offset + 4 <= len(data):
+        block_size = struct.unpack_from("<I", data, offset)[0]
+        offset += 4
+        if bytes(data[offset - 4:offset]) == LZ4_LEGACY_MAGIC:
+            # Several legacy streams written back to back
+            continue
+        if not block_size or offset + block_size > len(data):
+            # Trailing uncompressed size or page padding
+            break
+        out.append(lz4.block.decompress(data[offset:offset + block_size],
+                                        uncompressed_size=LZ4_LEGACY_BLOCK_SIZE))
+        offset += block_size
+    return b"".join(out)
+
+
+def _lz4_legacy_compress(data):
+    data = memoryview(data)
+    parts = [LZ4_LEGACY_MAGIC]
+    for offset in range(0, len(data), LZ4_LEGACY_BLOCK_SIZE):
+        block = lz4.block.compress(data[offset:offset + LZ4_LEGACY_BLOCK_SIZE],
+                                   mode="high_compression", compression=12, store_size=False)
+        parts.append(struct.pack("<I", len(block)))
+        parts.append(block)
+    return b"".join(parts)
+
+
+def decompress_ramdisk(data):
+    """(format, cpio bytes) of a boot image ramdisk"""
+    fmt = detect_format(data)
+    if fmt == FORMAT_GZIP:
+        return fmt, gzip.decompress(data)
+    if fmt == FORMAT_LZ4_LEGACY:
+        _require_lz4()
+        return fmt, _lz4_legacy_decompress(data)
+    if fmt == FORMAT_LZ4_FRAME:
+        _require_lz4()
+        return fmt, lz4.frame.decompress(data)
+    return fmt, bytes(data)
+
+
+def compress_ramdisk(fmt, data):
+    """Compress a cpio archive back into the stock ramdisk format"""
+    if fmt == FORMAT_GZIP:
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if fmt == FORMAT_LZ4_LEGACY:
+        _require_lz4()
+        return _lz4_legacy_compress(data)
+    if fmt == FORMAT_LZ4_FRAME:
+        _require_lz4()
+        return lz4.frame.compress(data, compression_level=12)
+    return data
+
+
+def _xz(data):
+    return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32)
+
+
+class MagiskPackage:
+    """Magisk binaries and version read from a Magisk APK"""
+
+    def __init__(self, apk_path):
+        self.apk_path = apk_path
+        try:
+            with zipfile.ZipFile(apk_path) as apk:
+                names = set(apk.namelist())
+
+                def member(path):
+                    return apk.read(path) if path in names else None
+
+                script = member("assets/util_functions.sh")
+                self.magiskinit = member(f"lib/{MAGISK_ABI}/libmagiskinit.so")
+                self.magisk64 = member(f"lib/{MAGISK_ABI}/libmagisk64.so")
+                self.magisk = member(f"lib/{MAGISK_ABI}/libmagisk.so")
+                self.magisk32 = member(f"lib/{MAGISK_ABI32}/libmagisk32.so")
+                self.init_ld = member(f"lib/{MAGISK_ABI}/libinit-ld.so")
+                self.stub = member("assets/stub.apk")
+        except zipfile.BadZipFile as e:
+            raise MagiskPatchError(f"Не удалось открыть APK Magisk: {e}")
+        if script is None or self.magiskinit is None or (self.magisk64 or self.magisk) is None:
+            raise MagiskPatchError(f"В APK нет бинарников Magisk для {MAGISK_ABI}: {apk_path}")
+        script = script.decode("utf-8", errors="replace")
+        version = re.search(r"^MAGISK_VER='?([^'\n]+)'?", script, re.M)
+        code = re.search(r"^MAGISK_VER_CODE=(\d+)", script, re.M)
+        if not code:
+            raise MagiskPatchError("Не удалось определить версию Magisk")
+        self.version = version.group(1) if version else code.group(1)
+        self.version_code = int(code.group(1))
+
+    def overlay_files(self):
+        """{name in overlay.d/sbin: xz-compressed content}"""
+        files = {}
+        if self.magisk64 is not None:
+            files["magisk64.xz"] = _xz(self.magisk64)
+        else:
+            files["magisk.xz"] = _xz(self.magisk)
+        if self.magisk32 is not None:
+            files["magisk32.xz"] = _xz(self.magisk32)
+        if self.stub is not None:
+            files["stub.xz"] = _xz(self.stub)
+        if self.init_ld is not None:
+            files["init-ld.xz"] = _xz(self.init_ld)
+        return files
+
+
+def patch_ramdisk(cpio, package, stock_sha1, keep_verity=True, keep_force_encrypt=True):
+    """Inject Magisk into an uncompressed ramdisk cpio
+
+    The stock init goes to .backup/init and the names of added files to
+    .backup/.rmlist, so Magisk can restore the image on uninstall.
+    """
+    entries = parse_cpio(cpio)
+    if ".backup/.magisk" in entries:
+        raise MagiskPatchError("Образ уже пропатчен Magisk")
+    original = set(entries)
+    stock_init = entries.get("init")
+
+    entries["init"] = CpioEntry("init", S_IFREG | 0o750, package.magiskinit)
+    entries["overlay.d"] = CpioEntry("overlay.d", S_IFDIR | 0o750)
+    entries["overlay.d/sbin"] = CpioEntry("overlay.d/sbin", S_IFDIR | 0o750)
+    for name, data in package.overlay_files().items():
+        path = f"overlay.d/sbin/{name}"
+        entries[path] = CpioEntry(path, S_IFREG | 0o644, data)
+
+    added = sorted(set(entries) - original)
+    entries[".backup"] = CpioEntry(".backup", S_IFDIR)
+    if stock_init is not None:
+        entries[".backup/init"] = CpioEntry(".backup/init", stock_init.mode, stock_init.data,
+                                            stock_init.uid, stock_init.gid, stock_init.mtime)
+    if added:
+        rmlist = "".join(f"{name}\0" for name in added).encode("utf-8")
+        entries[".backup/.rmlist"] = CpioEntry(".backup/.rmlist", S_IFREG, rmlist)
+    config = (f"KEEPVERITY={str(keep_verity).lower()}\n"
+              f"KEEPFORCEENCRYPT={str(keep_force_encrypt).lower()}\n"
+              f"RECOVERYMODE=false\n"
+              f"SHA1={stock_sha1}\n")
+    entries[".backup/.magisk"] = CpioEntry(".backup/.magisk", S_IFREG, config.encode("ascii"))
+    return write_cpio(entries)
+
+
+def _sha1_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def patch_image(stock_path, package, out_path):
+    """Write a Magisk-patched copy of a boot or init_boot image
+
+    package is a MagiskPackage or the path of a Magisk APK. The AVB footer
+    of the stock image is kept so the image still fits its partition.
+    """
+    if not isinstance(package, MagiskPackage):
+        package = MagiskPackage(package)
+    with boot_image.open_image(stock_path) as image:
+        if not isinstance(image, boot_image.BootImage):
+            raise MagiskPatchError("Magisk патчит boot или init_boot, а не vendor_boot")
+        if not image.ramdisk_size:
+            raise MagiskPatchError("В образе нет ramdisk, используйте init_boot.img")
+        fmt, cpio = decompress_ramdisk(image.ramdisk)
+        ramdisk = compress_ramdisk(fmt, patch_ramdisk(cpio, package, _sha1_file(stock_path)))
+        image.repack(out_path, ramdisk=ramdisk, keep_avb=True)
+    return out_path
+
+
+def find_stock_image(directory):
+    """init_boot.img or boot.img of a firmware version directory"""
+    found = {}
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            name = filename.lower()
+            if name in STOCK_IMAGE_NAMES and name not in found:
+                found[name] = os.path.join(dirpath, filename)
+    for name in STOCK_IMAGE_NAMES:
+        if name in found:
+            return found[name]
+    return None
+
+
+class PatchCache:
+    """Patched images keyed by (stock image sha256, Magisk version code)"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, stock_digest, version_code):
+        return os.path.join(self.cache_dir, f"{stock_digest}-{version_code}.img")
+
+    def get(self, stock_digest, version_code):
+        path = self.path(stock_digest, version_code)
+        return path if os.path.exists(path) else None
+
+
+_worker_package = None
+
+
+def _init_worker(apk_path):
+    global _worker_package
+    _worker_package = MagiskPackage(apk_path)
+
+
+def _patch_task(stock_path, out_path):
+    # Written under a temporary name, a killed worker leaves no half image
+    tmp_path = out_path + ".tmp"
+    try:
+        patch_image(stock_path, _worker_package, tmp_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def batch_patch(stock_images, apk_path, cache_dir, max_workers=None, progress=None):
+    """Patch many stock images with one Magisk APK in a process pool
+
+    stock_images is {label: image path}, returns {label: patched image in
+    the cache}. Identical stock images of different versions are patched
+    once. progress(done, total) is called as images finish.
+    """
+    package = MagiskPackage(apk_path)
+    cache = PatchCache(cache_dir)
+    digests = {label: hash_file(path) for label, path in stock_images.items()}
+    results = {}
+    pending = {}
+    for label, digest in digests.items():
+        cached = cache.get(digest, package.version_code)
+        if cached:
+            results[label] = cached
+        else:
+            pending.setdefault(digest, stock_images[label])
+
+    total = len(pending)
+    if pending:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(apk_path,)) as executor:
+            futures = {executor.submit(_patch_task, path,
+                                       cache.path(digest, package.version_code)): digest
+                       for digest, path in pending.items()}
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                if progress:
+                    progress(done, total)
+
+    for label, digest in digests.items():
+        results.setdefault(label, cache.path(digest, package.version_code))
+    return results
+
+
+def patched_name(stock_path):
+    stem, ext = os.path.splitext(os.path.basename(stock_path))
+    return f"{stem}{PATCHED_SUFFIX}{ext}"
+
+
+def patch_firmware_versions(base_path, apk_path, cache_dir, max_workers=None, progress=None):
+    """Patch the stock image of every HyperOS version folder
+
+    The patched image is placed next to the stock one as e.g.
+    init_boot_magisk.img. Returns {version folder: patched image path}.
+    """
+    stock_images = {}
+    root = os.path.join(base_path, FIRMWARE_ROOT)
+    for family in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        family_dir = os.path.join(root, family)
+        if not os.path.isdir(family_dir):
+            continue
+        for version in sorted(os.listdir(family_dir)):
+            stock = find_stock_image(os.path.join(family_dir, version))
+            if stock:
+                stock_images[os.path.join(family_dir, version)] = stock
+    if not stock_images:
+        raise MagiskPatchError(f"Не найдено стоковых boot/init_boot в {root}")
+
+    patched = batch_patch(stock_images, apk_path, cache_dir, max_workers, progress)
+    outputs = {}
+    for directory, cached in patched.items():
+        stock = stock_images[directory]
+        target = os.path.join(os.path.dirname(stock), patched_name(stock))
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(cached, target)
+        except OSError:
+            shutil.copyfile(cached, target)
+        outputs[directory] = target
+    return outputs
+
+
+def main():
+    """Command line: magisk_patch.py APK IMAGE [OUT] | magisk_patch.py APK --all BASE_PATH"""
+    if len(sys.argv) < 3:
+        print(main.__doc__)
+        return 1
+    apk_path = sys.argv[1]
+    if sys.argv[2] == "--all" and len(sys.argv) == 4:
+        base_path = sys.argv[3]
+        outputs = patch_firmware_versions(
+            base_path, apk_path, os.path.join(base_path, "cache", "magisk"),
+            progress=lambda done, total: print(f"Пропатчено {done}/{total}"))
+        for target in outputs.values():
+            print(target)
+    elif len(sys.argv) in (3, 4):
+        stock = sys.argv[2]
+        out_path = sys.argv[3] if len(sys.argv) == 4 else os.path.join(
+            os.path.dirname(stock), patched_name(stock))
+        package = MagiskPackage(apk_path)
+        patch_image(stock, package, out_path)
+        print(f"Magisk {package.version} ({package.version_code}): {out_path}")
+    else:
+        print(main.__doc__)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,575 @@
+"""
+OTA payload.bin extractor for ProshivkaTool
+
+Turns official HyperOS/MIUI recovery OTA packages into fastboot images.
+payload.bin is read straight out of the zip (it is stored uncompressed),
+the operations of every partition are spread over a process pool and the
+output images are preallocated and written through mmap. Incremental
+payloads are applied against the previous version's images, for example
+from the local firmware store: sparse and compressed base images are
+expanded first, logical partitions are unpacked from the base super.img.
+"""
+import bz2
+import hashlib
+import lzma
+import mmap
+import os
+import shutil
+import struct
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import compressed_image
+import firmware_store
+import sparse_image
+import super_image
+
+# Brotli is only needed for BROTLI_BSDIFF patches
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+# NumPy makes the bsdiff byte-wise addition run at memory speed
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+PAYLOAD_MAGIC = b"CrAU"
+# Operations per task are grouped up to this many bytes of payload data
+TASK_DATA_SIZE = 64 * 1024 * 1024
+
+# InstallOperation.Type
+OP_REPLACE = 0
+OP_REPLACE_BZ = 1
+OP_MOVE = 2
+OP_BSDIFF = 3
+OP_SOURCE_COPY = 4
+OP_SOURCE_BSDIFF = 5
+OP_ZERO = 6
+OP_DISCARD = 7
+OP_REPLACE_XZ = 8
+OP_PUFFDIFF = 9
+OP_BROTLI_BSDIFF = 10
+
+OPERATION_NAMES = {
+    OP_REPLACE: "REPLACE", OP_REPLACE_BZ: "REPLACE_BZ", OP_MOVE: "MOVE",
+    OP_BSDIFF: "BSDIFF", OP_SOURCE_COPY: "SOURCE_COPY", OP_SOURCE_BSDIFF: "SOURCE_BSDIFF",
+    OP_ZERO: "ZERO", OP_DISCARD: "DISCARD", OP_REPLACE_XZ: "REPLACE_XZ",
+    OP_PUFFDIFF: "PUFFDIFF", OP_BROTLI_BSDIFF: "BROTLI_BSDIFF",
+}
+FULL_OPERATIONS = (OP_REPLACE, OP_REPLACE_BZ, OP_REPLACE_XZ, OP_ZERO, OP_DISCARD)
+SOURCE_OPERATIONS = (OP_SOURCE_COPY, OP_SOURCE_BSDIFF, OP_BROTLI_BSDIFF)
+
+
+class PayloadError(Exception):
+    """Malformed payload or unsupported operation"""
+
+
+# --- Minimal protobuf wire format decoder -------------------------------
+
+def _read_varint(data, offset):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, offset
+        shift += 7
+
+
+def decode_message(data):
+    """Decode a protobuf message into {field number: [raw values]}
+
+    Length-delimited values stay bytes, callers decode nested messages.
+    """
+    fields = {}
+    offset = 0
+    end = len(data)
+    while offset < end:
+        key, offset = _read_varint(data, offset)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, offset = _read_varint(data, offset)
+        elif wire_type == 1:
+            value = struct.unpack_from("<Q", data, offset)[0]
+            offset += 8
+        elif wire_type == 2:
+            length, offset = _read_varint(data, offset)
+            value = bytes(data[offset:offset + length])
+            offset += length
+        elif wire_type == 5:
+            value = struct.unpack_from("<I", data, offset)[0]
+            offset += 4
+        else:
+            raise PayloadError(f"Неподдерживаемый тип поля protobuf: {wire_type}")
+        fields.setdefault(number, []).append(value)
+    return fields
+
+
+def _first(fields, number, default=None):
+    values = fields.get(number)
+    return values[0] if values else default
+
+
+def _extents(values):
+    extents = []
+    for raw in values or []:
+        fields = decode_message(raw)
+        extents.append((_first(fields, 1, 0), _first(fields, 2, 0)))
+    return extents
+
+
+class Operation:
+    """InstallOperation: type, payload data range and block extents"""
+
+    __slots__ = ("type", "data_offset", "data_length", "src_extents",
+                 "dst_extents", "data_sha256", "src_sha256")
+
+    def __init__(self, raw):
+        fields = decode_message(raw)
+        self.type = _first(fields, 1)
+        self.data_offset = _first(fields, 2, 0)
+        self.data_length = _first(fields, 3, 0)
+        self.src_extents = _extents(fields.get(4))
+        self.dst_extents = _extents(fields.get(6))
+        self.data_sha256 = _first(fields, 8)
+        self.src_sha256 = _first(fields, 9)
+
+    def as_tuple(self):
+        """Picklable form sent to worker processes"""
+        return (self.type, self.data_offset, self.data_length, self.src_extents,
+                self.dst_extents, self.data_sha256, self.src_sha256)
+
+
+class PartitionUpdate:
+    """PartitionUpdate: name, sizes/hashes and operations"""
+
+    def __init__(self, raw):
+        fields = decode_message(raw)
+        self.name = _first(fields, 1, b"").decode()
+        old_info = decode_message(_first(fields, 6, b""))
+        new_info = decode_message(_first(fields, 7, b""))
+        self.old_size = _first(old_info, 1, 0)
+        self.old_hash = _first(old_info, 2)
+        self.new_size = _first(new_info, 1, 0)
+        self.new_hash = _first(new_info, 2)
+        self.operations = [Operation(op) for op in fields.get(8, [])]
+
+    @property
+    def is_full(self):
+        return all(op.type in FULL_OPERATIONS for op in self.operations)
+
+
+class Payload:
+    """Parsed payload.bin header and manifest"""
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.offset = offset
+        with open(path, "rb") as f:
+            f.seek(offset)
+            header = f.read(24)
+            if header[:4] != PAYLOAD_MAGIC:
+                raise PayloadError("Это не payload.bin: неверная сигнатура")
+            self.version, manifest_size = struct.unpack(">QQ", header[4:20])
+            if self.version != 2:
+                raise PayloadError(f"Неподдерживаемая версия payload: {self.version}")
+            signature_size = struct.unpack(">I", header[20:24])[0]
+            manifest = f.read(manifest_size)
+        fields = decode_message(manifest)
+        self.block_size = _first(fields, 3, 4096)
+        self.minor_version = _first(fields, 12, 0)
+        self.partitions = [PartitionUpdate(raw) for raw in fields.get(13, [])]
+        # Operation data offsets are relative to the end of the metadata
+        self.data_offset = offset + 24 + manifest_size + signature_size
+
+    @property
+    def is_full(self):
+        return all(partition.is_full for partition in self.partitions)
+
+    def partition(self, name):
+        for partition in self.partitions:
+            if partition.name == name:
+                return partition
+        raise PayloadError(f"Раздел отсутствует в payload: {name}")
+
+
+def locate_payload(path):
+    """(file, offset) of payload.bin, reading through the OTA zip if needed"""
+    if not zipfile.is_zipfile(path):
+        return path, 0
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo("payload.bin")
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise PayloadError("payload.bin сжат внутри zip, нужна распаковка")
+    # The local header may carry a different extra field than the
+    # central directory, so its length is read from the file itself
+    with open(path, "rb") as f:
+        f.seek(info.header_offset)
+        local = f.read(30)
+        if local[:4] != b"PK\x03\x04":
+            raise PayloadError("Повреждён локальный заголовок zip")
+        name_length, extra_length = struct.unpack("<HH", local[26:30])
+    return path, info.header_offset + 30 + name_length + extra_length
+
+
+def open_payload(path):
+    """Payload from a payload.bin or an OTA zip, without unpacking"""
+    return Payload(*locate_payload(path))
+
+
+def _read_data(f, base, op):
+    f.seek(base + op[1])
+    data = f.read(op[2])
+    if len(data) != op[2]:
+        raise PayloadError("payload.bin обрезан")
+    if op[5] and hashlib.sha256(data).digest() != op[5]:
+        raise PayloadError("Не совпадает хеш данных операции")
+    return data
+
+
+def _write_extents(out, extents, data, block_size):
+    """Scatter data over destination extents of a mapped image"""
+    position = 0
+    for start, count in extents:
+        length = count * block_size
+        piece = data[position:position + length]
+        out[start * block_size:start * block_size + len(piece)] = piece
+        position += length
+
+
+def _read_extents(source, extents, block_size):
+    """Concatenate source extents, the 'old' side of SOURCE_* operations"""
+    return b"".join(source[start * block_size:(start + count) * block_size]
+                    for start, count in extents)
+
+
+def _offtin(data, offset):
+    """bsdiff sign-magnitude 64-bit integer"""
+    value = struct.unpack_from("<Q", data, offset)[0]
+    if value & (1 << 63):
+        return -(value & ~(1 << 63))
+    return value
+
+
+def _decompress_stream(kind, data):
+    if kind == 0:
+        return data
+    if kind == 1:
+        return bz2.decompress(data)
+    if kind == 2:
+        if not BROTLI_AVAILABLE:
+            raise PayloadError("Для BROTLI_BSDIFF нужен пакет brotli")
+        return brotli.decompress(data)
+    raise PayloadError(f"Неизвестное сжатие bsdiff: {kind}")
+
+
+def _add_bytes(diff, old):
+    """Byte-wise (diff + old) mod 256"""
+    if NUMPY_AVAILABLE:
+        return (np.frombuffer(diff, np.uint8) + np.frombuffer(old, np.uint8)).tobytes()
+    return bytes((a + b) & 0xFF for a, b in zip(diff, old))
+
+
+def bspatch(old, patch):
+    """Apply a BSDIFF40 or BSDF2 patch to old, return the new bytes"""
+    if patch[:8] == b"BSDIFF40":
+        kinds = (1, 1, 1)
+    elif patch[:5] == b"BSDF2":
+        kinds = tuple(patch[5:8])
+    else:
+        raise PayloadError("Неизвестный формат патча bsdiff")
+    ctrl_length = _offtin(patch, 8)
+    diff_length = _offtin(patch, 16)
+    new_size = _offtin(patch, 24)
+    position = 32
+    ctrl = _decompress_stream(kinds[0], patch[position:position + ctrl_length])
+    position += ctrl_length
+    diff = _decompress_stream(kinds[1], patch[position:position + diff_length])
+    position += diff_length
+    extra = _decompress_stream(kinds[2], patch[position:])
+
+    new = bytearray(new_size)
+    new_pos = old_pos = diff_pos = extra_pos = ctrl_pos = 0
+    while new_pos < new_size:
+        add_length = _offtin(ctrl, ctrl_pos)
+        copy_length = _offtin(ctrl, ctrl_pos + 8)
+        seek = _offtin(ctrl, ctrl_pos + 16)
+        ctrl_pos += 24
+        if add_length < 0 or copy_length < 0 or new_pos + add_length + copy_length > new_size:
+            raise PayloadError("Повреждён патч bsdiff")
+        if add_length:
+            # Positions outside old count as zero bytes
+            start = min(max(old_pos, 0), len(old))
+            end = min(max(old_pos + add_length, 0), len(old))
+            leading = min(max(-old_pos, 0), add_length)
+            old_part = bytes(leading) + old[start:end]
+            old_part += bytes(add_length - len(old_part))
+            new[new_pos:new_pos + add_length] = _add_bytes(diff[diff_pos:diff_pos + add_length], old_part)
+            new_pos += add_length
+            old_pos += add_length
+            diff_pos += add_length
+        new[new_pos:new_pos + copy_length] = extra[extra_pos:extra_pos + copy_length]
+        new_pos += copy_length
+        extra_pos += copy_length
+        old_pos += seek
+    return bytes(new)
+
+
+def _apply(op, data, out, block_size, source):
+    kind = op[0]
+    if kind == OP_REPLACE:
+        _write_extents(out, op[4], data, block_size)
+    elif kind == OP_REPLACE_BZ:
+        _write_extents(out, op[4], bz2.decompress(data), block_size)
+    elif kind == OP_REPLACE_XZ:
+        _write_extents(out, op[4], lzma.decompress(data), block_size)
+    elif kind in (OP_ZERO, OP_DISCARD):
+        # Output files start out as holes, which read back as zeros
+        pass
+    elif kind in SOURCE_OPERATIONS:
+        if source is None:
+            raise PayloadError(f"Операция {OPERATION_NAMES[kind]} требует исходный образ")
+        old = _read_extents(source, op[3], block_size)
+        if op[6] and hashlib.sha256(old).digest() != op[6]:
+            raise PayloadError("Исходный образ не совпадает с базовой версией OTA")
+        if kind == OP_SOURCE_COPY:
+            _write_extents(out, op[4], old, block_size)
+        else:
+            _write_extents(out, op[4], bspatch(old, data), block_size)
+    else:
+        raise PayloadError(f"Операция {OPERATION_NAMES.get(kind, kind)} не поддерживается")
+
+
+def _run_task(payload_path, data_base, block_size, out_path, ops, source_path=None):
+    """Worker: apply a batch of operations of one partition"""
+    with open(payload_path, "rb") as f, open(out_path, "r+b") as out_file:
+        size = os.fstat(out_file.fileno()).st_size
+        source_file = open(source_path, "rb") if source_path else None
+        source = None
+        try:
+            if source_file and os.fstat(source_file.fileno()).st_size:
+                source = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+            with mmap.mmap(out_file.fileno(), size) as out:
+                for op in ops:
+                    data = _read_data(f, data_base, op) if op[2] else b""
+                    _apply(op, data, out, block_size, source)
+        finally:
+            if source is not None:
+                source.close()
+            if source_file:
+                source_file.close()
+    return sum(op[2] for op in ops)
+
+
+def _batches(operations, block_size, limit=TASK_DATA_SIZE):
+    """Group operations into tasks of about limit bytes
+
+    Payload data and source blocks both count, so the memory a worker
+    holds for one task stays bounded.
+    """
+    batch = []
+    size = 0
+    for op in operations:
+        batch.append(op.as_tuple())
+        size += op.data_length + block_size * sum(count for _, count in op.src_extents)
+        if size >= limit:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def _preallocate(path, size):
+    with open(path, "wb") as f:
+        f.truncate(size)
+
+
+def verify_image(path, expected_hash):
+    if not expected_hash:
+        return True
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            digest.update(block)
+    return digest.digest() == expected_hash
+
+
+def extract(source, output_dir, partitions=None, max_workers=None, progress=None, verify=True,
+            source_images=None):
+    """Extract partitions of source into output_dir/<name>.img
+
+    source_images maps partition names to images of the base version and
+    is required for incremental payloads. progress(done_bytes,
+    total_bytes) counts payload data consumed. Returns the written paths.
+    """
+    payload = open_payload(source)
+    source_images = source_images or {}
+    selected = [p for p in payload.partitions if partitions is None or p.name in partitions]
+    for partition in selected:
+        if not partition.is_full and partition.name not in source_images:
+            raise PayloadError(f"{partition.name}: инкрементальный payload, нужен исходный образ")
+        if any(op.type not in FULL_OPERATIONS + SOURCE_OPERATIONS for op in partition.operations):
+            kinds = {OPERATION_NAMES.get(op.type, str(op.type)) for op in partition.operations
+                     if op.type not in FULL_OPERATIONS + SOURCE_OPERATIONS}
+            raise PayloadError(f"{partition.name}: не поддерживаются операции {', '.join(sorted(kinds))}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    outputs = {}
+    for partition in selected:
+        outputs[partition.name] = os.path.join(output_dir, f"{partition.name}.img")
+        _preallocate(outputs[partition.name], partition.new_size)
+
+    total = sum(op.data_length for p in selected for op in p.operations)
+    done = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for partition in selected:
+            source_path = None if partition.is_full else source_images[partition.name]
+            for batch in _batches(partition.operations, payload.block_size):
+                futures.append(executor.submit(_run_task, payload.path, payload.data_offset,
+                                               payload.block_size, outputs[partition.name], batch,
+                                               source_path))
+        for future in as_completed(futures):
+            done += future.result()
+            if progress:
+                progress(done, total)
+
+    if verify:
+        for partition in selected:
+            if not verify_image(outputs[partition.name], partition.new_hash):
+                raise PayloadError(f"{partition.name}: хеш образа не совпадает с манифестом")
+    return [outputs[partition.name] for partition in selected]
+
+
+def _manifest_image(manifest, name):
+    """Relative path of name.img, or of a compressed variant, in a store manifest"""
+    for relative in manifest:
+        filename = os.path.basename(relative)
+        if compressed_image.is_compressed(filename):
+            filename = os.path.splitext(filename)[0]
+        if filename == f"{name}.img":
+            return relative
+    return None
+
+
+def _raw_image(path, work_dir, name):
+    """path as a plain raw image, decompressed and unsparsed into work_dir if needed"""
+    if compressed_image.is_compressed(path):
+        target = os.path.join(work_dir, f"{name}.unpacked.img")
+        compressed_image.decompress_file(path, target)
+        path = target
+    if sparse_image.is_sparse(path):
+        target = os.path.join(work_dir, f"{name}.raw.img")
+        sparse_image.sparse_to_raw(path, target)
+        if os.path.dirname(path) == work_dir:
+            os.remove(path)
+        path = target
+    return path
+
+
+def store_source_images(store, version, payload, work_dir, partitions=None):
+    """Raw base images of an incremental payload, taken from the firmware store
+
+    SOURCE_* operations address raw blocks: sparse or compressed images
+    are expanded into work_dir, and partitions stored only inside the base
+    super.img (system, vendor, product ...) are unpacked from it.
+    """
+    manifest = store.manifest(version)
+    os.makedirs(work_dir, exist_ok=True)
+    images = {}
+    logical = []
+    for partition in payload.partitions:
+        if partition.is_full or (partitions is not None and partition.name not in partitions):
+            continue
+        relative = _manifest_image(manifest, partition.name)
+        if relative is None:
+            logical.append(partition.name)
+            continue
+        images[partition.name] = _raw_image(store.open_image(version, relative), work_dir,
+                                            partition.name)
+    if not logical:
+        return images
+    relative = _manifest_image(manifest, "super")
+    if relative is None:
+        raise PayloadError(f"В версии {version} нет образов {', '.join(logical)} и super.img")
+    super_path = store.open_image(version, relative)
+    if compressed_image.is_compressed(super_path):
+        # SuperImage reads sparse images itself, only the compression has to go
+        target = os.path.join(work_dir, "super.unpacked.img")
+        compressed_image.decompress_file(super_path, target)
+        super_path = target
+    with super_image.SuperImage(super_path) as image:
+        available = {entry.name for entry in image.partitions() if entry.size}
+    # An A/B super names them system_a/system_b, the payload just system
+    names = {}
+    for name in logical:
+        for candidate in (name, f"{name}_a", f"{name}_b"):
+            if candidate in available:
+                names[name] = candidate
+                break
+        else:
+            raise PayloadError(f"В версии {version} нет образа {name}.img, в super.img его тоже нет")
+    super_image.extract(super_path, work_dir, list(names.values()))
+    for name, candidate in names.items():
+        images[name] = os.path.join(work_dir, f"{candidate}.img")
+    return images
+
+
+def apply_incremental(source, output_dir, store, base_version, new_version=None, **kwargs):
+    """Build full images of an incremental OTA from a version in the store
+
+    Expanded base images live in output_dir/.base while the payload is
+    applied. With new_version the result is imported into the store as well.
+    """
+    payload = open_payload(source)
+    work_dir = os.path.join(output_dir, ".base")
+    try:
+        source_images = store_source_images(store, base_version, payload, work_dir,
+                                            kwargs.get("partitions"))
+        images = extract(source, output_dir, source_images=source_images, **kwargs)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if new_version:
+        store.import_version(new_version, output_dir)
+    return images
+
+
+def main():
+    """Command line: payload_extractor.py OTA.zip|payload.bin OUTPUT_DIR [PARTITION ...]
+    payload_extractor.py incremental STORE BASE_VERSION OTA.zip|payload.bin OUTPUT_DIR [PARTITION ...]
+
+    Incremental OTAs need the version they update from in the firmware
+    store; firmware_store.py STORE list shows the versions.
+    """
+    incremental = len(sys.argv) > 1 and sys.argv[1] == "incremental"
+    if len(sys.argv) < (6 if incremental else 3):
+        print(main.__doc__)
+        return 1
+
+    def progress(done, total):
+        print(f"\r{done * 100 // max(total, 1)}%", end="", flush=True)
+    try:
+        if incremental:
+            store = firmware_store.FirmwareStore(sys.argv[2])
+            images = apply_incremental(sys.argv[4], sys.argv[5], store, sys.argv[3],
+                                       partitions=sys.argv[6:] or None, progress=progress)
+        else:
+            images = extract(sys.argv[1], sys.argv[2], sys.argv[3:] or None, progress=progress)
+    except (PayloadError, FileNotFoundError, super_image.SuperError) as e:
+        print(f"\nОшибка: {e}")
+        return 1
+    print(f"\nИзвлечено образов: {len(images)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,490 @@
+"""
+Fastboot ROM archives (.tgz / .zip) for ProshivkaTool
+
+Official Xiaomi fastboot ROMs are multi-GB archives. Zip members are
+independent and are unpacked on several threads at once, each thread with
+its own handle on the archive. A tar.gz is one compressed stream, so one
+thread decompresses it and hands the data of each file to writer threads
+through bounded queues; decompression and disk writes overlap. Output
+files are preallocated and progress reports the throughput in MB/s.
+
+RomArchive flashes straight from the archive instead: only the flash
+scripts are unpacked, images are streamed member by member into the
+fastboot transfer.
+"""
+import hashlib
+import json
+import os
+import queue
+import shutil
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+# Chunks waiting per writer thread, bounds memory to writers * 8 * 4 MiB
+WRITER_QUEUE_CHUNKS = 8
+# Images a tar.gz stream has to pass before the plan needs them are parked
+# on disk up to this size, so flashing never decompresses the archive twice
+SPOOL_LIMIT = 8 * 1024 ** 3
+# Disk space left free when spooling
+SPOOL_RESERVE = 1024 ** 3
+ARCHIVE_EXTENSIONS = (".tgz", ".tar.gz", ".tar", ".zip")
+
+
+class RomArchiveError(Exception):
+    """Archive can not be unpacked"""
+
+
+def is_rom_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def _target_path(output_dir, name):
+    """Output path of an archive member, refusing names that leave output_dir"""
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or ".." in parts or ":" in parts[0]:
+        raise RomArchiveError(f"Недопустимое имя в архиве: {name}")
+    return os.path.join(output_dir, *parts)
+
+
+def _preallocate(f, size):
+    """Reserve the whole output file up front, fewer fragments on disk"""
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    f.truncate(size)
+
+
+class _Meter:
+    """Thread-safe byte counter calling progress(done, total, mb_per_s)"""
+
+    def __init__(self, total, progress):
+        self.total = total
+        self.progress = progress
+        self.done = 0
+        self.written = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def rate(self):
+        elapsed = time.monotonic() - self.started
+        return self.written / elapsed / 1024 ** 2 if elapsed > 0 else 0.0
+
+    def add(self, written, done=None):
+        with self.lock:
+            self.written += written
+            self.done = self.done + written if done is None else done
+            current = self.done
+        if self.progress:
+            self.progress(current, self.total, self.rate())
+
+
+def _copy(source, target, size, meter):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "wb") as out:
+        _preallocate(out, size)
+        while True:
+            chunk = source.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+            meter.add(len(chunk))
+        out.truncate()
+
+
+def _extract_zip(path, output_dir, max_workers, meter):
+    with zipfile.ZipFile(path) as archive:
+        members = [info for info in archive.infolist() if not info.is_dir()]
+    meter.total = sum(info.file_size for info in members)
+    handles = []
+    local = threading.local()
+    lock = threading.Lock()
+
+    def work(info):
+        # zipfile serialises reads of one handle, so every thread opens its own
+        archive = getattr(local, "archive", None)
+        if archive is None:
+            archive = local.archive = zipfile.ZipFile(path)
+            with lock:
+                handles.append(archive)
+        target = _target_path(output_dir, info.filename)
+        with archive.open(info) as source:
+            _copy(source, target, info.file_size, meter)
+        return info.filename, target
+
+    # Biggest members first so super.img does not start last
+    members.sort(key=lambda info: info.file_size, reverse=True)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="unzip") as executor:
+            return dict(executor.map(work, members))
+    finally:
+        for archive in handles:
+            archive.close()
+
+
+class _CountingReader:
+    """File wrapper counting compressed bytes consumed by tarfile"""
+
+    def __init__(self, f):
+        self.f = f
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.position += len(data)
+        return data
+
+
+class _Writer(threading.Thread):
+    """Writes the files handed to it in order, chunk by chunk"""
+
+    def __init__(self, meter, reader):
+        super().__init__(daemon=True, name="untar-writer")
+        self.queue = queue.Queue(maxsize=WRITER_QUEUE_CHUNKS)
+        self.meter = meter
+        self.reader = reader
+        self.error = None
+
+    def run(self):
+        out = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error:
+                # Keep draining so the decompressor never blocks on a full queue
+                continue
+            kind, value = item
+            try:
+                if kind == "open":
+                    target, size = value
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    out = open(target, "wb")
+                    _preallocate(out, size)
+                elif kind == "data":
+                    out.write(value)
+                    self.meter.add(len(value), self.reader.position)
+                else:
+                    out.truncate()
+                    out.close()
+                    out = None
+            except OSError as e:
+                self.error = e
+        if out:
+            out.close()
+
+
+def _extract_tar(path, output_dir, max_workers, meter):
+    meter.total = os.path.getsize(path)
+    extracted = {}
+    with open(path, "rb") as raw:
+        reader = _CountingReader(raw)
+        writers = [_Writer(meter, reader) for _ in range(max(1, max_workers or 1))]
+        for writer in writers:
+            writer.start()
+        try:
+            with tarfile.open(fileobj=reader, mode="r|*") as archive:
+                for index, member in enumerate(m for m in archive if m.isfile()):
+                    failed = [writer.error for writer in writers if writer.error]
+                    if failed:
+                        raise failed[0]
+                    target = _target_path(output_dir, member.name)
+                    # Whole files go to one writer, so each file is written sequentially
+                    writer = writers[index % len(writers)]
+                    writer.queue.put(("open", (target, member.size)))
+                    source = archive.extractfile(member)
+                    while True:
+                        chunk = source.read(COPY_BUFFER_SIZE)
+                        if not chunk:
+                            break
+                        writer.queue.put(("data", chunk))
+                    writer.queue.put(("close", None))
+                    extracted[member.name] = target
+        except tarfile.TarError as e:
+            raise RomArchiveError(f"Повреждённый архив: {e}")
+        finally:
+            for writer in writers:
+                writer.queue.put(None)
+            for writer in writers:
+                writer.join()
+    failed = [writer.error for writer in writers if writer.error]
+    if failed:
+        raise failed[0]
+    return extracted
+
+
+def extract(path, output_dir, max_workers=4, progress=None):
+    """Unpack a fastboot ROM archive into output_dir
+
+    progress(done, total, mb_per_s) is called from worker threads; done and
+    total count uncompressed bytes for zip and archive bytes for tar, the
+    rate is always the output written per second. Returns {member name:
+    extracted path}.
+    """
+    meter = _Meter(0, progress)
+    if zipfile.is_zipfile(path):
+        return _extract_zip(path, output_dir, max_workers, meter)
+    if tarfile.is_tarfile(path):
+        return _extract_tar(path, output_dir, max_workers, meter)
+    raise RomArchiveError(f"Не архив zip/tar: {path}")
+
+
+def find_flash_script(directory, name="flash_all.bat"):
+    """Flash script of an unpacked ROM, which sits one folder deep"""
+    for dirpath, _, filenames in os.walk(directory):
+        if name in filenames:
+            return os.path.join(dirpath, name)
+    return None
+
+
+def _member_name(name):
+    return "/".join(part for part in name.replace("\\", "/").split("/") if part not in ("", "."))
+
+
+class RomArchive:
+    """Images of a ROM archive, read without unpacking it
+
+    The member list and the flash scripts are cached under cache_dir by
+    archive path, size and mtime: a tar.gz has to be decompressed once to
+    list it, flashing the same ROM on the next phone starts immediately.
+    Scripts are unpacked into root with the archive layout, so a plan
+    compiled from them names images as root/<member path>.
+
+    A plain tar is read at random. A compressed tar is read forward once
+    per flash: after expect() names the images in flash order, the ones
+    the stream passes before they are due are spooled under root/spool
+    (up to spool_limit bytes) and served from there. Only an image that
+    did not fit the spool forces decompression from the start again.
+    """
+
+    def __init__(self, path, cache_dir, spool_limit=SPOOL_LIMIT):
+        self.path = path
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        self.root = os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+        self.is_zip = zipfile.is_zipfile(path)
+        self._zip = zipfile.ZipFile(path) if self.is_zip else None
+        self._zip_members = {}
+        if self._zip:
+            self._zip_members = {_member_name(info.filename): info
+                                 for info in self._zip.infolist() if not info.is_dir()}
+        self._tar = None
+        self._raw = None
+        self._passed = set()
+        self.members = self._load_index()
+        # Uncompressed tar: every member is reachable by seeking
+        self._random_tar = None
+        self._random_members = {}
+        if not self.is_zip:
+            try:
+                self._random_tar = tarfile.open(self.path, mode="r:")
+            except tarfile.TarError:
+                pass
+            else:
+                self._random_members = {_member_name(member.name): member
+                                        for member in self._random_tar.getmembers()
+                                        if member.isfile()}
+        self.spool_dir = os.path.join(self.root, "spool")
+        self.spool_limit = spool_limit
+        # member name -> flashes still to come, member name -> spooled copy
+        self._expected = Counter()
+        self._spooled = {}
+        self._spool_bytes = 0
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._close_tar()
+        if self._random_tar:
+            self._random_tar.close()
+            self._random_tar = None
+        self._expected.clear()
+        self._release_spool()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+        if self._zip:
+            self._zip.close()
+            self._zip = None
+
+    def _close_tar(self):
+        if self._tar:
+            self._tar.close()
+            self._raw.close()
+            self._tar = self._raw = None
+
+    def _load_index(self):
+        index_path = os.path.join(self.root, "index.json")
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+        os.makedirs(self.root, exist_ok=True)
+        members = {}
+        if self.is_zip:
+            for name, info in self._zip_members.items():
+                members[name] = info.file_size
+                if name.lower().endswith(".bat"):
+                    with self._zip.open(info) as source:
+                        self._save_script(name, source.read())
+        else:
+            try:
+                # Seekable mode skips the data of a plain tar instead of reading it
+                with tarfile.open(self.path, mode="r:*") as archive:
+                    for member in archive:
+                        if not member.isfile():
+                            continue
+                        name = _member_name(member.name)
+                        members[name] = member.size
+                        if name.lower().endswith(".bat"):
+                            self._save_script(name, archive.extractfile(member).read())
+            except tarfile.TarError as e:
+                raise RomArchiveError(f"Повреждённый архив: {e}")
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(members, f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+        return members
+
+    def _save_script(self, name, data):
+        target = _target_path(self.root, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as f:
+            f.write(data)
+
+    def script(self, name="flash_all.bat"):
+        """Unpacked copy of a flash script of the archive"""
+        matches = sorted((member for member in self.members
+                          if member.rsplit("/", 1)[-1].lower() == name.lower()),
+                         key=lambda member: member.count("/"))
+        if not matches:
+            raise RomArchiveError(f"В архиве нет {name}")
+        return _target_path(self.root, matches[0])
+
+    def member_for(self, path):
+        """Member name of a path under root, None when it is not in the archive"""
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+        name = _member_name(relative)
+        return name if name in self.members else None
+
+    def has(self, path):
+        return self.member_for(path) is not None
+
+    def size(self, path):
+        return self.members[self.member_for(path)]
+
+    def expect(self, paths):
+        """Announce the images about to be opened, in flash order"""
+        self._expected = Counter(name for name in map(self.member_for, paths) if name)
+        self._release_spool()
+
+    def _release_spool(self):
+        """Drop spooled images no longer expected"""
+        for name in [name for name in self._spooled if not self._expected[name]]:
+            try:
+                os.remove(self._spooled.pop(name))
+            except OSError:
+                pass
+            self._spool_bytes -= self.members.get(name, 0)
+
+    def _spool(self, name, member):
+        """Park a passed member on disk; False when the spool is full"""
+        size = member.size
+        if self._spool_bytes + size > self.spool_limit:
+            return False
+        target = _target_path(self.spool_dir, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if shutil.disk_usage(self.spool_dir).free < size + SPOOL_RESERVE:
+            return False
+        source = self._tar.extractfile(member)
+        try:
+            with open(target, "wb") as out:
+                shutil.copyfileobj(source, out, COPY_BUFFER_SIZE)
+        except OSError:
+            if os.path.exists(target):
+                os.remove(target)
+            return False
+        self._spooled[name] = target
+        self._spool_bytes += size
+        return True
+
+    def open(self, path):
+        """Stream of one member, valid until the next open
+
+        A tar.gz can only be read forward. Expected images passed on the
+        way to this one are spooled; going back to an earlier member that
+        was not spooled starts decompressing from the beginning again.
+        """
+        name = self.member_for(path)
+        if name is None:
+            raise RomArchiveError(f"Образ отсутствует в архиве: {path}")
+        if self._zip:
+            return self._zip.open(self._zip_members[name])
+        # The stream handed out last has been closed by now
+        self._release_spool()
+        if self._expected[name]:
+            self._expected[name] -= 1
+        if self._random_tar:
+            return self._random_tar.extractfile(self._random_members[name])
+        if name in self._spooled:
+            return open(self._spooled[name], "rb")
+        if self._tar is None or name in self._passed:
+            self._close_tar()
+            self._raw = open(self.path, "rb")
+            self._tar = tarfile.open(fileobj=self._raw, mode="r|*")
+            self._passed = set()
+        while True:
+            member = self._tar.next()
+            if member is None:
+                raise RomArchiveError(f"Образ отсутствует в архиве: {name}")
+            current = _member_name(member.name)
+            self._passed.add(current)
+            if not member.isfile():
+                continue
+            if current == name:
+                return self._tar.extractfile(member)
+            if self._expected[current] and current not in self._spooled:
+                self._spool(current, member)
+
+    def flash(self, client, partition, path, progress=None):
+        """Stream one image of the archive into a fastboot partition"""
+        size = self.size(path)
+        stream = self.open(path)
+        try:
+            client.flash_stream(partition, stream, size, progress)
+        finally:
+            stream.close()
+
+
+def main():
+    """Command line: rom_archive.py ARCHIVE OUTPUT_DIR"""
+    if len(sys.argv) != 3:
+        print(main.__doc__)
+        return 1
+    started = time.monotonic()
+
+    def progress(done, total, rate):
+        print(f"\r{done * 100 // max(total, 1)}%  {rate:.0f} МБ/с", end="", flush=True)
+
+    files = extract(sys.argv[1], sys.argv[2], progress=progress)
+    elapsed = time.monotonic() - started
+    size = sum(os.path.getsize(path) for path in files.values())
+    print(f"\nФайлов: {len(files)}, {size / 1024 ** 3:.2f} ГБ за {elapsed:.1f} с "
+          f"({size / max(elapsed, 1e-6) / 1024 ** 2:.0f} МБ/с)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,604 @@
+"""
+Android sparse image support for ProshivkaTool
+
+Reads raw and sparse images through mmap and yields their chunks lazily.
+RAW chunk data is handed out as memoryview slices of the mapping, so
+converting or sending a multi-GB image never copies it into memory.
+Images that can only be read as a stream (archive members) are parsed
+front to back in bounded pieces instead.
+"""
+import mmap
+import os
+import struct
+import sys
+import zlib
+from collections import namedtuple
+
+# NumPy is optional, without it raw images are sent as plain RAW chunks
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+SPARSE_MAGIC = 0xED26FF3A
+SPARSE_HEADER = struct.Struct("<IHHHHIIII")
+CHUNK_HEADER = struct.Struct("<HHII")
+
+CHUNK_RAW = 0xCAC1
+CHUNK_FILL = 0xCAC2
+CHUNK_DONT_CARE = 0xCAC3
+CHUNK_CRC32 = 0xCAC4
+
+DEFAULT_BLOCK_SIZE = 4096
+# RAW chunks produced from raw images are capped so they stay splittable
+RAW_CHUNK_BLOCKS = 4096
+# Blocks classified per NumPy pass when scanning raw images
+SCAN_WINDOW_BLOCKS = 16384
+# Block class used for blocks that are not a repeated 32-bit word
+_MIXED = -1
+
+# data: memoryview for RAW, 4 fill bytes for FILL, crc bytes for CRC32
+Chunk = namedtuple("Chunk", "type start blocks data")
+
+
+class SparseError(Exception):
+    """Malformed sparse image"""
+
+
+def is_sparse(path):
+    """Check the sparse magic at the start of a file"""
+    with open(path, "rb") as f:
+        head = f.read(4)
+    return len(head) == 4 and struct.unpack("<I", head)[0] == SPARSE_MAGIC
+
+
+def chunk_payload_size(chunk):
+    """Bytes a chunk occupies in a sparse file, header included"""
+    if chunk.type == CHUNK_RAW:
+        return CHUNK_HEADER.size + len(chunk.data)
+    if chunk.type in (CHUNK_FILL, CHUNK_CRC32):
+        return CHUNK_HEADER.size + 4
+    return CHUNK_HEADER.size
+
+
+class SparseImage:
+    """A raw or sparse image mapped read-only into memory"""
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE):
+        self.path = path
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = None
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.sparse = False
+        self.block_size = block_size
+        self.total_blocks = (self.size + block_size - 1) // block_size
+        self.total_chunks = None
+        self.checksum = 0
+        self._data_start = 0
+
+        if self.size >= SPARSE_HEADER.size:
+            header = SPARSE_HEADER.unpack_from(self.map, 0)
+            if header[0] == SPARSE_MAGIC:
+                self._read_header(header)
+
+    def _read_header(self, header):
+        (magic, major, minor, file_hdr_sz, chunk_hdr_sz,
+         blk_sz, total_blks, total_chunks, checksum) = header
+        if major != 1:
+            raise SparseError(f"Неподдерживаемая версия sparse: {major}.{minor}")
+        if chunk_hdr_sz < CHUNK_HEADER.size or blk_sz % 4:
+            raise SparseError("Повреждён заголовок sparse-образа")
+        self.sparse = True
+        self.block_size = blk_sz
+        self.total_blocks = total_blks
+        self.total_chunks = total_chunks
+        self.checksum = checksum
+        self._data_start = file_hdr_sz
+        self._chunk_header_size = chunk_hdr_sz
+
+    @property
+    def raw_size(self):
+        """Size of the image once expanded"""
+        if self.sparse:
+            return self.total_blocks * self.block_size
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Chunks are still referenced somewhere, the mapping goes
+                # away together with the last of them
+                pass
+            self.map = None
+        self.file.close()
+
+    def chunks(self, detect_fill=True, zero_as_dont_care=False):
+        """Yield the image as chunks without copying RAW data
+
+        For raw images, blocks repeating one 32-bit word become FILL chunks.
+        Zero blocks stay FILL by default: DONT_CARE would leave whatever
+        was on the partition before, which is only fine after an erase.
+        """
+        if self.sparse:
+            return self._sparse_chunks()
+        if detect_fill and NUMPY_AVAILABLE and self.block_size % 4 == 0:
+            return self._scanned_chunks(zero_as_dont_care)
+        return self._raw_chunks()
+
+    def _sparse_chunks(self):
+        for chunk, _ in self._located_sparse_chunks():
+            yield chunk
+
+    def located_chunks(self):
+        """Yield (chunk, file offset of its data), offset None unless RAW
+
+        Worker processes map the same file and copy RAW data by offset
+        instead of receiving it pickled. Raw images come as plain RAW chunks.
+        """
+        if self.sparse:
+            yield from self._located_sparse_chunks()
+            return
+        for chunk in self._raw_chunks():
+            yield chunk, chunk.start * self.block_size
+
+    def _located_sparse_chunks(self):
+        view = memoryview(self.map)
+        offset = self._data_start
+        block = 0
+        for index in range(self.total_chunks):
+            if offset + CHUNK_HEADER.size > self.size:
+                raise SparseError(f"Образ обрезан на чанке {index}")
+            chunk_type, _, blocks, total_size = CHUNK_HEADER.unpack_from(view, offset)
+            data_offset = offset + self._chunk_header_size
+            data_size = total_size - self._chunk_header_size
+            if offset + total_size > self.size:
+                raise SparseError(f"Образ обрезан на чанке {index}")
+
+            if chunk_type == CHUNK_RAW:
+                if data_size != blocks * self.block_size:
+                    raise SparseError(f"Неверный размер RAW-чанка {index}")
+                yield Chunk(CHUNK_RAW, block, blocks, view[data_offset:data_offset + data_size]), data_offset
+            elif chunk_type == CHUNK_FILL:
+                yield Chunk(CHUNK_FILL, block, blocks, bytes(view[data_offset:data_offset + 4])), None
+            elif chunk_type == CHUNK_DONT_CARE:
+                yield Chunk(CHUNK_DONT_CARE, block, blocks, None), None
+            elif chunk_type == CHUNK_CRC32:
+                yield Chunk(CHUNK_CRC32, block, 0, bytes(view[data_offset:data_offset + 4])), None
+            else:
+                raise SparseError(f"Неизвестный тип чанка 0x{chunk_type:04x}")
+            block += blocks
+            offset += total_size
+        if block != self.total_blocks:
+            raise SparseError(f"Чанки покрывают {block} блоков из {self.total_blocks}")
+
+    def _raw_chunks(self):
+        if not self.size:
+            return
+        view = memoryview(self.map)
+        full_blocks = self.size // self.block_size
+        for start in range(0, full_blocks, RAW_CHUNK_BLOCKS):
+            blocks = min(RAW_CHUNK_BLOCKS, full_blocks - start)
+            offset = start * self.block_size
+            yield Chunk(CHUNK_RAW, start, blocks, view[offset:offset + blocks * self.block_size])
+        tail = self.size - full_blocks * self.block_size
+        if tail:
+            # Only the last partial block is copied, to pad it
+            padded = bytes(view[self.size - tail:]) + bytes(self.block_size - tail)
+            yield Chunk(CHUNK_RAW, full_blocks, 1, memoryview(padded))
+
+
+    def _classify(self, view, start, count):
+        """Class of each block: its fill word, or _MIXED
+
+        The window is viewed in place as a (blocks, words) array, no copy.
+        """
+        words = np.frombuffer(view, dtype="<u4", count=count * self.block_size // 4,
+                              offset=start * self.block_size)
+        words = words.reshape(count, self.block_size // 4)
+        uniform = (words == words[:, :1]).all(axis=1)
+        return np.where(uniform, words[:, 0].astype(np.int64), _MIXED)
+
+    def _scanned_chunks(self, zero_as_dont_care):
+        if not self.size:
+            return
+        view = memoryview(self.map)
+        full_blocks = self.size // self.block_size
+        # Current run carried across windows: (class, first block)
+        run_class = None
+        run_start = 0
+        for window in range(0, full_blocks, SCAN_WINDOW_BLOCKS):
+            count = min(SCAN_WINDOW_BLOCKS, full_blocks - window)
+            classes = self._classify(view, window, count)
+            # Run-length merge: indices where the class changes
+            edges = np.flatnonzero(classes[1:] != classes[:-1]) + 1
+            starts = np.concatenate(([0], edges))
+            for index, first in zip(starts.tolist(), classes[starts].tolist()):
+                if first == run_class:
+                    continue
+                if run_class is not None:
+                    yield from self._run_chunks(view, run_class, run_start, window + index,
+                                                zero_as_dont_care)
+                run_class = first
+                run_start = window + index
+        if run_class is not None:
+            yield from self._run_chunks(view, run_class, run_start, full_blocks,
+                                        zero_as_dont_care)
+        tail = self.size - full_blocks * self.block_size
+        if tail:
+            padded = bytes(view[self.size - tail:]) + bytes(self.block_size - tail)
+            yield Chunk(CHUNK_RAW, full_blocks, 1, memoryview(padded))
+
+    def _run_chunks(self, view, run_class, start, end, zero_as_dont_care):
+        if run_class == _MIXED:
+            for first in range(start, end, RAW_CHUNK_BLOCKS):
+                blocks = min(RAW_CHUNK_BLOCKS, end - first)
+                offset = first * self.block_size
+                yield Chunk(CHUNK_RAW, first, blocks, view[offset:offset + blocks * self.block_size])
+        elif run_class == 0 and zero_as_dont_care:
+            yield Chunk(CHUNK_DONT_CARE, start, end - start, None)
+        else:
+            yield Chunk(CHUNK_FILL, start, end - start, struct.pack("<I", run_class))
+
+
+def _read_upto(stream, length):
+    """length bytes, fewer only at the end of the stream"""
+    data = stream.read(length)
+    while len(data) < length:
+        more = stream.read(length - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def _read_exact(stream, length):
+    data = _read_upto(stream, length)
+    if len(data) < length:
+        raise SparseError("Образ обрезан")
+    return data
+
+
+class StreamImage:
+    """A raw or sparse image read once, front to back, from a stream
+
+    For archive members and decompressors that can not be mapped. RAW data
+    is read in pieces of at most RAW_CHUNK_BLOCKS blocks, so memory use
+    does not depend on the chunk sizes of the image. size may be None for
+    a decompressor that does not know it: a sparse image is then described
+    by its header, a raw one is read to the end of the stream and
+    total_blocks is left for the caller to set.
+    """
+
+    def __init__(self, stream, size, block_size=DEFAULT_BLOCK_SIZE):
+        self.stream = stream
+        self.size = size
+        self.sparse = False
+        self.block_size = block_size
+        self.total_blocks = (size + block_size - 1) // block_size if size is not None else None
+        self.total_chunks = None
+        if size is None:
+            self._head = _read_upto(stream, SPARSE_HEADER.size)
+        else:
+            self._head = _read_exact(stream, min(SPARSE_HEADER.size, size))
+        if len(self._head) == SPARSE_HEADER.size:
+            header = SPARSE_HEADER.unpack(self._head)
+            if header[0] == SPARSE_MAGIC:
+                (_, major, minor, file_hdr_sz, chunk_hdr_sz,
+                 blk_sz, total_blks, total_chunks, _) = header
+                if major != 1:
+                    raise SparseError(f"Неподдерживаемая версия sparse: {major}.{minor}")
+                if chunk_hdr_sz < CHUNK_HEADER.size or blk_sz % 4:
+                    raise SparseError("Повреждён заголовок sparse-образа")
+                self.sparse = True
+                self.block_size = blk_sz
+                self.total_blocks = total_blks
+                self.total_chunks = total_chunks
+                self._chunk_header_size = chunk_hdr_sz
+                # Kept with the header, pass-through re-emits the image unchanged
+                self._head += _read_exact(stream, file_hdr_sz - SPARSE_HEADER.size)
+
+    @property
+    def raw_size(self):
+        if self.sparse:
+            return self.total_blocks * self.block_size
+        return self.size
+
+    def iter_bytes(self):
+        """The image unchanged, in pieces as read"""
+        yield self._head
+        yield from iter(lambda: self.stream.read(RAW_CHUNK_BLOCKS * self.block_size), b"")
+
+    def chunks(self):
+        if self.sparse:
+            return self._sparse_chunks()
+        return self._raw_chunks()
+
+    def _sparse_chunks(self):
+        block = 0
+        piece_bytes = RAW_CHUNK_BLOCKS * self.block_size
+        for _ in range(self.total_chunks):
+            header = _read_exact(self.stream, self._chunk_header_size)
+            chunk_type, _, blocks, total_size = CHUNK_HEADER.unpack_from(header)
+            data_size = total_size - self._chunk_header_size
+            if chunk_type == CHUNK_RAW:
+                if data_size != blocks * self.block_size:
+                    raise SparseError("Размер RAW-чанка не совпадает с числом блоков")
+                for offset in range(0, data_size, piece_bytes):
+                    data = _read_exact(self.stream, min(piece_bytes, data_size - offset))
+                    yield Chunk(CHUNK_RAW, block + offset // self.block_size,
+                                len(data) // self.block_size, memoryview(data))
+            elif chunk_type in (CHUNK_FILL, CHUNK_CRC32):
+                data = _read_exact(self.stream, data_size)
+                yield Chunk(chunk_type, block, blocks, data[:4])
+            elif chunk_type == CHUNK_DONT_CARE:
+                yield Chunk(CHUNK_DONT_CARE, block, blocks, None)
+            else:
+                raise SparseError(f"Неизвестный тип чанка 0x{chunk_type:04x}")
+            block += blocks
+        if block != self.total_blocks:
+            raise SparseError(f"Чанки покрывают {block} блоков из {self.total_blocks}")
+
+    def _raw_chunks(self):
+        piece_bytes = RAW_CHUNK_BLOCKS * self.block_size
+        pending = self._head
+        block = 0
+        # Unknown size: read until the stream runs dry
+        remaining = self.size - len(pending) if self.size is not None else None
+        while pending or remaining != 0:
+            if remaining is None:
+                pending += _read_upto(self.stream, piece_bytes - len(pending))
+                if len(pending) < piece_bytes:
+                    remaining = 0
+                if not pending:
+                    break
+            else:
+                want = min(piece_bytes - len(pending), remaining)
+                if want:
+                    pending += _read_exact(self.stream, want)
+                    remaining -= want
+            tail = len(pending) % self.block_size
+            if tail:
+                # Only the last partial block is padded
+                pending += bytes(self.block_size - tail)
+            blocks = len(pending) // self.block_size
+            yield Chunk(CHUNK_RAW, block, blocks, memoryview(pending))
+            block += blocks
+            pending = b""
+
+
+def sparse_header(block_size, total_blocks, total_chunks, checksum=0):
+    return SPARSE_HEADER.pack(SPARSE_MAGIC, 1, 0, SPARSE_HEADER.size, CHUNK_HEADER.size,
+                              block_size, total_blocks, total_chunks, checksum)
+
+
+def sparse_size(chunks):
+    """Size of the sparse file made of chunks"""
+    return SPARSE_HEADER.size + sum(chunk_payload_size(chunk) for chunk in chunks)
+
+
+def iter_sparse(chunks, block_size, total_blocks):
+    """Serialize chunks into sparse file pieces
+
+    chunks must be a sequence (the header needs the count). RAW data is
+    yielded as the original memoryview, never copied.
+    """
+    yield sparse_header(block_size, total_blocks, len(chunks))
+    for chunk in chunks:
+        if chunk.type == CHUNK_RAW:
+            yield CHUNK_HEADER.pack(CHUNK_RAW, 0, chunk.blocks, CHUNK_HEADER.size + len(chunk.data))
+            yield chunk.data
+        elif chunk.type in (CHUNK_FILL, CHUNK_CRC32):
+            yield CHUNK_HEADER.pack(chunk.type, 0, chunk.blocks, CHUNK_HEADER.size + 4) + bytes(chunk.data)
+        else:
+            yield CHUNK_HEADER.pack(CHUNK_DONT_CARE, 0, chunk.blocks, CHUNK_HEADER.size)
+
+
+def build_chunks(blocks, fills, total_blocks):
+    """Chunks of a generated image, in block order
+
+    blocks maps a block number to its data (one block each), fills lists
+    (start, count) runs to be zeroed; neither may overlap. Consecutive
+    blocks are merged into RAW chunks of at most RAW_CHUNK_BLOCKS, every
+    other area becomes DONT_CARE.
+    """
+    entries = [(block, 1, data) for block, data in blocks.items()]
+    entries += [(start, length, None) for start, length in fills]
+    entries.sort(key=lambda entry: entry[0])
+    chunks = []
+    position = 0
+    pending = []
+    for start, length, data in entries:
+        if pending and (data is None or start != pending[-1][0] + 1
+                        or len(pending) >= RAW_CHUNK_BLOCKS):
+            chunks.append(Chunk(CHUNK_RAW, pending[0][0], len(pending),
+                                memoryview(b"".join(item[1] for item in pending))))
+            pending = []
+        if start > position and not pending:
+            chunks.append(Chunk(CHUNK_DONT_CARE, position, start - position, None))
+        if data is None:
+            chunks.append(Chunk(CHUNK_FILL, start, length, b"\0\0\0\0"))
+        else:
+            pending.append((start, data))
+        position = start + length
+    if pending:
+        chunks.append(Chunk(CHUNK_RAW, pending[0][0], len(pending),
+                            memoryview(b"".join(item[1] for item in pending))))
+    if position < total_blocks:
+        chunks.append(Chunk(CHUNK_DONT_CARE, position, total_blocks - position, None))
+    return chunks
+
+
+def write_sparse(chunks, out_path, block_size, total_blocks):
+    """Write chunks to a sparse image file"""
+    chunks = list(chunks)
+    with open(out_path, "wb") as f:
+        for piece in iter_sparse(chunks, block_size, total_blocks):
+            f.write(piece)
+    return sparse_size(chunks)
+
+
+def write_raw(chunks, out_path, block_size, total_blocks):
+    """Expand chunks into a raw image, DONT_CARE areas stay as file holes"""
+    with open(out_path, "wb") as f:
+        f.truncate(total_blocks * block_size)
+        fill_buffer = None
+        for chunk in chunks:
+            if chunk.type == CHUNK_RAW:
+                f.seek(chunk.start * block_size)
+                f.write(chunk.data)
+            elif chunk.type == CHUNK_FILL and chunk.data != b"\0\0\0\0":
+                # Reuse one block-sized pattern buffer for all FILL chunks
+                if fill_buffer is None or fill_buffer[:4] != chunk.data:
+                    fill_buffer = chunk.data * (block_size * 256 // 4)
+                f.seek(chunk.start * block_size)
+                remaining = chunk.blocks * block_size
+                while remaining:
+                    count = min(remaining, len(fill_buffer))
+                    f.write(fill_buffer[:count])
+                    remaining -= count
+
+
+def verify_crc(chunks, block_size):
+    """Check CRC32 chunks against the data before them"""
+    crc = 0
+    zero_block = bytes(block_size)
+    for chunk in chunks:
+        if chunk.type == CHUNK_RAW:
+            crc = zlib.crc32(chunk.data, crc)
+        elif chunk.type == CHUNK_FILL:
+            block = chunk.data * (block_size // 4)
+            for _ in range(chunk.blocks):
+                crc = zlib.crc32(block, crc)
+        elif chunk.type == CHUNK_DONT_CARE:
+            for _ in range(chunk.blocks):
+                crc = zlib.crc32(zero_block, crc)
+        elif chunk.type == CHUNK_CRC32:
+            if struct.unpack("<I", chunk.data)[0] != crc:
+                return False
+    return True
+
+
+class SparsePiece:
+    """One download-sized part of a split image
+
+    Every piece covers the whole partition: blocks outside its chunks are
+    DONT_CARE, so the device can apply the pieces one after another.
+    """
+
+    def __init__(self, block_size, total_blocks):
+        self.block_size = block_size
+        self.total_blocks = total_blocks
+        self.chunks = []
+
+    def _framed(self):
+        chunks = []
+        position = 0
+        for chunk in self.chunks:
+            if chunk.start > position:
+                chunks.append(Chunk(CHUNK_DONT_CARE, position, chunk.start - position, None))
+            chunks.append(chunk)
+            position = chunk.start + chunk.blocks
+        if position < self.total_blocks:
+            chunks.append(Chunk(CHUNK_DONT_CARE, position, self.total_blocks - position, None))
+        return chunks
+
+    @property
+    def size(self):
+        return sparse_size(self._framed())
+
+    def iter_bytes(self):
+        """Sparse file of this piece, RAW data straight from the source mapping"""
+        return iter_sparse(self._framed(), self.block_size, self.total_blocks)
+
+
+def split_plan(chunks, block_size, total_blocks, max_size):
+    """Split chunks into pieces of at most max_size bytes
+
+    Only chunk metadata is looked at; RAW chunks that do not fit are cut
+    into memoryview slices at block boundaries.
+    """
+    return list(iter_split(chunks, block_size, total_blocks, max_size))
+
+
+def iter_split(chunks, block_size, total_blocks, max_size):
+    """split_plan as a generator, a piece is yielded as soon as it is full
+
+    Used with StreamImage, where the chunks are read while splitting.
+    """
+    # Header plus a leading and a trailing DONT_CARE chunk
+    overhead = SPARSE_HEADER.size + 2 * CHUNK_HEADER.size
+    if max_size < overhead + CHUNK_HEADER.size + block_size:
+        raise SparseError(f"max-download-size слишком мал: {max_size}")
+
+    produced = False
+    piece = SparsePiece(block_size, total_blocks)
+    used = overhead
+    for chunk in chunks:
+        if chunk.type in (CHUNK_CRC32, CHUNK_DONT_CARE):
+            # Gaps are re-created by the framing, CRCs no longer match
+            continue
+        while chunk is not None:
+            # A gap before the chunk costs a DONT_CARE header
+            gap = CHUNK_HEADER.size if piece.chunks and chunk.start > piece.chunks[-1].start + piece.chunks[-1].blocks else 0
+            need = chunk_payload_size(chunk) + gap
+            if used + need <= max_size:
+                piece.chunks.append(chunk)
+                used += need
+                chunk = None
+                continue
+            fit_blocks = 0
+            if chunk.type == CHUNK_RAW:
+                fit_blocks = (max_size - used - gap - CHUNK_HEADER.size) // block_size
+            if fit_blocks > 0:
+                split = fit_blocks * block_size
+                piece.chunks.append(Chunk(CHUNK_RAW, chunk.start, fit_blocks, chunk.data[:split]))
+                chunk = Chunk(CHUNK_RAW, chunk.start + fit_blocks, chunk.blocks - fit_blocks, chunk.data[split:])
+            yield piece
+            produced = True
+            piece = SparsePiece(block_size, total_blocks)
+            used = overhead
+    if piece.chunks or not produced:
+        yield piece
+
+
+def raw_to_sparse(src_path, dst_path, block_size=DEFAULT_BLOCK_SIZE):
+    """Convert a raw image to sparse format"""
+    with SparseImage(src_path, block_size) as image:
+        if image.sparse:
+            raise SparseError(f"Образ уже в формате sparse: {src_path}")
+        return write_sparse(image.chunks(), dst_path, image.block_size, image.total_blocks)
+
+
+def sparse_to_raw(src_path, dst_path):
+    """Expand a sparse image to a raw one"""
+    with SparseImage(src_path) as image:
+        if not image.sparse:
+            raise SparseError(f"Образ не в формате sparse: {src_path}")
+        write_raw(image.chunks(), dst_path, image.block_size, image.total_blocks)
+
+
+def main():
+    """Command line: sparse_image.py img2simg|simg2img SRC DST"""
+    if len(sys.argv) != 4 or sys.argv[1] not in ("img2simg", "simg2img"):
+        print("Использование: sparse_image.py img2simg|simg2img SRC DST")
+        return 1
+    if sys.argv[1] == "img2simg":
+        raw_to_sparse(sys.argv[2], sys.argv[3])
+    else:
+        sparse_to_raw(sys.argv[2], sys.argv[3])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
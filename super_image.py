@@ -0,0 +1,941 @@
+"""
+Dynamic partition (super.img) support for ProshivkaTool
+
+HyperOS keeps system, vendor, product, odm and the rest as logical
+partitions inside one super partition, described by lpmetadata (liblp,
+metadata format 10.x). This module reads that metadata from raw, sparse
+and super_empty images, unpacks logical partitions in parallel and builds
+super images from partition images.
+
+Reading maps the image and indexes sparse chunk headers only; metadata
+and partitions are parsed when first asked for. Unpacking gives every
+worker process a list of (destination, source offset, length) copies
+between mmap slices of super.img and the output files. Building composes
+the sparse super out of the chunks of the partition images shifted to
+their extents, so the raw super is never materialised, neither on disk
+nor in memory, and can be streamed to fastboot as it is generated.
+"""
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import sparse_image
+from ext4_image import Ext4Error, parse_size
+from sparse_image import CHUNK_DONT_CARE, CHUNK_FILL, CHUNK_RAW, Chunk
+
+LP_METADATA_GEOMETRY_MAGIC = 0x616C4467
+LP_METADATA_HEADER_MAGIC = 0x414C5030
+LP_METADATA_MAJOR_VERSION = 10
+LP_METADATA_MAX_MINOR_VERSION = 2
+LP_SECTOR_SIZE = 512
+LP_PARTITION_RESERVED_BYTES = 4096
+LP_METADATA_GEOMETRY_SIZE = 4096
+
+GEOMETRY = struct.Struct("<II32sIII")
+# Header up to 10.1; 10.2 adds flags and reserved bytes (256 bytes total)
+HEADER = struct.Struct("<IHHI32sI32sIIIIIIIIIIII")
+HEADER_V1_2 = struct.Struct("<I124s")
+HEADER_V1_2_SIZE = HEADER.size + HEADER_V1_2.size
+PARTITION = struct.Struct("<36sIIII")
+EXTENT = struct.Struct("<QIQI")
+GROUP = struct.Struct("<36sIQ")
+BLOCK_DEVICE = struct.Struct("<QIIQ36sI")
+
+# LpMetadataPartition.attributes
+ATTR_READONLY = 0x1
+ATTR_SLOT_SUFFIXED = 0x2
+ATTR_UPDATED = 0x4
+ATTR_DISABLED = 0x8
+ATTRIBUTE_NAMES = {ATTR_READONLY: "readonly", ATTR_SLOT_SUFFIXED: "slot-suffixed",
+                   ATTR_UPDATED: "updated", ATTR_DISABLED: "disabled"}
+
+TARGET_TYPE_LINEAR = 0
+TARGET_TYPE_ZERO = 1
+
+# LpMetadataHeader.flags
+HEADER_FLAG_VIRTUAL_AB_DEVICE = 0x1
+
+# lpmake defaults
+DEFAULT_METADATA_SIZE = 65536
+DEFAULT_SLOT_COUNT = 3
+DEFAULT_ALIGNMENT = 1024 * 1024
+DEFAULT_BLOCK_SIZE = 4096
+DEFAULT_GROUP = "default"
+
+# Copy operations per unpack task are grouped up to this many bytes
+TASK_DATA_SIZE = 64 * 1024 * 1024
+
+Geometry = namedtuple("Geometry", "metadata_max_size metadata_slot_count logical_block_size")
+Extent = namedtuple("Extent", "num_sectors target_type target_data target_source")
+Group = namedtuple("Group", "name flags maximum_size")
+BlockDevice = namedtuple("BlockDevice", "first_logical_sector alignment alignment_offset size name flags")
+# extents: list of Extent; size in bytes
+LogicalPartition = namedtuple("LogicalPartition", "name group attributes extents size")
+
+
+class SuperError(Exception):
+    """Malformed lpmetadata or a layout that does not fit"""
+
+
+def _name(raw):
+    return raw.split(b"\0", 1)[0].decode("ascii", "replace")
+
+
+def _encode_name(name):
+    raw = name.encode("ascii")
+    if len(raw) > 36:
+        raise SuperError(f"Слишком длинное имя: {name}")
+    return raw
+
+
+def _align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def parse_geometry(data, offset=0):
+    magic, struct_size, checksum, max_size, slots, block_size = GEOMETRY.unpack_from(data, offset)
+    if magic != LP_METADATA_GEOMETRY_MAGIC:
+        raise SuperError("Нет геометрии lpmetadata")
+    if struct_size != GEOMETRY.size:
+        raise SuperError(f"Неизвестный размер геометрии: {struct_size}")
+    raw = bytearray(data[offset:offset + GEOMETRY.size])
+    raw[8:40] = bytes(32)
+    if hashlib.sha256(raw).digest() != checksum:
+        raise SuperError("Контрольная сумма геометрии не совпадает")
+    if not slots or max_size % LP_SECTOR_SIZE or not block_size or block_size % LP_SECTOR_SIZE:
+        raise SuperError("Повреждена геометрия lpmetadata")
+    return Geometry(max_size, slots, block_size)
+
+
+def serialize_geometry(geometry):
+    """Geometry block, padded to LP_METADATA_GEOMETRY_SIZE"""
+    raw = bytearray(GEOMETRY.pack(LP_METADATA_GEOMETRY_MAGIC, GEOMETRY.size, bytes(32), *geometry))
+    raw[8:40] = hashlib.sha256(raw).digest()
+    return bytes(raw) + bytes(LP_METADATA_GEOMETRY_SIZE - len(raw))
+
+
+def primary_metadata_offset(geometry, slot):
+    return LP_PARTITION_RESERVED_BYTES + 2 * LP_METADATA_GEOMETRY_SIZE + geometry.metadata_max_size * slot
+
+
+def backup_metadata_offset(geometry, slot):
+    return primary_metadata_offset(geometry, geometry.metadata_slot_count + slot)
+
+
+def metadata_area_size(geometry):
+    """Bytes at the start of super taken by geometry and all metadata copies"""
+    return backup_metadata_offset(geometry, geometry.metadata_slot_count)
+
+
+class LpMetadata:
+    """One metadata slot: partitions, their extents, groups and block devices
+
+    partitions holds the raw table entries (name, attributes, first extent
+    index, extent count, group index); logical_partitions() resolves them.
+    """
+
+    def __init__(self, geometry, partitions, extents, groups, block_devices,
+                 minor=0, flags=0):
+        self.geometry = geometry
+        self.partitions = partitions
+        self.extents = extents
+        self.groups = groups
+        self.block_devices = block_devices
+        self.minor = minor
+        self.flags = flags
+
+    @property
+    def device_size(self):
+        return self.block_devices[0].size
+
+    @property
+    def first_logical_sector(self):
+        return self.block_devices[0].first_logical_sector
+
+    def logical_partitions(self):
+        """Yield LogicalPartition entries in table order"""
+        for name, attributes, first, count, group in self.partitions:
+            extents = self.extents[first:first + count]
+            yield LogicalPartition(name, self.groups[group].name, attributes, extents,
+                                   sum(extent.num_sectors for extent in extents) * LP_SECTOR_SIZE)
+
+    def partition(self, name):
+        for partition in self.logical_partitions():
+            if partition.name == name:
+                return partition
+        raise SuperError(f"В super нет раздела {name}")
+
+    def serialize(self):
+        """Header and tables, as written to a metadata slot"""
+        tables = [
+            b"".join(PARTITION.pack(_encode_name(name), attributes, first, count, group)
+                     for name, attributes, first, count, group in self.partitions),
+            b"".join(EXTENT.pack(*extent) for extent in self.extents),
+            b"".join(GROUP.pack(_encode_name(group.name), group.flags, group.maximum_size)
+                     for group in self.groups),
+            b"".join(BLOCK_DEVICE.pack(device.first_logical_sector, device.alignment,
+                                       device.alignment_offset, device.size,
+                                       _encode_name(device.name), device.flags)
+                     for device in self.block_devices),
+        ]
+        counts = (len(self.partitions), len(self.extents), len(self.groups), len(self.block_devices))
+        sizes = (PARTITION.size, EXTENT.size, GROUP.size, BLOCK_DEVICE.size)
+        descriptors = []
+        offset = 0
+        for table, count, entry_size in zip(tables, counts, sizes):
+            descriptors += [offset, count, entry_size]
+            offset += len(table)
+        body = b"".join(tables)
+        header_size = HEADER_V1_2_SIZE if self.minor >= 2 else HEADER.size
+        header = bytearray(HEADER.pack(LP_METADATA_HEADER_MAGIC, LP_METADATA_MAJOR_VERSION, self.minor,
+                                       header_size, bytes(32), len(body),
+                                       hashlib.sha256(body).digest(), *descriptors))
+        if self.minor >= 2:
+            header += HEADER_V1_2.pack(self.flags, bytes(124))
+        header[12:44] = hashlib.sha256(header).digest()
+        blob = bytes(header) + body
+        if len(blob) > self.geometry.metadata_max_size:
+            raise SuperError(f"Метаданные ({len(blob)} байт) не помещаются в слот "
+                             f"({self.geometry.metadata_max_size} байт)")
+        return blob
+
+    def empty_image(self):
+        """super_empty.img: geometry followed by the metadata, as lpmake writes it
+
+        This is what fastbootd expects after download for update-super.
+        """
+        return serialize_geometry(self.geometry) + self.serialize()
+
+
+def _table(data, offset, entry_struct, tables_size, name):
+    table_offset, count, entry_size = offset
+    if entry_size != entry_struct.size:
+        raise SuperError(f"Неизвестный размер записи таблицы {name}: {entry_size}")
+    if table_offset + count * entry_size > tables_size:
+        raise SuperError(f"Таблица {name} выходит за пределы метаданных")
+    return [entry_struct.unpack_from(data, table_offset + index * entry_size) for index in range(count)]
+
+
+def parse_metadata(geometry, data, offset=0):
+    """LpMetadata from a metadata slot starting at data[offset]"""
+    if len(data) - offset < HEADER.size:
+        raise SuperError("Метаданные обрезаны")
+    fields = HEADER.unpack_from(data, offset)
+    magic, major, minor, header_size, header_checksum, tables_size, tables_checksum = fields[:7]
+    if magic != LP_METADATA_HEADER_MAGIC:
+        raise SuperError("Нет заголовка lpmetadata")
+    if major != LP_METADATA_MAJOR_VERSION or minor > LP_METADATA_MAX_MINOR_VERSION:
+        raise SuperError(f"Неподдерживаемая версия lpmetadata: {major}.{minor}")
+    if header_size != (HEADER_V1_2_SIZE if minor >= 2 else HEADER.size):
+        raise SuperError(f"Неверный размер заголовка lpmetadata: {header_size}")
+    if header_size + tables_size > geometry.metadata_max_size or offset + header_size + tables_size > len(data):
+        raise SuperError("Метаданные обрезаны")
+    header = bytearray(data[offset:offset + header_size])
+    header[12:44] = bytes(32)
+    if hashlib.sha256(header).digest() != header_checksum:
+        raise SuperError("Контрольная сумма заголовка lpmetadata не совпадает")
+    tables = bytes(data[offset + header_size:offset + header_size + tables_size])
+    if hashlib.sha256(tables).digest() != tables_checksum:
+        raise SuperError("Контрольная сумма таблиц lpmetadata не совпадает")
+    flags = HEADER_V1_2.unpack_from(data, offset + HEADER.size)[0] if minor >= 2 else 0
+
+    descriptors = [fields[7 + 3 * index:10 + 3 * index] for index in range(4)]
+    partitions = [(_name(name), attributes, first, count, group) for name, attributes, first, count, group
+                  in _table(tables, descriptors[0], PARTITION, tables_size, "разделов")]
+    extents = [Extent(*entry) for entry in _table(tables, descriptors[1], EXTENT, tables_size, "экстентов")]
+    groups = [Group(_name(name), group_flags, maximum)
+              for name, group_flags, maximum in _table(tables, descriptors[2], GROUP, tables_size, "групп")]
+    devices = [BlockDevice(first, alignment, alignment_offset, size, _name(name), device_flags)
+               for first, alignment, alignment_offset, size, name, device_flags
+               in _table(tables, descriptors[3], BLOCK_DEVICE, tables_size, "устройств")]
+    if not devices:
+        raise SuperError("В lpmetadata нет блочных устройств")
+    for name, _, first, count, group in partitions:
+        if first + count > len(extents) or group >= len(groups):
+            raise SuperError(f"Раздел {name} ссылается за пределы таблиц")
+    return LpMetadata(geometry, partitions, extents, groups, devices, minor, flags)
+
+
+class SuperImage:
+    """A super image (raw, sparse or super_empty) opened for reading
+
+    Nothing but the sparse chunk headers is read up front; geometry and
+    metadata slots are parsed on first use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.image = sparse_image.SparseImage(path)
+        self.block_size = self.image.block_size
+        self.size = self.image.raw_size
+        self._chunks = None
+        self._starts = None
+        self._geometry = None
+        self._metadata = {}
+        # super_empty.img starts with the geometry, a full super with reserved bytes
+        self.empty = self._has_geometry_at(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._chunks = None
+        self.image.close()
+
+    def _index(self):
+        if self._chunks is None:
+            self._chunks = [(chunk, offset) for chunk, offset in self.image.located_chunks()
+                            if chunk.blocks]
+            self._starts = [chunk.start for chunk, _ in self._chunks]
+        return self._chunks
+
+    def spans(self, offset, length):
+        """Yield (position, length, chunk, file offset) covering a byte range
+
+        file offset is where the bytes are in the image file for RAW chunks,
+        None otherwise. Ranges past the end of the image are not yielded.
+        """
+        chunks = self._index()
+        end = min(offset + length, self.size)
+        index = max(bisect.bisect_right(self._starts, offset // self.block_size) - 1, 0)
+        while offset < end and index < len(chunks):
+            chunk, file_offset = chunks[index]
+            chunk_start = chunk.start * self.block_size
+            chunk_end = min(chunk_start + chunk.blocks * self.block_size, self.size)
+            if chunk_end > offset:
+                piece = min(end, chunk_end) - offset
+                inside = offset - chunk_start
+                yield offset, piece, chunk, None if file_offset is None else file_offset + inside
+                offset += piece
+            index += 1
+
+    def read(self, offset, length):
+        """Bytes of the expanded image, DONT_CARE reads as zeros"""
+        result = bytearray(length)
+        for position, piece, chunk, _ in self.spans(offset, length):
+            inside = position - chunk.start * self.block_size
+            at = position - offset
+            if chunk.type == CHUNK_RAW:
+                result[at:at + piece] = chunk.data[inside:inside + piece]
+            elif chunk.type == CHUNK_FILL and chunk.data != b"\0\0\0\0":
+                pattern = chunk.data * ((inside % 4 + piece + 3) // 4 + 1)
+                result[at:at + piece] = pattern[inside % 4:inside % 4 + piece]
+        return bytes(result)
+
+    def _has_geometry_at(self, offset):
+        head = self.read(offset, 4) if self.size >= offset + GEOMETRY.size else b""
+        return len(head) == 4 and struct.unpack("<I", head)[0] == LP_METADATA_GEOMETRY_MAGIC
+
+    @property
+    def geometry(self):
+        if self._geometry is None:
+            bases = (0,) if self.empty else (LP_PARTITION_RESERVED_BYTES,
+                                              LP_PARTITION_RESERVED_BYTES + LP_METADATA_GEOMETRY_SIZE)
+            error = None
+            for base in bases:
+                try:
+                    self._geometry = parse_geometry(self.read(base, GEOMETRY.size))
+                    break
+                except SuperError as e:
+                    error = e
+            else:
+                raise SuperError(f"{os.path.basename(self.path)}: {error}")
+        return self._geometry
+
+    def metadata(self, slot=0):
+        """LpMetadata of a slot, from the backup copy if the primary is damaged"""
+        if slot not in self._metadata:
+            geometry = self.geometry
+            if slot >= geometry.metadata_slot_count:
+                raise SuperError(f"Слот метаданных {slot} отсутствует ({geometry.metadata_slot_count} слотов)")
+            if self.empty:
+                # Only slot 0 is stored, right after the geometry
+                data = self.read(LP_METADATA_GEOMETRY_SIZE, geometry.metadata_max_size)
+                self._metadata[slot] = parse_metadata(geometry, data)
+                return self._metadata[slot]
+            error = None
+            for offset in (primary_metadata_offset(geometry, slot), backup_metadata_offset(geometry, slot)):
+                try:
+                    self._metadata[slot] = parse_metadata(geometry, self.read(offset, geometry.metadata_max_size))
+                    break
+                except SuperError as e:
+                    error = e
+            else:
+                raise SuperError(f"{os.path.basename(self.path)}: {error}")
+        return self._metadata[slot]
+
+    def partitions(self, slot=0):
+        """Yield the logical partitions of a metadata slot"""
+        return self.metadata(slot).logical_partitions()
+
+    def copy_plan(self, partition):
+        """Copies that rebuild a partition: (dest, length, file offset or fill word)
+
+        Zero fills, DONT_CARE and ZERO extents are left out, the output
+        file is preallocated with zeros.
+        """
+        if self.empty:
+            raise SuperError("super_empty.img не содержит данных разделов")
+        copies = []
+        position = 0
+        for extent in partition.extents:
+            length = extent.num_sectors * LP_SECTOR_SIZE
+            if extent.target_type == TARGET_TYPE_LINEAR:
+                if extent.target_source != 0:
+                    raise SuperError(f"{partition.name}: экстенты на других блочных устройствах не поддерживаются")
+                source = extent.target_data * LP_SECTOR_SIZE
+                if source + length > self.size:
+                    raise SuperError(f"{partition.name}: экстент выходит за пределы образа")
+                for span_position, piece, chunk, file_offset in self.spans(source, length):
+                    dest = position + span_position - source
+                    if chunk.type == CHUNK_RAW:
+                        copies.append((dest, piece, file_offset))
+                    elif chunk.type == CHUNK_FILL and chunk.data != b"\0\0\0\0":
+                        inside = span_position - chunk.start * self.block_size
+                        copies.append((dest, piece, chunk.data[inside % 4:] + chunk.data[:inside % 4]))
+            elif extent.target_type != TARGET_TYPE_ZERO:
+                raise SuperError(f"{partition.name}: неизвестный тип экстента {extent.target_type}")
+            position += length
+        return copies
+
+
+def _batches(copies, limit=TASK_DATA_SIZE):
+    """Group copies into tasks of about limit bytes, cutting large copies"""
+    batch = []
+    size = 0
+    for dest, length, source in copies:
+        while length:
+            piece = min(length, limit - size)
+            batch.append((dest, piece, source))
+            size += piece
+            dest += piece
+            length -= piece
+            if isinstance(source, int):
+                source += piece
+            if size >= limit:
+                yield batch
+                batch = []
+                size = 0
+    if batch:
+        yield batch
+
+
+def _copy_task(super_path, out_path, copies):
+    """Worker: copy mmap slices of super.img into one output image"""
+    with open(super_path, "rb") as source_file, open(out_path, "r+b") as out_file:
+        size = os.fstat(out_file.fileno()).st_size
+        with mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ) as source, \
+                mmap.mmap(out_file.fileno(), size) as out:
+            for dest, length, data in copies:
+                if isinstance(data, int):
+                    out[dest:dest + length] = source[data:data + length]
+                else:
+                    out[dest:dest + length] = (data * (length // 4 + 1))[:length]
+    return sum(length for _, length, _ in copies)
+
+
+def extract(source, output_dir, partitions=None, slot=0, max_workers=None, progress=None):
+    """Unpack logical partitions of super.img into output_dir/<name>.img
+
+    By default every partition with data is unpacked (the empty _b
+    partitions of an A/B super are skipped). progress(done_bytes,
+    total_bytes) counts copied bytes. Returns the written paths.
+    """
+    with SuperImage(source) as image:
+        available = list(image.partitions(slot))
+        if partitions is None:
+            selected = [partition for partition in available if partition.size]
+        else:
+            by_name = {partition.name: partition for partition in available}
+            missing = [name for name in partitions if name not in by_name]
+            if missing:
+                raise SuperError(f"В super нет разделов: {', '.join(missing)}")
+            selected = [by_name[name] for name in partitions]
+        plans = {partition.name: image.copy_plan(partition) for partition in selected}
+    os.makedirs(output_dir, exist_ok=True)
+
+    outputs = {}
+    for partition in selected:
+        outputs[partition.name] = os.path.join(output_dir, f"{partition.name}.img")
+        with open(outputs[partition.name], "wb") as f:
+            f.truncate(partition.size)
+
+    total = sum(length for copies in plans.values() for _, length, _ in copies)
+    done = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_copy_task, source, outputs[name], batch)
+                   for name, copies in plans.items() for batch in _batches(copies)]
+        for future in as_completed(futures):
+            done += future.result()
+            if progress:
+                progress(done, total)
+    return [outputs[partition.name] for partition in selected]
+
+
+class SuperLayout:
+    """Host-side equivalent of liblp's MetadataBuilder for a single super
+
+    Partitions get extents in free space aligned to the block device
+    alignment; groups cap the total size of their partitions (0 means no
+    limit). export() produces LpMetadata for one slot.
+    """
+
+    def __init__(self, device_size, metadata_max_size=DEFAULT_METADATA_SIZE,
+                 slot_count=DEFAULT_SLOT_COUNT, alignment=DEFAULT_ALIGNMENT,
+                 block_size=DEFAULT_BLOCK_SIZE, block_device="super", virtual_ab=False):
+        if metadata_max_size % LP_SECTOR_SIZE or alignment % block_size or block_size % LP_SECTOR_SIZE:
+            raise SuperError("Размеры метаданных и выравнивание должны быть кратны сектору и блоку")
+        self.geometry = Geometry(metadata_max_size, slot_count, block_size)
+        self.device_size = device_size // block_size * block_size
+        self.alignment = alignment
+        self.alignment_offset = 0
+        self.block_device = block_device
+        self.flags = HEADER_FLAG_VIRTUAL_AB_DEVICE if virtual_ab else 0
+        self.first_logical_sector = _align(metadata_area_size(self.geometry), alignment) // LP_SECTOR_SIZE
+        if self.first_logical_sector * LP_SECTOR_SIZE >= self.device_size:
+            raise SuperError(f"Устройство {device_size} байт меньше области метаданных")
+        # name -> [flags, maximum_size], in table order
+        self.groups = {DEFAULT_GROUP: [0, 0]}
+        # name -> [attributes, group, [(first sector, sectors), ...]]
+        self.partitions = {}
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        """Layout to modify an existing metadata slot"""
+        device = metadata.block_devices[0]
+        if len(metadata.block_devices) != 1:
+            raise SuperError("Поддерживается только super на одном блочном устройстве")
+        layout = cls(device.size, metadata.geometry.metadata_max_size, metadata.geometry.metadata_slot_count,
+                     device.alignment or DEFAULT_ALIGNMENT, metadata.geometry.logical_block_size,
+                     device.name, bool(metadata.flags & HEADER_FLAG_VIRTUAL_AB_DEVICE))
+        layout.device_size = device.size
+        layout.alignment_offset = device.alignment_offset
+        layout.first_logical_sector = device.first_logical_sector
+        layout.groups = {group.name: [group.flags, group.maximum_size] for group in metadata.groups}
+        for partition in metadata.logical_partitions():
+            extents = []
+            for extent in partition.extents:
+                if extent.target_type != TARGET_TYPE_LINEAR or extent.target_source != 0:
+                    raise SuperError(f"{partition.name}: поддерживаются только линейные экстенты")
+                extents.append((extent.target_data, extent.num_sectors))
+            layout.partitions[partition.name] = [partition.attributes, partition.group, extents]
+        return layout
+
+    def add_group(self, name, maximum_size=0):
+        if name in self.groups:
+            raise SuperError(f"Группа {name} уже есть")
+        _encode_name(name)
+        self.groups[name] = [0, maximum_size]
+
+    def remove_group(self, name):
+        if any(group == name for _, group, _ in self.partitions.values()):
+            raise SuperError(f"В группе {name} остались разделы")
+        self.groups.pop(name, None)
+
+    def add_partition(self, name, group=DEFAULT_GROUP, attributes=ATTR_READONLY):
+        if name in self.partitions:
+            raise SuperError(f"Раздел {name} уже есть")
+        if group not in self.groups:
+            raise SuperError(f"Нет группы {group}")
+        _encode_name(name)
+        self.partitions[name] = [attributes, group, []]
+
+    def remove_partition(self, name):
+        self.partitions.pop(name, None)
+
+    def partition_size(self, name):
+        return sum(count for _, count in self.partitions[name][2]) * LP_SECTOR_SIZE
+
+    def group_size(self, group):
+        return sum(self.partition_size(name) for name, entry in self.partitions.items() if entry[1] == group)
+
+    def _free_regions(self):
+        used = sorted(extent for entry in self.partitions.values() for extent in entry[2])
+        position = self.first_logical_sector
+        end = self.device_size // LP_SECTOR_SIZE
+        for first, count in used:
+            if first > position:
+                yield position, first
+            position = max(position, first + count)
+        if position < end:
+            yield position, end
+
+    def resize_partition(self, name, size):
+        """Grow or shrink a partition to size bytes (rounded up to a block)
+
+        Existing extents are kept when growing, so the data already in them
+        stays in place; shrinking cuts from the end.
+        """
+        if name not in self.partitions:
+            raise SuperError(f"Нет раздела {name}")
+        attributes, group, extents = self.partitions[name]
+        sectors = _align(size, self.geometry.logical_block_size) // LP_SECTOR_SIZE
+        current = sum(count for _, count in extents)
+        maximum = self.groups[group][1]
+        if maximum and self.group_size(group) - current * LP_SECTOR_SIZE + sectors * LP_SECTOR_SIZE > maximum:
+            raise SuperError(f"{name}: группа {group} ограничена {maximum} байтами")
+        if sectors <= current:
+            while current > sectors:
+                first, count = extents.pop()
+                cut = min(count, current - sectors)
+                if count > cut:
+                    extents.append((first, count - cut))
+                current -= cut
+            return
+        needed = sectors - current
+        alignment = self.alignment // LP_SECTOR_SIZE
+        offset = self.alignment_offset // LP_SECTOR_SIZE
+        added = []
+        for start, end in self._free_regions():
+            # Extend the last extent in place when free space follows it
+            if not (extents and extents[-1][0] + extents[-1][1] == start):
+                start = _align(start - offset, alignment) + offset
+            if start >= end:
+                continue
+            count = min(end - start, needed)
+            added.append((start, count))
+            needed -= count
+            if not needed:
+                break
+        if needed:
+            raise SuperError(f"{name}: в super не хватает {needed * LP_SECTOR_SIZE} байт")
+        for start, count in added:
+            if extents and extents[-1][0] + extents[-1][1] == start:
+                extents[-1] = (extents[-1][0], extents[-1][1] + count)
+            else:
+                extents.append((start, count))
+
+    def export(self):
+        groups = list(self.groups)
+        partitions = []
+        extents = []
+        for name, (attributes, group, partition_extents) in self.partitions.items():
+            partitions.append((name, attributes, len(extents), len(partition_extents), groups.index(group)))
+            extents += [Extent(count, TARGET_TYPE_LINEAR, first, 0) for first, count in partition_extents]
+        minor = 0
+        if any(attributes & ATTR_UPDATED for attributes, _, _ in self.partitions.values()):
+            minor = 1
+        if self.flags:
+            minor = 2
+        device = BlockDevice(self.first_logical_sector, self.alignment, self.alignment_offset,
+                             self.device_size, self.block_device, 0)
+        return LpMetadata(self.geometry, partitions, extents,
+                          [Group(name, flags, maximum) for name, (flags, maximum) in self.groups.items()],
+                          [device], minor, self.flags)
+
+
+def _frame(chunks, total_blocks):
+    """Sorted chunks with the gaps between them as DONT_CARE"""
+    framed = []
+    position = 0
+    for chunk in sorted(chunks, key=lambda chunk: chunk.start):
+        if chunk.start < position:
+            raise SuperError(f"Пересечение данных на блоке {chunk.start}")
+        if chunk.start > position:
+            framed.append(Chunk(CHUNK_DONT_CARE, position, chunk.start - position, None))
+        framed.append(chunk)
+        position = chunk.start + chunk.blocks
+    if position < total_blocks:
+        framed.append(Chunk(CHUNK_DONT_CARE, position, total_blocks - position, None))
+    return framed
+
+
+class SuperBuilder:
+    """Sparse super image composed from partition images
+
+    images maps partition names to raw or sparse image paths; every
+    partition must already be sized in metadata. The images stay mapped
+    until close(), chunks() hands out slices of them.
+    """
+
+    def __init__(self, metadata, images):
+        self.metadata = metadata
+        self.block_size = metadata.geometry.logical_block_size
+        self.total_blocks = metadata.device_size // self.block_size
+        self.images = {}
+        try:
+            for name, path in images.items():
+                partition = metadata.partition(name)
+                image = sparse_image.SparseImage(path, self.block_size)
+                self.images[name] = image
+                if image.block_size != self.block_size:
+                    raise SuperError(f"{name}: размер блока образа {image.block_size}, в super {self.block_size}")
+                if image.raw_size > partition.size:
+                    raise SuperError(f"{name}: образ ({image.raw_size} байт) больше раздела ({partition.size} байт)")
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        for image in self.images.values():
+            image.close()
+        self.images = {}
+
+    def _metadata_chunks(self):
+        geometry = self.metadata.geometry
+        blob = self.metadata.serialize()
+        area = bytearray(metadata_area_size(geometry))
+        geometry_blob = serialize_geometry(geometry)
+        area[LP_PARTITION_RESERVED_BYTES:LP_PARTITION_RESERVED_BYTES + LP_METADATA_GEOMETRY_SIZE] = geometry_blob
+        area[LP_PARTITION_RESERVED_BYTES + LP_METADATA_GEOMETRY_SIZE:
+             LP_PARTITION_RESERVED_BYTES + 2 * LP_METADATA_GEOMETRY_SIZE] = geometry_blob
+        for slot in range(geometry.metadata_slot_count):
+            for offset in (primary_metadata_offset(geometry, slot), backup_metadata_offset(geometry, slot)):
+                area[offset:offset + len(blob)] = blob
+        area_blocks = _align(len(area), self.block_size) // self.block_size
+        area += bytes(area_blocks * self.block_size - len(area))
+        blocks = {}
+        fills = []
+        zero = bytes(self.block_size)
+        for block in range(area_blocks):
+            data = bytes(area[block * self.block_size:(block + 1) * self.block_size])
+            if data == zero:
+                fills.append((block, 1))
+            else:
+                blocks[block] = data
+        # Merge adjacent zero blocks into one FILL run
+        runs = []
+        for start, count in fills:
+            if runs and runs[-1][0] + runs[-1][1] == start:
+                runs[-1] = (runs[-1][0], runs[-1][1] + count)
+            else:
+                runs.append((start, count))
+        return sparse_image.build_chunks(blocks, runs, area_blocks)
+
+    def _partition_chunks(self, name, image):
+        """Chunks of one image moved onto the extents of its partition"""
+        # (first image block, first super block or None for ZERO, blocks) per extent
+        mapping = []
+        position = 0
+        sectors_per_block = self.block_size // LP_SECTOR_SIZE
+        for extent in self.metadata.partition(name).extents:
+            if extent.target_data % sectors_per_block or extent.num_sectors % sectors_per_block:
+                raise SuperError(f"{name}: экстент не выровнен по блоку {self.block_size}")
+            blocks = extent.num_sectors // sectors_per_block
+            target = extent.target_data // sectors_per_block if extent.target_type == TARGET_TYPE_LINEAR else None
+            mapping.append((position, target, blocks))
+            position += blocks
+        starts = [first for first, _, _ in mapping]
+        for chunk in image.chunks(zero_as_dont_care=False):
+            if chunk.type not in (CHUNK_RAW, CHUNK_FILL):
+                continue
+            start = chunk.start
+            done = 0
+            while done < chunk.blocks:
+                index = bisect.bisect_right(starts, start) - 1
+                first, target, blocks = mapping[index]
+                count = min(chunk.blocks - done, first + blocks - start)
+                data = chunk.data
+                if chunk.type == CHUNK_RAW:
+                    data = chunk.data[done * self.block_size:(done + count) * self.block_size]
+                if target is not None:
+                    yield Chunk(chunk.type, target + start - first, count, data)
+                start += count
+                done += count
+
+    def chunks(self):
+        chunks = self._metadata_chunks()
+        for name, image in self.images.items():
+            chunks += self._partition_chunks(name, image)
+        return _frame(chunks, self.total_blocks)
+
+    def write(self, out_path, sparse=True):
+        """Write super.img, sparse by default; returns the file size"""
+        chunks = self.chunks()
+        if sparse:
+            return sparse_image.write_sparse(chunks, out_path, self.block_size, self.total_blocks)
+        sparse_image.write_raw(chunks, out_path, self.block_size, self.total_blocks)
+        return self.total_blocks * self.block_size
+
+
+def make_builder(device_size, partitions, groups=(), **options):
+    """SuperBuilder for a fresh layout
+
+    partitions is a list of (name, group, image path or None); each
+    partition is sized to its image, None leaves it empty (the _b slot of
+    an A/B super). groups lists (name, maximum size). options go to
+    SuperLayout.
+    """
+    layout = SuperLayout(device_size, **options)
+    for name, maximum in groups:
+        layout.add_group(name, maximum)
+    images = {}
+    for name, group, path in partitions:
+        layout.add_partition(name, group)
+        if path:
+            with sparse_image.SparseImage(path) as image:
+                layout.resize_partition(name, image.raw_size)
+            images[name] = path
+    return SuperBuilder(layout.export(), images)
+
+
+def _slot_of(name):
+    base, _, suffix = name.rpartition("_")
+    return suffix if base and suffix in ("a", "b") else ""
+
+
+def batched_update(template, device_size, partitions, commands, slot, rewritten):
+    """Metadata for one update-super replacing a run of logical partition commands
+
+    template is LpMetadata of the firmware's super image (geometry and
+    groups), device_size the size of the device's super, partitions the
+    logical partitions the device reports ({name: size}), commands the
+    (command, name, size) triples of create-, delete- and
+    resize-logical-partition in script order, slot the current slot
+    letter and rewritten the partitions flashed right after the commands.
+
+    fastbootd takes the current slot's partitions from the new metadata
+    and keeps the other slot's, so the current slot is laid out from
+    scratch here. That is only safe when no partition whose extents are
+    unknown keeps data: every other-slot partition must be empty and every
+    non-empty current-slot partition must be rewritten. Partitions made by
+    create-logical-partition land in the default group without
+    attributes, as fastbootd would create them; the others keep the group
+    and attributes of the template. Raises SuperError otherwise.
+    """
+    if template.device_size != device_size:
+        raise SuperError(f"super устройства ({device_size} байт) не совпадает с образом прошивки "
+                         f"({template.device_size} байт)")
+    sizes = dict(partitions)
+    created = set()
+    for command, name, size in commands:
+        if _slot_of(name) != slot:
+            raise SuperError(f"{name} не относится к текущему слоту {slot}")
+        if command == "delete-logical-partition":
+            sizes.pop(name, None)
+            created.discard(name)
+        elif command == "create-logical-partition":
+            if name in sizes:
+                raise SuperError(f"Раздел {name} уже существует")
+            sizes[name] = size
+            created.add(name)
+        elif command == "resize-logical-partition":
+            if name not in sizes:
+                raise SuperError(f"Нет раздела {name}")
+            sizes[name] = size
+        else:
+            raise SuperError(f"Неизвестная команда {command}")
+    busy = [name for name, size in sizes.items() if size and _slot_of(name) != slot]
+    if busy:
+        raise SuperError(f"Разделы другого слота заняты: {', '.join(sorted(busy))}")
+    kept = [name for name, size in sizes.items()
+            if size and _slot_of(name) == slot and name not in rewritten]
+    if kept:
+        raise SuperError(f"Разделы не перепрошиваются и потеряли бы данные: {', '.join(sorted(kept))}")
+
+    layout = SuperLayout.from_metadata(template)
+    known = {partition.name: partition for partition in template.logical_partitions()}
+    layout.partitions.clear()
+    order = list(known)
+    for name in sorted((name for name in sizes if _slot_of(name) == slot),
+                       key=lambda name: (order.index(name) if name in order else len(order), name)):
+        if name in created:
+            layout.add_partition(name, DEFAULT_GROUP, 0)
+        elif name in known:
+            layout.add_partition(name, known[name].group, known[name].attributes)
+        else:
+            raise SuperError(f"Раздела {name} нет в образе прошивки, группа неизвестна")
+        layout.resize_partition(name, sizes[name])
+    return layout.export()
+
+
+def describe_attributes(attributes):
+    names = [label for flag, label in ATTRIBUTE_NAMES.items() if attributes & flag]
+    return ",".join(names) or "none"
+
+
+def _parse_partition(text):
+    """NAME[:GROUP][=IMAGE] -> (name, group, image)"""
+    spec, _, path = text.partition("=")
+    name, _, group = spec.partition(":")
+    return name, group or DEFAULT_GROUP, path or None
+
+
+def main():
+    """Command line:
+    super_image.py list SUPER [SLOT]
+    super_image.py unpack SUPER OUTPUT_DIR [PARTITION ...]
+    super_image.py build OUTPUT DEVICE_SIZE [-g GROUP:MAX] [-p NAME[:GROUP][=IMAGE]] ...
+                   [--slots N] [--metadata-size N] [--virtual-ab] [--raw]
+
+    SUPER may be raw, sparse or super_empty.img. For build, partitions
+    without an image are created empty.
+    """
+    args = sys.argv[1:]
+    if not args:
+        print(main.__doc__)
+        return 1
+    command = args.pop(0)
+    try:
+        if command == "list" and len(args) in (1, 2):
+            slot = int(args[1]) if len(args) == 2 else 0
+            with SuperImage(args[0]) as image:
+                metadata = image.metadata(slot)
+                print(f"lpmetadata 10.{metadata.minor}, слотов: {metadata.geometry.metadata_slot_count}, "
+                      f"super: {metadata.device_size / 1024 ** 3:.2f} ГБ")
+                for group in metadata.groups:
+                    limit = f"{group.maximum_size / 1024 ** 3:.2f} ГБ" if group.maximum_size else "без ограничения"
+                    print(f"Группа {group.name}: {limit}")
+                for partition in image.partitions(slot):
+                    print(f"{partition.name}\t{partition.group}\t{partition.size / 1024 ** 2:.1f} МБ\t"
+                          f"{describe_attributes(partition.attributes)}\tэкстентов: {len(partition.extents)}")
+            return 0
+        if command == "unpack" and len(args) >= 2:
+            started = time.monotonic()
+
+            def progress(done, total):
+                print(f"\r{done * 100 // max(total, 1)}%", end="", flush=True)
+            images = extract(args[0], args[1], args[2:] or None, progress=progress)
+            print(f"\nИзвлечено образов: {len(images)} за {time.monotonic() - started:.1f} с")
+            return 0
+        if command == "build" and len(args) >= 2:
+            output, device_size = args[0], parse_size(args[1])
+            groups, partitions, options, sparse = [], [], {}, True
+            rest = args[2:]
+            while rest:
+                arg = rest.pop(0)
+                if arg == "-g" and rest:
+                    name, _, maximum = rest.pop(0).partition(":")
+                    groups.append((name, parse_size(maximum) if maximum else 0))
+                elif arg == "-p" and rest:
+                    partitions.append(_parse_partition(rest.pop(0)))
+                elif arg == "--slots" and rest:
+                    options["slot_count"] = int(rest.pop(0))
+                elif arg == "--metadata-size" and rest:
+                    options["metadata_max_size"] = int(rest.pop(0))
+                elif arg == "--virtual-ab":
+                    options["virtual_ab"] = True
+                elif arg == "--raw":
+                    sparse = False
+                else:
+                    print(main.__doc__)
+                    return 1
+            started = time.monotonic()
+            with make_builder(device_size, partitions, groups, **options) as builder:
+                written = builder.write(output, sparse)
+            print(f"Записано {written / 1024 ** 2:.1f} МБ за {time.monotonic() - started:.2f} с")
+            return 0
+    except (SuperError, sparse_image.SparseError, Ext4Error, OSError, ValueError) as e:
+        print(f"\nОшибка: {e}")
+        return 1
+    print(main.__doc__)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""AdbClient host-protocol exchanges against a socket stand-in for the adb server"""
+import socket
+import threading
+
+import pytest
+
+import adb_client
+from adb_client import AdbClient, AdbError
+from device_monitor import DeviceMonitor, FakeBackend
+
+
+class FakeAdbServer:
+    """Answers host:* and host:transport:<serial> requests like adb server does"""
+
+    def __init__(self, devices):
+        # serial -> {"state": ..., "props": {...}}
+        self.devices = devices
+        self.requests = []
+        self.lock = threading.Lock()
+        # Called with the serial after a reboot request was accepted
+        self.on_reboot = None
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def close(self):
+        self.server.close()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+    @staticmethod
+    def _recv(connection, length):
+        data = b""
+        while len(data) < length:
+            chunk = connection.recv(length - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _request(self, connection):
+        request = self._recv(connection, int(self._recv(connection, 4), 16)).decode()
+        with self.lock:
+            self.requests.append(request)
+        return request
+
+    @staticmethod
+    def _fail(connection, message):
+        data = message.encode()
+        connection.sendall(b"FAIL%04x" % len(data) + data)
+
+    @staticmethod
+    def _block(connection, payload):
+        data = payload.encode()
+        connection.sendall(b"OKAY%04x" % len(data) + data)
+
+    def _handle(self, connection):
+        with connection:
+            try:
+                request = self._request(connection)
+                if request == "host:version":
+                    return self._block(connection, "0029")
+                if request == "host:devices-l":
+                    return self._block(connection, "".join(
+                        f"{serial}\t{device['state']} product:aristotle model:M_{serial} "
+                        f"device:aristotle transport_id:1\n"
+                        for serial, device in self.devices.items()))
+                if not request.startswith("host:transport:"):
+                    return self._fail(connection, "unknown host service")
+                serial = request.split(":", 2)[2]
+                if serial not in self.devices:
+                    return self._fail(connection, f"device '{serial}' not found")
+                connection.sendall(b"OKAY")
+                request = self._request(connection)
+                properties = self.devices[serial]["props"]
+                if request == "shell:getprop":
+                    connection.sendall(b"OKAY" + "".join(
+                        f"[{name}]: [{value}]\n" for name, value in properties.items()).encode())
+                elif request.startswith("shell:getprop "):
+                    connection.sendall(b"OKAY" + (properties.get(request.split()[1], "") + "\n").encode())
+                elif request.startswith("reboot:"):
+                    connection.sendall(b"OKAY")
+                    self.devices[serial]["state"] = "offline"
+                    if self.on_reboot:
+                        self.on_reboot(serial)
+                else:
+                    self._fail(connection, "unknown service")
+            except (EOFError, OSError):
+                pass
+
+
+@pytest.fixture
+def server():
+    fake = FakeAdbServer({
+        "A1": {"state": "device", "props": {"ro.product.device": "aristotle",
+                                            "ro.build.version.incremental": "OS2.0.104.0"}},
+        "B2": {"state": "unauthorized", "props": {}},
+    })
+    yield fake
+    fake.close()
+
+
+@pytest.fixture
+def client(server):
+    return AdbClient("127.0.0.1", server.port, timeout=5)
+
+
+def test_version(client):
+    assert client.version() == 0x29
+
+
+def test_devices(client):
+    devices = {device.serial: device for device in client.devices()}
+    assert devices["A1"].ready and devices["A1"].model == "M_A1"
+    assert not devices["B2"].ready
+
+
+def test_getprop(client, server):
+    assert client.getprop("A1", "ro.product.device") == "aristotle"
+    assert client.getprop("A1")["ro.build.version.incremental"] == "OS2.0.104.0"
+    assert server.requests[:2] == ["host:transport:A1", "shell:getprop ro.product.device"]
+
+
+def test_fail_carries_server_message(client):
+    with pytest.raises(AdbError, match="device 'C3' not found"):
+        client.getprop("C3", "ro.product.device")
+    with pytest.raises(AdbError, match="unknown host service"):
+        client.host_request("host:nonsense")
+
+
+def test_server_unavailable():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    with pytest.raises(AdbError, match="недоступен"):
+        AdbClient("127.0.0.1", port).devices()
+
+
+def test_getprop_all_keeps_errors_per_serial(client):
+    results = adb_client.getprop_all(client, "ro.product.device", serials=["A1", "C3"])
+    assert results["A1"] == "aristotle"
+    assert isinstance(results["C3"], AdbError)
+
+
+def test_reboot_all_waits_for_fastboot(client, server):
+    backend = FakeBackend()
+    server.on_reboot = lambda serial: threading.Timer(0.1, backend.plug, args=(serial,)).start()
+    with DeviceMonitor(backend) as monitor:
+        results = adb_client.reboot_all(client, monitor=monitor, timeout=5)
+    assert results == {"A1": None}
+    assert server.devices["A1"]["state"] == "offline"
+    assert "reboot:bootloader" in server.requests
+
+
+def test_server_address_from_environment(monkeypatch):
+    monkeypatch.setenv("ADB_SERVER_SOCKET", "tcp:10.0.0.2:5038")
+    assert adb_client.server_address() == ("10.0.0.2", 5038)
+    monkeypatch.delenv("ADB_SERVER_SOCKET")
+    assert adb_client.server_address() == (adb_client.DEFAULT_HOST, adb_client.DEFAULT_PORT)
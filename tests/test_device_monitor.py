@@ -0,0 +1,124 @@
+"""DeviceMonitor registry and events driven through FakeBackend"""
+import threading
+import time
+
+import device_monitor
+from device_monitor import (EVENT_ADDED, EVENT_MODE_CHANGED, EVENT_REMOVED, MODE_ADB,
+                            MODE_FASTBOOT, DeviceMonitor, FakeBackend, PollingBackend, UsbDevice)
+
+
+def start_monitor():
+    backend = FakeBackend()
+    monitor = DeviceMonitor(backend).start()
+    events = []
+    monitor.subscribe(events.append)
+    return backend, monitor, events
+
+
+def test_devices_present_at_start():
+    backend = FakeBackend()
+    backend.plug("A1")
+    backend.plug("B2", MODE_ADB)
+    with DeviceMonitor(backend) as monitor:
+        assert monitor.serials() == ["A1"]
+        assert [device.serial for device in monitor.list()] == ["A1", "B2"]
+
+
+def test_plug_and_unplug_events():
+    backend, monitor, events = start_monitor()
+    backend.plug("A1")
+    backend.unplug("A1")
+    assert [event.kind for event in events] == [EVENT_ADDED, EVENT_REMOVED]
+    assert monitor.get("A1") is None
+    monitor.stop()
+
+
+def test_mode_change_on_replug():
+    backend, monitor, events = start_monitor()
+    backend.plug("A1", MODE_ADB)
+    backend.plug("A1", MODE_FASTBOOT)
+    assert [event.kind for event in events] == [EVENT_ADDED, EVENT_REMOVED, EVENT_ADDED,
+                                                EVENT_MODE_CHANGED]
+    assert events[-1].previous_mode == MODE_ADB
+    assert monitor.get("A1").mode == MODE_FASTBOOT
+    monitor.stop()
+
+
+def test_duplicate_add_is_ignored():
+    backend, monitor, events = start_monitor()
+    device = backend.plug("A1")
+    # Interface and bind uevents report the same device twice
+    backend.added(UsbDevice("A1", MODE_FASTBOOT, device.location))
+    assert [event.kind for event in events] == [EVENT_ADDED]
+    monitor.stop()
+
+
+def test_wait_for_device_plugged_later():
+    backend, monitor, _ = start_monitor()
+    timer = threading.Timer(0.1, backend.plug, args=("A1",))
+    timer.start()
+    device = monitor.wait_for("A1", timeout=5)
+    timer.join()
+    assert device is not None and device.serial == "A1"
+    monitor.stop()
+
+
+def test_wait_for_timeout_and_cancel():
+    _, monitor, _ = start_monitor()
+    assert monitor.wait_for("A1", timeout=0.1) is None
+    cancel = threading.Event()
+    cancel.set()
+    started = time.time()
+    assert monitor.wait_for("A1", cancel_event=cancel) is None
+    assert time.time() - started < 1
+    monitor.stop()
+
+
+def test_wait_for_removal():
+    backend, monitor, _ = start_monitor()
+    backend.plug("A1")
+    assert not monitor.wait_for_removal("A1", timeout=0.05)
+    threading.Timer(0.1, backend.unplug, args=("A1",)).start()
+    assert monitor.wait_for_removal("A1", timeout=5)
+    monitor.stop()
+
+
+def test_broken_subscriber_and_unsubscribe():
+    backend, monitor, events = start_monitor()
+
+    def broken(event):
+        raise RuntimeError("subscriber bug")
+    unsubscribe = monitor.subscribe(broken)
+    backend.plug("A1")
+    unsubscribe()
+    backend.unplug("A1")
+    assert [event.kind for event in events] == [EVENT_ADDED, EVENT_REMOVED]
+    monitor.stop()
+
+
+def test_polling_backend_survives_scan_errors():
+    class FlakyBackend(PollingBackend):
+        def __init__(self):
+            super().__init__(interval=0.01)
+            self.calls = 0
+
+        def scan(self):
+            self.calls += 1
+            if self.calls <= 3:
+                raise OSError("usb backend unavailable")
+            return [UsbDevice("A1", MODE_FASTBOOT, "usb:1:1")]
+
+    backend = FlakyBackend()
+    added = threading.Event()
+    backend.start(lambda device: added.set(), lambda location: None)
+    try:
+        assert added.wait(5)
+        assert backend.thread.is_alive()
+    finally:
+        backend.stop()
+
+
+def test_event_text():
+    event = device_monitor.DeviceEvent(EVENT_MODE_CHANGED, UsbDevice("A1", MODE_FASTBOOT, "usb:1:1"),
+                                       MODE_ADB)
+    assert event.describe() == "A1: adb → fastboot"
@@ -0,0 +1,220 @@
+"""FastbootClient over TcpTransport against a loopback fake device"""
+import os
+import socket
+import struct
+import threading
+
+import pytest
+
+import sparse_image
+from fastboot_client import FastbootClient, FastbootDisconnected, FastbootError
+
+
+class FakeFastbootDevice:
+    """Fastboot TCP protocol (FB01 handshake, 8-byte length frames) on 127.0.0.1"""
+
+    def __init__(self, variables=None, max_download=0x10000, handshake=b"FB01"):
+        self.variables = {"max-download-size": hex(max_download), "product": "aristotle",
+                          "current-slot": "a", "slot-count": "2", "is-userspace": "no"}
+        self.variables.update(variables or {})
+        self.handshake = handshake
+        self.commands = []
+        self.downloads = []
+        self.flashed = {}
+        # Commands that close the connection instead of answering
+        self.drop = set()
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(4)
+        self.serial = f"tcp:127.0.0.1:{self.server.getsockname()[1]}"
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def close(self):
+        self.server.close()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+
+    @staticmethod
+    def _recv(connection, length):
+        data = b""
+        while len(data) < length:
+            chunk = connection.recv(length - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _message(self, connection):
+        length, = struct.unpack(">Q", self._recv(connection, 8))
+        return self._recv(connection, length)
+
+    @staticmethod
+    def _send(connection, message):
+        connection.sendall(struct.pack(">Q", len(message)) + message)
+
+    def _handle(self, connection):
+        with connection:
+            try:
+                self._recv(connection, 4)
+                connection.sendall(self.handshake)
+                download = b""
+                while True:
+                    command = self._message(connection).decode()
+                    self.commands.append(command)
+                    if command in self.drop:
+                        return
+                    if command == "getvar:all":
+                        for name, value in self.variables.items():
+                            self._send(connection, f"INFO{name}:{value}".encode())
+                        self._send(connection, b"OKAY")
+                    elif command.startswith("getvar:"):
+                        value = self.variables.get(command[7:])
+                        self._send(connection, b"FAILunknown variable" if value is None
+                                   else b"OKAY" + value.encode())
+                    elif command.startswith("download:"):
+                        size = int(command[9:], 16)
+                        self._send(connection, b"DATA%08x" % size)
+                        download = b""
+                        while len(download) < size:
+                            download += self._message(connection)
+                        self.downloads.append(download)
+                        self._send(connection, b"OKAY")
+                    elif command.startswith("flash:"):
+                        self.flashed.setdefault(command[6:], []).append(download)
+                        self._send(connection, b"INFOwriting")
+                        self._send(connection, b"OKAY")
+                    elif command.startswith(("erase:", "reboot", "set_active:", "oem ")):
+                        self._send(connection, b"OKAY")
+                    else:
+                        self._send(connection, b"FAILunknown command")
+            except (EOFError, OSError):
+                pass
+
+
+@pytest.fixture
+def device():
+    fake = FakeFastbootDevice()
+    yield fake
+    fake.close()
+
+
+def unsparse(data, tmp_path):
+    """Raw bytes described by one sparse download"""
+    path = tmp_path / "piece.img"
+    path.write_bytes(data)
+    with sparse_image.SparseImage(str(path)) as image:
+        assert image.sparse
+        raw = bytearray(image.total_blocks * image.block_size)
+        for chunk in image.chunks():
+            offset = chunk.start * image.block_size
+            length = chunk.blocks * image.block_size
+            if chunk.type == sparse_image.CHUNK_RAW:
+                raw[offset:offset + length] = chunk.data
+            elif chunk.type == sparse_image.CHUNK_FILL:
+                raw[offset:offset + length] = bytes(chunk.data) * (length // 4)
+        return raw
+
+
+def test_getvar(device):
+    with FastbootClient.connect(device.serial) as client:
+        assert client.getvar("product") == "aristotle"
+        assert client.max_download_size() == 0x10000
+
+
+def test_fail_reply_raises(device):
+    with FastbootClient.connect(device.serial) as client:
+        with pytest.raises(FastbootError, match="unknown variable"):
+            client.getvar("no-such-variable")
+        # The session stays usable after a FAIL
+        assert client.getvar("current-slot") == "a"
+
+
+def test_info_lines_reach_callback(device):
+    lines = []
+    with FastbootClient.connect(device.serial, info_callback=lines.append) as client:
+        client.command("flash:boot")
+    assert lines == ["writing"]
+
+
+def test_probe_reads_getvar_all(device):
+    with FastbootClient.connect(device.serial) as client:
+        info = client.probe(refresh=True)
+    assert info.variables["product"] == "aristotle"
+    assert device.commands.count("getvar:all") == 1
+
+
+def test_flash_small_image(device, tmp_path):
+    data = os.urandom(10000)
+    path = tmp_path / "boot.img"
+    path.write_bytes(data)
+    with FastbootClient.connect(device.serial) as client:
+        client.flash_image("boot", str(path))
+    assert device.flashed["boot"] == [data]
+
+
+def test_flash_large_image_is_split(device, tmp_path):
+    block = 4096
+    # Random blocks around a zero gap, three times max-download-size
+    data = os.urandom(16 * block) + bytes(16 * block) + os.urandom(16 * block)
+    path = tmp_path / "vendor.img"
+    path.write_bytes(data)
+    progress = []
+    with FastbootClient.connect(device.serial) as client:
+        client.flash_image("vendor", str(path), progress=lambda done, total: progress.append(done))
+    pieces = device.flashed["vendor"]
+    assert len(pieces) > 1
+    assert all(len(piece) <= 0x10000 for piece in pieces)
+    raw = bytearray(len(data))
+    for piece in pieces:
+        for index, value in enumerate(unsparse(piece, tmp_path)):
+            if value:
+                raw[index] = value
+    assert bytes(raw) == data
+    assert progress and progress == sorted(progress)
+
+
+def test_flash_stream_in_pieces(device, tmp_path):
+    data = os.urandom(0x18000)
+    path = tmp_path / "system.img"
+    path.write_bytes(data)
+    with FastbootClient.connect(device.serial) as client, open(path, "rb") as stream:
+        client.flash_stream("system", stream, len(data))
+    assert len(device.flashed["system"]) > 1
+
+
+def test_commands(device):
+    with FastbootClient.connect(device.serial) as client:
+        client.erase("cache")
+        client.set_active("b")
+        client.reboot("bootloader")
+    assert device.commands[-3:] == ["erase:cache", "set_active:b", "reboot-bootloader"]
+
+
+def test_dropped_connection(device):
+    device.drop.add("erase:userdata")
+    with FastbootClient.connect(device.serial) as client:
+        with pytest.raises(FastbootDisconnected):
+            client.erase("userdata")
+
+
+def test_bad_handshake():
+    fake = FakeFastbootDevice(handshake=b"NOPE")
+    try:
+        with pytest.raises(FastbootError):
+            FastbootClient.connect(fake.serial)
+    finally:
+        fake.close()
+
+
+def test_no_listener():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    with pytest.raises(FastbootDisconnected):
+        FastbootClient.connect(f"tcp:127.0.0.1:{port}")